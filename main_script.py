@@ -1,92 +1,488 @@
 import argparse
 import os
 import sys
-from modules import maasHelper, onboard 
-import csv
+from modules.logPipeline import setup_logger
+from modules.stepCache import CACHEABLE_STEPS
+from modules.runState import RunState
+from modules.inventory import Inventory, InventoryError
+# The MAAS client, the engines and onboarding (jinja2) are imported by the
+# commands that use them, so status starts at once and touches neither.
 
+COMMANDS = ("run", "provision", "storage", "deploy", "onboard", "status")
+# The command when none is given: the whole workflow, as before there were commands.
+DEFAULT_COMMAND = "run"
+# Status each stage command leaves the machines it runs on with.
+STAGE_TARGETS = {"provision": "Ready", "storage": "Ready", "deploy": "Deployed"}
 
 
 ###############################################################################
 #                           Argument parsing                                  #
 ###############################################################################
-parser = argparse.ArgumentParser(description="Add and deploy MAAS machines from a CSV file.and PCD Node Onboarding")
-parser.add_argument("-maas_user","--maas_user", required=True, help="MAAS username")
-parser.add_argument("-csv_filename","--csv_filename", required=True, help="CSV file path")
-parser.add_argument("-cloud_init_template", "--cloud_init_template", required=False, help="Cloud-init template YAML path ")
-parser.add_argument("-portal", "--portal", required=True, help="Region name (REQUIRED)")
-parser.add_argument("-region", "--region", required=True, help="Site name to form DU=<portal>-<region> (REQUIRED)")
-parser.add_argument("-environment", "--environment", required=True, help="Environment name to segregate hosts")
-parser.add_argument("-url", "--url", required=True, help="Portal URL for blueprint/hostconfigs/network resources")
-parser.add_argument("-ssh_user", "--ssh_user", required=True, help="SSH user for Ansible")
-parser.add_argument("-max_workers", "--max_workers", required=True,type=int,help="Maximum number of concurrent threads for provisioning")
-parser.add_argument("-preserve_cloud_init","--preserve_cloud_init",choices=["yes", "no"],default="no",help="Preserve cloud-init files created for each machine (yes or no, default: no)")
-parser.add_argument("-setup_env","--setup_env",choices=["yes", "no"],default="no",help="setup the environment for pcd onboarding script (yes or no, default: no)")
-parser.add_argument("-storage_layout","--storage_layout",choices=["yes", "no"],default="no",help="setup the storage layout for machines (yes or no, default: no)")
-parser.add_argument("-storage_layout_template", "--storage_layout_template", required=False, help="storage layout template JSON path ")
-parser.add_argument("-onprem","--onprem",choices=["yes", "no"],default="no",help="is it onprem installation (yes or no, default: no)")
-parser.add_argument("-controller_ip", "--controller_ip", required=False, help="PCD controller IP")
-args = parser.parse_args()
-
-
-current_dir = os.getcwd()
-home = os.getenv("HOME")
-logger = maasHelper.setup_logger()
-
-if not os.path.isfile(args.csv_filename):
-    logger.error(f"Error: The CSV file '{args.csv_filename}' does not exist.")
-    sys.exit(1)
-
-if args.cloud_init_template and not os.path.isfile(args.cloud_init_template):
-    logger.error(f"Error: The cloud-init template file '{args.cloud_init_template}' does not exist.")
-    sys.exit(1)
-if not args.cloud_init_template:
-    with open(args.csv_filename, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        if 'cloud_init' not in reader.fieldnames:
-            logger.error("Error: No cloud-init template provided and 'cloud-init' column is missing from the CSV.")
-            sys.exit(1)
-if not os.path.isfile("vars_template.j2"):
-    logger.error(f"Error: The template file vars_template.j2 does not exist.")
-    sys.exit(1)
-if not os.path.isdir("pcd_ansible-pcd_develop"):
-    logger.error(f"Directory pcd_ansible-pcd_develop does not exist.")
-    sys.exit(1)
-if args.storage_layout == "yes" and not os.path.isfile(args.storage_layout_template):
-    logger.error(f"Error: The storage layout template file '{args.storage_layout_template}' does not exist.")
-    sys.exit(1)
-if args.onprem == "yes" and not args.controller_ip:
-    logger.error(f"Error: controller IP is required") 
-    sys.exit(1)
+def add_state_options(parser):
+    parser.add_argument("-csv_filename","--csv_filename", required=True, help="CSV file path")
+    parser.add_argument("-journal", "--journal", required=False, help="Progress journal path (default: <csv_filename without .csv>_journal.jsonl)")
+
+
+def add_selector_options(parser):
+    parser.add_argument("-node","--node",action="append",default=[],help="only the machine with this hostname (shell patterns such as r1-* work); repeat for more (default: every machine of the CSV)")
+    parser.add_argument("-status","--status",action="append",default=[],help="only the machines whose last status is this, e.g. Deployed-Unreachable, Ready or \"Not Started\"; repeat for more")
+    parser.add_argument("-rack","--rack",action="append",default=[],help="only the machines in this rack (the CSV rack column); repeat for more")
+
+
+def add_maas_options(parser, required=True):
+    parser.add_argument("-maas_user","--maas_user", required=True, help="MAAS username")
+    if required:
+        parser.add_argument("-max_workers", "--max_workers", required=True,type=int,help="Maximum number of concurrent threads per provisioning stage")
+    else:
+        parser.add_argument("-max_workers", "--max_workers", type=int, default=10, help="Maximum number of concurrent threads per provisioning stage (default: 10)")
+    parser.add_argument("-maas_client","--maas_client",choices=["api", "cli"],default="api",help="talk to MAAS through the REST API or by forking the maas CLI (api or cli, default: api)")
+    parser.add_argument("-maas_url", "--maas_url", required=False, help="MAAS URL, e.g. http://<maas_ip>:5240/MAAS/ (default: taken from the maas CLI profile)")
+    parser.add_argument("-maas_api_key", "--maas_api_key", required=False, help="MAAS API key (default: taken from the maas CLI profile)")
+    parser.add_argument("-poll_min_interval", "--poll_min_interval", type=float, default=5, help="Shortest interval in seconds between bulk machine status polls (default: 5)")
+    parser.add_argument("-poll_max_interval", "--poll_max_interval", type=float, default=60, help="Longest interval in seconds between bulk machine status polls (default: 60)")
+    parser.add_argument("-engine","--engine",choices=["thread", "async"],default="thread",help="provisioning engine: one worker thread per in-flight stage, or a single asyncio event loop (thread or async, default: thread)")
+    parser.add_argument("-max_creates", "--max_creates", type=int, required=False, help="Maximum concurrent machine creates (default: --max_workers)")
+    parser.add_argument("-max_storage", "--max_storage", type=int, required=False, help="Maximum machines configuring storage layout at once (default: --max_workers)")
+    parser.add_argument("-max_deploys", "--max_deploys", type=int, required=False, help="Maximum concurrent deploy calls (default: --max_workers)")
+    parser.add_argument("-max_ssh_probes", "--max_ssh_probes", type=int, required=False, help="Maximum concurrent SSH connectivity checks (default: --max_workers)")
+    parser.add_argument("-adaptive","--adaptive",choices=["yes", "no"],default="no",help="adapt how many machines are provisioned at once: start with a canary wave, then add one machine at a time while MAAS copes and halve on failures or slow MAAS calls (yes or no, default: no)")
+    parser.add_argument("-adaptive_canary","--adaptive_canary",type=int,default=5,help="Machines in the first (canary) wave of --adaptive (default: 5)")
+    parser.add_argument("-adaptive_max","--adaptive_max",type=int,required=False,help="Most machines --adaptive lets in flight at once (default: no limit)")
+    parser.add_argument("-throttle", "--throttle", action="append", default=[], help="Limit an operation (create, storage, deploy or power-update) per key (global, subnet, rack or rack_controller), e.g. deploy,key=subnet,concurrency=4,rate=0.5,burst=2; repeat for more operations")
+    parser.add_argument("-retry", "--retry", action="append", default=[], help="Retry policy for transient MAAS errors of one stage (create, commission, storage, deploy or power-update), e.g. deploy,attempts=6,base=2,max=60,budget=900; repeat for more stages (default: 4 attempts, 2-30s backoff, 300s budget)")
+    parser.add_argument("-commission_retries", "--commission_retries", type=int, default=2, help="How many times a machine that ends in Failed commissioning is commissioned again (default: 2)")
+
+
+def add_provision_options(parser):
+    parser.add_argument("-enlist","--enlist",choices=["yes", "no"],default="no",help="adopt machines MAAS already enlisted by itself (matched by MAC) instead of creating them, and commission them in bulk (yes or no, default: no)")
+    parser.add_argument("-bmc_preflight","--bmc_preflight",choices=["no", "reach", "auth"],default="no",help="check every machine's BMC before creating any: reach checks that the IPMI (UDP 623) or Redfish (TCP 443) port answers, auth also logs in with the CSV credentials (no, reach or auth, default: no)")
+    parser.add_argument("-bmc_exclude","--bmc_exclude",choices=["yes", "no"],default="no",help="leave out the machines that fail the BMC preflight and provision the rest, instead of stopping (yes or no, default: no)")
+    parser.add_argument("-bmc_preflight_workers","--bmc_preflight_workers",type=int,default=64,help="BMCs checked at once by the preflight (default: 64)")
+    parser.add_argument("-bmc_timeout","--bmc_timeout",type=float,default=2.0,help="Seconds each BMC check waits for an answer (default: 2)")
+
+
+def add_storage_options(parser, stage=False):
+    if stage:
+        parser.add_argument("-storage_layout","--storage_layout",choices=["yes", "plan"],default="yes",help="set up the storage layout, or plan to only log the changes it would make (yes or plan, default: yes)")
+        parser.add_argument("-storage_layout_template", "--storage_layout_template", required=True, help="storage layout template JSON path ")
+    else:
+        parser.add_argument("-storage_layout","--storage_layout",choices=["yes", "no", "plan"],default="no",help="setup the storage layout for machines (yes, no or plan to only log the changes it would make, default: no)")
+        parser.add_argument("-storage_layout_template", "--storage_layout_template", required=False, help="storage layout template JSON path ")
+
+
+def add_deploy_options(parser):
+    parser.add_argument("-cloud_init_template", "--cloud_init_template", required=False, help="Cloud-init template YAML path ")
+    parser.add_argument("-preserve_cloud_init","--preserve_cloud_init",choices=["yes", "no"],default="no",help="Preserve cloud-init files created for each machine (yes or no, default: no)")
+    parser.add_argument("-ssh_user", "--ssh_user", required=True, help="SSH user for Ansible")
+    parser.add_argument("-ssh_probe_deadline", "--ssh_probe_deadline", type=float, default=600, help="Seconds a deployed machine gets to accept an SSH login before it is marked Deployed-Unreachable (default: 600)")
+    parser.add_argument("-ssh_probe_min_backoff", "--ssh_probe_min_backoff", type=float, default=2, help="Initial delay in seconds between SSH reachability attempts, doubled after each failure (default: 2)")
+    parser.add_argument("-ssh_probe_max_backoff", "--ssh_probe_max_backoff", type=float, default=30, help="Longest delay in seconds between SSH reachability attempts (default: 30)")
+    parser.add_argument("-ssh_port", "--ssh_port", type=int, default=22, help="SSH port of the deployed machines (default: 22)")
+
+
+def add_onboarding_options(parser):
+    parser.add_argument("-portal", "--portal", required=True, help="Region name (REQUIRED)")
+    parser.add_argument("-region", "--region", required=True, help="Site name to form DU=<portal>-<region> (REQUIRED)")
+    parser.add_argument("-environment", "--environment", required=True, help="Environment name to segregate hosts")
+    parser.add_argument("-url", "--url", required=True, help="Portal URL for blueprint/hostconfigs/network resources")
+    parser.add_argument("-setup_env","--setup_env",choices=["yes", "no"],default="no",help="setup the environment for pcd onboarding script (yes or no, default: no)")
+    parser.add_argument("-onprem","--onprem",choices=["yes", "no"],default="no",help="is it onprem installation (yes or no, default: no)")
+    parser.add_argument("-controller_ip", "--controller_ip", required=False, help="PCD controller IP")
+    parser.add_argument("-onboard_shards", "--onboard_shards", type=int, default=1, help="Split the hosts of an onboarding run into this many shards onboarded in parallel, each in its own copy of pcd_ansible-pcd_develop (default: 1)")
+    parser.add_argument("-force_step","--force_step","--force-step",action="append",default=[],choices=CACHEABLE_STEPS + ("all",),help="run this onboarding step even if its inputs and outputs are unchanged since it last succeeded; repeat for more steps, or all (default: unchanged setup-environment, render-userconfig and create-hostagents-configs steps are skipped)")
+
+
+def add_log_options(parser):
+    parser.add_argument("-node_logs","--node_logs",choices=["yes", "no"],default="no",help="also write every log line about a machine to deploy_logs/nodes/<hostname>.log (yes or no, default: no)")
+    parser.add_argument("-spans_file", "--spans_file", default="deploy_logs/stage_spans.jsonl", help="JSON lines file the per-node stage timings are appended to (default: deploy_logs/stage_spans.jsonl)")
+    parser.add_argument("-metrics_file", "--metrics_file", required=False, help="Also write the stage timing summary as a Prometheus textfile, e.g. for the node exporter textfile collector")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Add and deploy MAAS machines from a CSV file.and PCD Node Onboarding",
+                                     epilog=f"Without a command, {DEFAULT_COMMAND} is assumed.")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    run = commands.add_parser("run", help="the whole workflow: provision, storage layout, deploy and onboard every machine of the CSV")
+    add_state_options(run)
+    add_maas_options(run)
+    add_provision_options(run)
+    add_storage_options(run)
+    add_deploy_options(run)
+    add_onboarding_options(run)
+    run.add_argument("-incremental_onboarding","--incremental_onboarding",choices=["yes", "no"],default="no",help="onboard deployed hosts to PCD in batches while the rest of the fleet is still provisioning (yes or no, default: no)")
+    run.add_argument("-onboard_batch_size", "--onboard_batch_size", type=int, default=10, help="Hosts per incremental onboarding batch (default: 10)")
+    run.add_argument("-onboard_batch_window", "--onboard_batch_window", type=float, default=300, help="Seconds a deployed host waits for its batch to fill before onboarding starts anyway (default: 300)")
+    run.add_argument("-resume","--resume",choices=["yes", "no"],default="no",help="resume an interrupted run from its journal: existing machines are reused and completed stages skipped (yes or no, default: no)")
+    add_log_options(run)
+    run.set_defaults(handler=run_all)
+
+    provision = commands.add_parser("provision", help="create and commission the selected machines, up to Ready")
+    storage = commands.add_parser("storage", help="set up the storage layout of the selected Ready machines")
+    deploy = commands.add_parser("deploy", help="deploy the selected Ready machines and check they are reachable over SSH")
+    for stage in (provision, storage, deploy):
+        add_state_options(stage)
+        add_selector_options(stage)
+        add_maas_options(stage, required=False)
+        add_log_options(stage)
+        stage.set_defaults(handler=run_stage)
+    add_provision_options(provision)
+    add_storage_options(storage, stage=True)
+    add_deploy_options(deploy)
+
+    onboard = commands.add_parser("onboard", help="onboard the selected Deployed machines to PCD, without touching MAAS")
+    add_state_options(onboard)
+    add_selector_options(onboard)
+    onboard.add_argument("-ssh_user", "--ssh_user", required=True, help="SSH user for Ansible")
+    add_onboarding_options(onboard)
+    add_log_options(onboard)
+    onboard.set_defaults(handler=run_onboard)
+
+    status = commands.add_parser("status", help="show where the selected machines are, from the run's status file and journal")
+    add_state_options(status)
+    add_selector_options(status)
+    status.set_defaults(handler=show_status)
+    return parser
+
+
 ###############################################################################
-#                        Deploy MAAS machines from CSV                        #
+#                         Steps shared by the commands                        #
 ###############################################################################
-logger.info("Starting deployment of baremetal nodes...")
-maasHelper.add_machines_from_csv(
-    args.csv_filename,
-    args.maas_user,
-    args.max_workers,
-    args.cloud_init_template,
-    args.preserve_cloud_init,
-    args.ssh_user,
-    args.storage_layout,
-    args.storage_layout_template,
-    logger
-)
+def load_inventory(args, logger, require_cloud_init=False):
+    if not os.path.isfile(args.csv_filename):
+        logger.error(f"Error: The CSV file '{args.csv_filename}' does not exist.")
+        sys.exit(1)
+    if getattr(args, "cloud_init_template", None) and not os.path.isfile(args.cloud_init_template):
+        logger.error(f"Error: The cloud-init template file '{args.cloud_init_template}' does not exist.")
+        sys.exit(1)
+    try:
+        inventory = Inventory.load(args.csv_filename, require_cloud_init=require_cloud_init)
+    except InventoryError as e:
+        for line in str(e).splitlines():
+            logger.error(line)
+        sys.exit(1)
+    logger.info(f"Inventory: {len(inventory)} machines in {args.csv_filename}")
+    return inventory
+
+
+def select_nodes(args, inventory, logger):
+    """Give the rows of inventory their status from the run state and return the hostnames the selector picks."""
+    try:
+        state = RunState(args.csv_filename, args.journal)
+        state.apply(inventory)
+        selected = state.select(inventory, args.node, args.status, args.rack)
+    except (OSError, ValueError) as e:
+        logger.error(f"Error: {e}")
+        sys.exit(1)
+    if not selected:
+        logger.error("Error: no machine matches the selection")
+        sys.exit(1)
+    logger.info(f"Selected {len(selected)} of {len(inventory)} machines")
+    return selected
+
+
+def check_onboarding(args, logger):
+    if not os.path.isfile("vars_template.j2"):
+        logger.error(f"Error: The template file vars_template.j2 does not exist.")
+        sys.exit(1)
+    if not os.path.isdir("pcd_ansible-pcd_develop"):
+        logger.error(f"Directory pcd_ansible-pcd_develop does not exist.")
+        sys.exit(1)
+    if args.onprem == "yes" and not args.controller_ip:
+        logger.error(f"Error: controller IP is required")
+        sys.exit(1)
+
+
+def load_storage_layout(args, logger):
+    if args.storage_layout == "no":
+        return None
+    from modules import storageLayout
+    if not os.path.isfile(args.storage_layout_template):
+        logger.error(f"Error: The storage layout template file '{args.storage_layout_template}' does not exist.")
+        sys.exit(1)
+    try:
+        return storageLayout.LayoutSpec.load(args.storage_layout_template)
+    except ValueError as e:
+        logger.error(f"Error: {e}")
+        sys.exit(1)
+
+
+def check_bmcs(args, inventory, logger):
+    """Check every machine's BMC before creating any; returns the hostnames to leave out."""
+    from modules import bmcPreflight
+    preflight = bmcPreflight.BmcPreflight(logger, auth=args.bmc_preflight == "auth",
+                                          max_workers=args.bmc_preflight_workers, timeout=args.bmc_timeout)
+    try:
+        results = preflight.run(inventory)
+    except ValueError as e:
+        logger.error(f"Error: {e}")
+        sys.exit(1)
+    report = os.path.join("deploy_logs", "bmc_preflight.csv")
+    bmcPreflight.write_report(results, report)
+    # Big fleets: only the failures in the log, the full table is in the report.
+    bmcPreflight.log_table(results, logger, failed_only=len(results) > bmcPreflight.TABLE_ROWS)
+    logger.info(f"BMC preflight results written to {report}")
+    failed = [result.hostname for result in results if not result.ok]
+    if failed and args.bmc_exclude != "yes":
+        logger.error(f"{len(failed)} machines failed the BMC preflight; fix their power settings or rerun with "
+                     f"--bmc_exclude yes to provision the others")
+        sys.exit(1)
+    for hostname in failed:
+        inventory.by_hostname[hostname]["deployment_status"] = bmcPreflight.PREFLIGHT_STATUS
+    if failed:
+        logger.warning(f"Excluding {len(failed)} machines that failed the BMC preflight: {', '.join(failed)}")
+    return set(failed)
+
+
+def report_timing(args, spans, logger):
+    for line in spans.summary():
+        logger.info(f"Timing: {line}")
+    if args.metrics_file:
+        try:
+            spans.write_metrics(args.metrics_file)
+        except OSError as e:
+            logger.warning(f"Cannot write metrics file {args.metrics_file}: {e}")
+    spans.close()
+
+
+def provision_machines(args, parser, inventory, logger, journal, spans, stage=None, exclude=(), on_node_done=None,
+                       storage_layout_spec=None):
+    """Run the MAAS part of the workflow, or only stage of it, on the machines of inventory not in exclude."""
+    from modules import maasHelper, maasClient, sshProber, throttling, retry
+    from modules.adaptiveConcurrency import AdaptiveConcurrency
+    try:
+        throttle_limits = [throttling.parse_limit(spec) for spec in args.throttle]
+        retries = retry.Retries([retry.parse_policy(spec) for spec in args.retry], args.commission_retries)
+    except ValueError as e:
+        parser.error(str(e))
+    # Ansible (onboarding) reuses the SSH master connections the reachability probe opens.
+    os.environ.update(sshProber.ansible_environment())
+
+    client = maasClient.get_client(args.maas_user, args.maas_client, args.maas_url, args.maas_api_key, args.max_workers, logger)
+    if storage_layout_spec:
+        # Fail before any machine is touched if the layout cannot fit a boot disk MAAS already knows.
+        try:
+            maasHelper.check_layout_fits(client, inventory.without(exclude) if exclude else inventory, storage_layout_spec)
+        except ValueError as e:
+            logger.error(f"Error: {e}")
+            sys.exit(1)
+        except maasClient.MaasError as e:
+            logger.warning(f"Cannot list machines to check the storage layout fits, checking each in its storage stage: {e}")
+    throttle = throttling.Throttle.build(throttle_limits, client, logger)
+    adaptive = None
+    if args.adaptive == "yes":
+        adaptive = AdaptiveConcurrency(logger, args.adaptive_max or len(inventory), canary=args.adaptive_canary)
+        logger.info(f"Adaptive concurrency: canary wave of {adaptive.limit} machines, at most {adaptive.maximum} in flight")
+    if args.engine == "async":
+        from modules import asyncEngine as engine
+    else:
+        engine = maasHelper
+    engine.add_machines_from_csv(
+        inventory,
+        client,
+        args.max_workers,
+        getattr(args, "cloud_init_template", None),
+        getattr(args, "preserve_cloud_init", "no"),
+        getattr(args, "ssh_user", None),
+        getattr(args, "storage_layout", "no"),
+        storage_layout_spec,
+        logger,
+        poll_min_interval=args.poll_min_interval,
+        poll_max_interval=args.poll_max_interval,
+        stage_limits={"create": args.max_creates, "storage": args.max_storage, "deploy": args.max_deploys, "ssh": args.max_ssh_probes},
+        on_node_done=on_node_done,
+        journal=journal,
+        resume=getattr(args, "resume", "no") == "yes",
+        enlist=getattr(args, "enlist", "no") == "yes",
+        exclude=exclude,
+        adaptive=adaptive,
+        ssh_probe={"deadline": getattr(args, "ssh_probe_deadline", 600), "min_backoff": getattr(args, "ssh_probe_min_backoff", 2),
+                   "max_backoff": getattr(args, "ssh_probe_max_backoff", 30), "port": getattr(args, "ssh_port", 22)},
+        throttle=throttle,
+        spans=spans,
+        retries=retries,
+        stage=stage
+    )
+    client.close()
+    for line in throttle.summary():
+        logger.info(f"Throttle: {line}")
+
+
+def onboard_hosts(args, logger, spans, rows, journal):
+    """Onboard the Deployed hosts among rows and record the ones onboarded in journal."""
+    from modules import onboard
+    result = onboard.start_pcd_onboarding(
+        csv_filename=args.csv_filename,
+        ssh_user=args.ssh_user,
+        portal=args.portal,
+        region=args.region,
+        environment=args.environment,
+        url=args.url,
+        setup_env=args.setup_env,
+        onprem=args.onprem,
+        controller_ip=args.controller_ip,
+        logger=logger,
+        spans=spans,
+        shards=args.onboard_shards,
+        rows=rows,
+        force_steps=args.force_step
+    )
+    hostnames = {row.get("ip"): row["hostname"] for row in rows}
+    for ip in result.succeeded:
+        journal.record(hostnames.get(ip, ip), "onboarded", ip=ip)
+    return result
+
 
 ###############################################################################
-#                      Load CSV rows and filter deployed                      #
+#                                  Commands                                   #
 ###############################################################################
+def run_all(args, parser):
+    """run: provision, set up the storage layout of, deploy and onboard every machine of the CSV."""
+    from modules import onboard
+    from modules.journal import Journal, journal_path
+    from modules.timing import SpanRecorder
+    logger = setup_logger(node_log_dir="deploy_logs/nodes" if args.node_logs == "yes" else None)
+    inventory = load_inventory(args, logger, require_cloud_init=not args.cloud_init_template)
+    check_onboarding(args, logger)
+    storage_layout_spec = load_storage_layout(args, logger)
+    excluded = check_bmcs(args, inventory, logger) if args.bmc_preflight != "no" else set()
+
+    journal = Journal(args.journal or journal_path(args.csv_filename), resume=args.resume == "yes")
+    logger.info(f"Recording progress in {journal.path}")
+    spans = SpanRecorder(args.spans_file)
+
+    stream = None
+    if args.incremental_onboarding == "yes":
+        stream = onboard.OnboardingStream(
+            ssh_user=args.ssh_user,
+            portal=args.portal,
+            region=args.region,
+            environment=args.environment,
+            url=args.url,
+            setup_env=args.setup_env,
+            controller_ip=args.controller_ip,
+            onprem=args.onprem,
+            logger=logger,
+            batch_size=args.onboard_batch_size,
+            batch_window=args.onboard_batch_window,
+            journal=journal,
+            spans=spans,
+            shards=args.onboard_shards,
+            force_steps=args.force_step
+        ).start()
+
+    logger.info("Starting deployment of baremetal nodes...")
+    ok = False
+    try:
+        provision_machines(args, parser, inventory, logger, journal, spans, exclude=excluded,
+                           on_node_done=stream.add if stream else None, storage_layout_spec=storage_layout_spec)
+        if not stream:
+            ok = bool(onboard_hosts(args, logger, spans, inventory.rows, journal))
+    finally:
+        # Also when provisioning fails: the stream onboards what it was given and stops.
+        if stream:
+            ok = stream.close()
+        journal.close()
+        report_timing(args, spans, logger)
+    return 0 if ok else 1
+
+
+def run_stage(args, parser):
+    """provision, storage or deploy: one stage, on the selected machines MAAS has at that stage."""
+    from modules.journal import Journal, journal_path
+    from modules.timing import SpanRecorder
+    logger = setup_logger(node_log_dir="deploy_logs/nodes" if args.node_logs == "yes" else None)
+    inventory = load_inventory(args, logger, require_cloud_init=args.command == "deploy" and not args.cloud_init_template)
+    storage_layout_spec = load_storage_layout(args, logger) if args.command == "storage" else None
+    selected = select_nodes(args, inventory, logger)
+    excluded = {row["hostname"] for row in inventory} - set(selected)
+    if args.command == "provision" and args.bmc_preflight != "no":
+        excluded |= check_bmcs(args, inventory.without(excluded), logger)
+
+    journal = Journal(args.journal or journal_path(args.csv_filename), resume=True)
+    logger.info(f"Recording progress in {journal.path}")
+    spans = SpanRecorder(args.spans_file)
+    before = {hostname: inventory.by_hostname[hostname].get("deployment_status") for hostname in selected}
+    try:
+        provision_machines(args, parser, inventory, logger, journal, spans, stage=args.command, exclude=excluded,
+                           storage_layout_spec=storage_layout_spec)
+    finally:
+        journal.close()
+        report_timing(args, spans, logger)
+
+    target = STAGE_TARGETS[args.command]
+    failed = [hostname for hostname in selected
+              if inventory.by_hostname[hostname].get("deployment_status") not in (before[hostname], target)]
+    if failed:
+        logger.error(f"{len(failed)} machines did not reach {target}: {', '.join(failed)}")
+    return 1 if failed else 0
+
+
+def run_onboard(args, parser):
+    """onboard: onboard the selected machines that are Deployed."""
+    from modules import sshProber
+    from modules.journal import Journal, journal_path
+    from modules.timing import SpanRecorder
+    logger = setup_logger(node_log_dir="deploy_logs/nodes" if args.node_logs == "yes" else None)
+    inventory = load_inventory(args, logger)
+    check_onboarding(args, logger)
+    selected = select_nodes(args, inventory, logger)
+    # Ansible reuses the SSH master connections the deploy stage's reachability probe left open.
+    os.environ.update(sshProber.ansible_environment())
+
+    journal = Journal(args.journal or journal_path(args.csv_filename), resume=True)
+    spans = SpanRecorder(args.spans_file)
+    try:
+        result = onboard_hosts(args, logger, spans, [inventory.by_hostname[hostname] for hostname in selected], journal)
+    finally:
+        journal.close()
+        report_timing(args, spans, logger)
+    return 0 if result else 1
+
+
+def show_status(args, parser):
+    """status: print where every selected machine is. Reads the run's files only, and logs nothing."""
+    if not os.path.isfile(args.csv_filename):
+        print(f"Error: The CSV file '{args.csv_filename}' does not exist.", file=sys.stderr)
+        return 1
+    try:
+        inventory = Inventory.load(args.csv_filename)
+        state = RunState(args.csv_filename, args.journal)
+        selected = state.select(inventory, args.node, args.status, args.rack)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    header = ["hostname", "ip", "system_id", "event", "status", "onboarded"]
+    racks = "rack" in inventory.fieldnames
+    if racks:
+        header.insert(2, "rack")
+    lines, counts = [], {}
+    for hostname in selected:
+        row = inventory.by_hostname[hostname]
+        status = state.status_of(hostname)
+        counts[status] = counts.get(status, 0) + 1
+        line = [hostname, row.get("ip") or "", state.system_id(hostname) or "-", state.last_event(hostname) or "-",
+                status, "yes" if state.onboarded(hostname) else "no"]
+        if racks:
+            line.insert(2, row.get("rack") or "-")
+        lines.append(line)
+    widths = [max(len(str(line[i])) for line in [header] + lines) for i in range(len(header))]
+    for line in [header] + lines:
+        print("  ".join(str(value).ljust(width) for value, width in zip(line, widths)).rstrip())
+    print(f"{len(selected)} of {len(inventory)} machines: "
+          + ", ".join(f"{status} {count}" for status, count in sorted(counts.items())))
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Command lines from before the commands (and multiRun's) start with an option: they mean run.
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help"):
+        argv = [DEFAULT_COMMAND] + argv
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    return args.handler(args, parser)
 
-onboard.start_pcd_onboarding(
-    csv_filename=args.csv_filename,
-    ssh_user=args.ssh_user,
-    portal=args.portal,
-    region=args.region,
-    environment=args.environment,
-    url=args.url,
-    setup_env=args.setup_env,
-    onprem=args.onprem,
-    controller_ip=args.controller_ip,
-    logger=logger
-)
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import time
+import asyncio
+import threading
+from collections import Counter, deque
+from modules.maasClient import MaasError
+from modules.timing import percentile
+
+# Progress events (see Pipeline.record) that mean a stage of a machine succeeded.
+STAGE_EVENTS = {"created": "create", "commissioned": "commission", "storage": "storage", "deployed": "deploy",
+                "ssh": "ssh"}
+# Final statuses that mean a stage failed. Others (a missing cloud-init
+# template, a machine not resumable) say nothing about the load on MAAS.
+FAILED_STAGES = {"System ID Missing Machine Was Not Created": "create",
+                 "Not Ready,Commissioning Was Not Done": "commission", "Deploy Failed": "deploy",
+                 "Deployment Failed": "deploy", "Deployment Timeout": "deploy", "Deployed-Unreachable": "ssh"}
+# MAAS call latency is healthy up to this many times the canary wave's p90,
+# and always up to LATENCY_SLACK seconds above it.
+LATENCY_RATIO = 2.0
+LATENCY_SLACK = 0.25
+# Share of MAAS calls that may fail with a transient error (503, timeout) in a healthy window.
+MAX_CALL_ERRORS = 0.05
+
+
+def failed_stage(status):
+    if status and status.startswith("Error During "):
+        return status[len("Error During "):].lower()
+    return FAILED_STAGES.get(status)
+
+
+class AdaptiveConcurrency:
+    """How many machines are in flight at once, adjusted to how MAAS copes (AIMD).
+
+    The run starts with a canary wave of canary machines and admits no more
+    until the whole wave is done. From then on the outcome of every stage of
+    every machine (created, commissioned, deployed, ... or failed there) and
+    the latency of every MAAS call are collected in windows of as many stage
+    outcomes as machines are allowed in flight. A window where every stage
+    succeeded at least min_success of the time, the MAAS call p90 latency
+    stayed near the canary's and few calls failed raises the limit by step
+    (additive increase, up to maximum); any other window multiplies it by
+    backoff (multiplicative decrease, down to minimum). A Failed commissioning
+    that is retried counts as a failed commission. Every change is logged.
+    """
+
+    def __init__(self, logger, maximum, canary=5, minimum=1, step=1, backoff=0.5, min_success=0.9):
+        self.logger = logger
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = max(self.minimum, min(canary, self.maximum))
+        self.canary = self.limit
+        self.step = max(1, step)
+        self.backoff = backoff
+        self.min_success = min_success
+        self.in_flight = 0
+        self.finished = 0
+        self.canary_done = False
+        self.baseline = None
+        self.adjustments = []
+        self._outcomes = {}
+        self._latencies = []
+        self._call_errors = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def try_acquire(self):
+        """Take an in-flight slot for a machine if the limit allows it."""
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    async def acquire_async(self):
+        """Wait (in the asyncio engine) until a machine may start."""
+        while not self.try_acquire():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def release(self, node):
+        """node is done: free its slot and count its outcome."""
+        stage = failed_stage(node.status)
+        with self._lock:
+            self.in_flight -= 1
+            self.finished += 1
+            if stage:
+                self._observe(stage, False)
+            if not self.canary_done and self.finished >= self.canary:
+                self.canary_done = True
+                self._adjust("canary wave")
+        self._wake()
+
+    def record(self, event):
+        """A progress event of a machine (Pipeline.record)."""
+        stage = STAGE_EVENTS.get(event)
+        if stage:
+            with self._lock:
+                self._observe(stage, True)
+                self._maybe_adjust()
+            self._wake()
+
+    def commission_failed(self):
+        """A machine ended in Failed commissioning and is commissioned again."""
+        with self._lock:
+            self._observe("commission", False)
+            self._maybe_adjust()
+
+    def observe_call(self, seconds, error=False):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._call_errors += error
+
+    def _observe(self, stage, ok):
+        counts = self._outcomes.setdefault(stage, Counter())
+        counts["ok" if ok else "failed"] += 1
+
+    def _maybe_adjust(self):
+        if self.canary_done and sum(sum(c.values()) for c in self._outcomes.values()) >= self.limit:
+            self._adjust("window")
+
+    def _adjust(self, label):
+        rates = {stage: counts["ok"] / sum(counts.values()) for stage, counts in self._outcomes.items()}
+        latencies = sorted(self._latencies)
+        p90 = percentile(latencies, 0.9) if latencies else None
+        errors = self._call_errors / len(latencies) if latencies else 0
+        problems = [f"{stage} {rate:.0%}" for stage, rate in rates.items() if rate < self.min_success]
+        if p90 is not None and self.baseline is not None \
+                and p90 > max(self.baseline * LATENCY_RATIO, self.baseline + LATENCY_SLACK):
+            problems.append(f"MAAS p90 {p90:.3f}s vs {self.baseline:.3f}s")
+        if errors > MAX_CALL_ERRORS:
+            problems.append(f"{errors:.0%} MAAS calls failed")
+        if self.baseline is None and p90 is not None:
+            self.baseline = p90
+        previous = self.limit
+        if problems:
+            self.limit = max(self.minimum, int(self.limit * self.backoff))
+        else:
+            self.limit = min(self.maximum, self.limit + self.step)
+        summary = ", ".join(f"{stage} {rate:.0%}" for stage, rate in rates.items()) or "no stage outcomes"
+        latency = f"MAAS p90 {p90:.3f}s" if p90 is not None else "no MAAS calls"
+        if self.limit != previous:
+            self.adjustments.append((time.time(), previous, self.limit))
+            reason = "unhealthy: " + "; ".join(problems) if problems else "healthy"
+            self.logger.info(f"Adaptive concurrency {previous} -> {self.limit} machines in flight after {label} "
+                             f"({reason}; success {summary}; {latency}, {self._call_errors} failed calls)")
+        self._outcomes = {}
+        self._latencies = []
+        self._call_errors = 0
+
+    def _wake(self):
+        """Let as many waiting asyncio machines start as there are free slots (only called on the loop)."""
+        free = self.limit - self.in_flight
+        while self._waiters and free > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class ObservedClient:
+    """A MAAS client whose calls report their latency (and transient failures) to an AdaptiveConcurrency."""
+
+    def __init__(self, client, controller):
+        self._client = client
+        self._controller = controller
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def call(self, resource, action, *ids, **params):
+        started = time.monotonic()
+        try:
+            result = self._client.call(resource, action, *ids, **params)
+        except MaasError as e:
+            self._controller.observe_call(time.monotonic() - started, bool(e.transient))
+            raise
+        self._controller.observe_call(time.monotonic() - started)
+        return result
+
+
+class ObservedAsyncClient(ObservedClient):
+    async def call(self, resource, action, *ids, **params):
+        started = time.monotonic()
+        try:
+            result = await self._client.call(resource, action, *ids, **params)
+        except MaasError as e:
+            self._controller.observe_call(time.monotonic() - started, bool(e.transient))
+            raise
+        self._controller.observe_call(time.monotonic() - started)
+        return result
@@ -0,0 +1,481 @@
+import ssl
+import time
+import asyncio
+from modules import maasHelper, storageLayout
+from modules.maasClient import (MaasError, parse_api_url, parse_api_key, oauth_header,
+                                prepare_request, cli_command, parse_cli_result, parse_http_result, CLI_TIMEOUT)
+from modules.fleetPoller import FleetPoller
+from modules.sshProber import SshProber
+from modules.throttling import Throttle
+from modules.timing import SpanRecorder
+from modules.retry import Retries
+from modules.pipeline import Node, STAGES
+from modules.inventory import Inventory
+from modules.statusWriter import StatusWriter
+from modules.runState import RunState
+from modules.logPipeline import node_context
+from modules.adaptiveConcurrency import ObservedClient, ObservedAsyncClient
+
+
+class AsyncMaasApiClient:
+    """asyncio counterpart of MaasApiClient: same OAuth signing, keep-alive sockets via asyncio streams."""
+
+    mode = "api"
+
+    def __init__(self, url, api_key, pool_size=10, timeout=60):
+        self.scheme, self.netloc, self.base_path = parse_api_url(url)
+        self.credentials = parse_api_key(api_key)
+        host, _, port = self.netloc.partition(":")
+        self.host = host
+        self.port = int(port) if port else (443 if self.scheme == "https" else 80)
+        self.timeout = timeout
+        self._idle = []
+        self._slots = asyncio.Semaphore(max(1, pool_size))
+        self.requests = 0
+        self.connections_opened = 0
+
+    async def _open(self, method, path):
+        """A new connection to MAAS; a refused or timed out connect is a transient MaasError."""
+        self.connections_opened += 1
+        context = ssl.create_default_context() if self.scheme == "https" else None
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise MaasError(f"{method} {path} failed: cannot connect to {self.netloc}: {e!r}", transient=True)
+
+    async def _roundtrip(self, reader, writer, method, path, body, headers):
+        payload = (body or "").encode()
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.netloc}", f"Content-Length: {len(payload)}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + payload)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by MAAS")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+
+        keep_alive = response_headers.get("connection", "").lower() != "close"
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                data += await reader.readexactly(size)
+                await reader.readline()
+        elif "content-length" in response_headers:
+            data = await reader.readexactly(int(response_headers["content-length"]))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return status, response_headers.get("content-type", ""), data, keep_alive
+
+    async def call(self, resource, action, *ids, **params):
+        method, path, body, content_type = prepare_request(self.base_path, resource, action, ids, params)
+        headers = {"Authorization": oauth_header(*self.credentials), "Accept": "application/json"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        self.requests += 1
+        async with self._slots:
+            reused = bool(self._idle)
+            reader, writer = self._idle.pop() if reused else await self._open(method, path)
+            while True:
+                try:
+                    status, ctype, data, keep_alive = await asyncio.wait_for(
+                        self._roundtrip(reader, writer, method, path, body, headers), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused:
+                        # The server dropped an idle keep-alive socket; retry once on a fresh one.
+                        reused = False
+                        reader, writer = await self._open(method, path)
+                        continue
+                    raise MaasError(f"{method} {path} failed: {e}", transient=True)
+                except (OSError, asyncio.TimeoutError, ValueError, IndexError) as e:
+                    writer.close()
+                    raise MaasError(f"{method} {path} failed: {e!r}", transient=True)
+                break
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+        return parse_http_result(method, path, status, ctype, data)
+
+    async def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+class AsyncMaasCliClient:
+    """Fallback that runs the maas CLI as an asyncio subprocess instead of blocking a thread."""
+
+    mode = "cli"
+
+    def __init__(self, maas_user, timeout=CLI_TIMEOUT):
+        self.maas_user = maas_user
+        self.timeout = timeout
+        self.requests = 0
+
+    async def call(self, resource, action, *ids, **params):
+        command = cli_command(self.maas_user, resource, action, ids, params)
+        self.requests += 1
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            raise MaasError(f"{' '.join(command[:5])} timed out after {self.timeout}s", transient=True)
+        return parse_cli_result(command, process.returncode, stdout.decode(), stderr.decode())
+
+    async def close(self):
+        pass
+
+
+def async_client_for(client, pool_size=10):
+    """Build the asyncio client matching an already configured sync client."""
+    if client.mode == "cli":
+        return AsyncMaasCliClient(client.maas_user, client.timeout)
+    return AsyncMaasApiClient(client.url, client.api_key, pool_size=pool_size, timeout=client.timeout)
+
+
+class AsyncFleetPoller(FleetPoller):
+    """FleetPoller driven by the event loop: bulk reads are awaited and waits are futures."""
+
+    def __init__(self, client, logger, min_interval=5, max_interval=60):
+        super().__init__(client, logger, min_interval, max_interval)
+        self._async_wakeup = asyncio.Event()
+
+    def _notify(self):
+        self._async_wakeup.set()
+
+    async def poll_once_async(self):
+        system_ids = self._watched_ids()
+        current = None
+        if system_ids:
+            try:
+                current = self.statuses_from(await self.client.call("machines", "read", **self.status_query(system_ids)))
+                self.ticks += 1
+            except MaasError as e:
+                self.logger.warning(f"Fleet status poll failed, keeping previous states: {e}")
+            except Exception as e:
+                # Every wait_for_async depends on this loop; an unexpected error must not end it.
+                self.logger.error(f"Fleet status poll failed unexpectedly, keeping previous states: {e!r}")
+        return self.apply(system_ids, current)
+
+    async def run(self):
+        while not self._stopped.is_set():
+            changed = await self.poll_once_async()
+            try:
+                await asyncio.wait_for(self._async_wakeup.wait(), self.next_interval(changed))
+            except asyncio.TimeoutError:
+                pass
+            self._async_wakeup.clear()
+
+    def stop(self):
+        self._stopped.set()
+        self._async_wakeup.set()
+
+    async def wait_for_async(self, system_id, expected_status, hostname, timeout=600):
+        future = asyncio.get_running_loop().create_future()
+        self.watch(system_id, expected_status, hostname, timeout,
+                   lambda ok, status: future.done() or future.set_result((ok, status)))
+        return await future
+
+
+class AsyncProvisioningFlow:
+    """One coroutine per machine; per-stage semaphores bound how many are in each stage at once.
+
+    until is where a machine stops, as in maasHelper.ProvisioningFlow.
+    """
+
+    def __init__(self, client, sync_client, poller, stage_limits, cloud_init_template, preserve_cloud_init,
+                 prober, storage_layout, storage_layout_template, logger, on_node_done=None, journal=None,
+                 throttle=None, spans=None, retries=None, inventory=None, status=None, adaptive=None, until=None):
+        self.client = client
+        self.sync_client = sync_client
+        self.poller = poller
+        self.limits = {stage: asyncio.Semaphore(max(1, limit)) for stage, limit in stage_limits.items()}
+        self.cloud_init_template = cloud_init_template
+        self.preserve_cloud_init = preserve_cloud_init
+        self.prober = prober
+        self.throttle = throttle or Throttle()
+        self.spans = spans or SpanRecorder()
+        self.retries = retries or Retries()
+        self.storage_layout = storage_layout
+        self.storage_layout_template = storage_layout_template
+        self.logger = logger
+        self.on_node_done = on_node_done
+        self.journal = journal
+        self.inventory = inventory
+        self.status = status
+        self.adaptive = adaptive
+        self.until = until
+
+    def record(self, node, event, **fields):
+        if self.journal:
+            self.journal.record(node.hostname, event, system_id=node.system_id, **fields)
+        if self.status:
+            self.status.update(node.hostname, event, system_id=node.system_id, **fields)
+        if self.adaptive:
+            self.adaptive.record(event)
+
+    def finish(self, node, status=None):
+        if status is not None:
+            node.row["deployment_status"] = status
+        node.finished = time.monotonic()
+        self.record(node, "finished", status=node.status)
+        if self.on_node_done:
+            try:
+                self.on_node_done(node)
+            except Exception as e:
+                self.logger.error(f"[{node.hostname}] Node completion hook failed: {e}")
+        if self.adaptive:
+            self.adaptive.release(node)
+
+    async def provision(self, row, resume_at="create", system_id=None, record=None):
+        if self.adaptive:
+            await self.adaptive.acquire_async()
+        node = Node(row)
+        node.system_id = system_id
+        node.onboarded = bool(record and record.done("onboarded"))
+        if resume_at != "create":
+            self.logger.info(f"[{node.hostname}] Resuming at {resume_at} (system_id {system_id}).")
+        if resume_at == "done":
+            self.finish(node, "Deployed")
+            return node
+        if resume_at not in maasHelper.RESUME_POINTS:
+            self.finish(node, f"Not Resumed, MAAS Status {resume_at}")
+            return node
+        try:
+            # Each node runs in its own task, so the context holds for all of its stages.
+            with node_context(node):
+                status = await self._provision(node, maasHelper.RESUME_POINTS.index(resume_at))
+        except Exception as e:
+            self.logger.error(f"[{node.hostname}] Unexpected error in {node.stage} stage: {e}")
+            status = f"Error During {(node.stage or 'create').capitalize()}"
+        self.finish(node, status)
+        return node
+
+    async def _provision(self, node, start=0):
+        """Run the node from RESUME_POINTS[start] onwards (0 is a fresh create)."""
+        hostname, row = node.hostname, node.row
+        steps = maasHelper.RESUME_POINTS
+        if start == 0:
+            async with self.limits["create"], self.throttle.slot_async("create", row):
+                node.stage = "create"
+                with self.spans.span(hostname, "create") as span:
+                    try:
+                        response = await self.retries["create"].call_async(
+                            lambda: self.client.call("machines", "create", **maasHelper.machine_create_params(row)),
+                            hostname, self.logger, span, lambda error: self._already_created(row, error))
+                        node.system_id = response.get("system_id")
+                        self.logger.info(f"[{hostname}] Machine created.")
+                    except MaasError as e:
+                        self.logger.error(f"[{hostname}] Error creating machine: {e}")
+                        span.outcome = "failed"
+            if not node.system_id:
+                self.logger.warning(f"[{hostname}] Skipping: no system_id.")
+                return "System ID Missing Machine Was Not Created"
+            if self.inventory:
+                self.inventory.bind(hostname, node.system_id)
+            self.record(node, "created")
+        elif start == steps.index("commission"):
+            if not await self._commission(node):
+                return "Not Ready,Commissioning Was Not Done"
+
+        if start <= steps.index("wait_ready"):
+            while True:
+                ok, status = await self.timed_wait(node, "commissioning", "Ready", 700)
+                if ok:
+                    break
+                if status == "Failed commissioning" and node.commission_retries < self.retries.commission_retries:
+                    node.commission_retries += 1
+                    if self.adaptive:
+                        self.adaptive.commission_failed()
+                    self.logger.warning(f"[{hostname}] Failed commissioning, commissioning again "
+                                        f"(retry {node.commission_retries} of {self.retries.commission_retries}).")
+                    if await self._commission(node):
+                        continue
+                else:
+                    self.logger.warning(f"[{hostname}] Not Ready. Skipping deployment.")
+                return "Not Ready,Commissioning Was Not Done"
+            self.record(node, "commissioned")
+            if self.until == "wait_ready":
+                return "Ready"
+
+        if self.storage_layout != "no" and start <= steps.index("storage"):
+            async with self.limits["storage"], self.throttle.slot_async("storage", row):
+                node.stage = "storage"
+                # The storage layout code is synchronous; it runs on a worker thread
+                # but only as many at once as the storage stage allows.
+                with self.spans.span(hostname, "storage") as span:
+                    ok = await asyncio.to_thread(storageLayout.create_storage_layout, self.sync_client,
+                                                 node.system_id, hostname, self.storage_layout_template,
+                                                 self.logger, self.storage_layout == "plan",
+                                                 self.retries["storage"], span)
+                    if not ok:
+                        span.outcome = "failed"
+            if self.storage_layout == "yes":
+                self.record(node, "storage" if ok else "storage_failed")
+            if self.until == "storage":
+                return "Ready"
+
+        if start <= steps.index("deploy"):
+            status = await self._deploy(node)
+            if status:
+                return status
+
+        if start <= steps.index("wait_deployed"):
+            ok, status = await self.timed_wait(node, "deploying", "Deployed", 1200)
+            if not ok:
+                self.logger.warning(f"[{hostname}] Did not reach Deployed state.")
+                return "Deployment Failed" if status == "Failed deployment" else "Deployment Timeout"
+            self.logger.info(f"[{hostname}] Deployment completed.")
+            self.record(node, "deployed")
+
+        async with self.limits["ssh"], self.throttle.slot_async("power-update", row):
+            node.stage = "ssh"
+            with self.spans.span(hostname, "power-update") as span:
+                try:
+                    await self.retries["power-update"].call_async(
+                        lambda: self.client.call("machine", "update", node.system_id,
+                                                 power_parameters=maasHelper.ipmi_user_params(row)),
+                        hostname, self.logger, span)
+                except MaasError as e:
+                    self.logger.warning(f"[{hostname}] Failed to update IPMI user: {e}")
+            self.logger.info(f"[{hostname}] checking connectivity.")
+        status = await self.check_ssh(node)
+        if status == "Deployed":
+            self.record(node, "ssh")
+        return status
+
+    async def _already_created(self, row, error):
+        """Recovery check for a retried create: the timed-out attempt may have created the machine."""
+        if "already exists" not in str(error):
+            return None
+        try:
+            return maasHelper.created_machine(await self.client.call("machines", "read", hostname=row["hostname"]), row)
+        except MaasError:
+            return None
+
+    async def _commission(self, node):
+        """Start commissioning again; returns False if it could not be started."""
+        hostname = node.hostname
+        async with self.limits["create"], self.throttle.slot_async("create", node.row):
+            node.stage = "create"
+            with self.spans.span(hostname, "commission") as span:
+                try:
+                    await self.retries["commission"].call_async(
+                        lambda: self.client.call("machine", "commission", node.system_id),
+                        hostname, self.logger, span, maasHelper.already_in_progress)
+                    self.logger.info(f"[{hostname}] Commissioning started.")
+                    return True
+                except MaasError as e:
+                    self.logger.error(f"[{hostname}] Commissioning failed to start: {e}")
+                    span.outcome = "failed"
+                    return False
+
+    async def _deploy(self, node):
+        """Trigger the deploy; returns the final status on failure, None once it is under way."""
+        hostname = node.hostname
+        async with self.limits["deploy"], self.throttle.slot_async("deploy", node.row):
+            node.stage = "deploy"
+            user_data = maasHelper.prepare_user_data(node, self.cloud_init_template, self.preserve_cloud_init,
+                                                     self.logger)
+            if not user_data:
+                return "Cloud-init Template Missing"
+            with self.spans.span(hostname, "deploy") as span:
+                try:
+                    await self.retries["deploy"].call_async(
+                        lambda: self.client.call("machine", "deploy", node.system_id, user_data=user_data),
+                        hostname, self.logger, span, maasHelper.already_in_progress)
+                    self.logger.info(f"[{hostname}] Deploy triggered with cloud-init.")
+                except MaasError as e:
+                    self.logger.error(f"[{hostname}] Deploy failed: {e}")
+                    span.outcome = "failed"
+                    return "Deploy Failed"
+        self.record(node, "deploy_started")
+        return None
+
+    async def timed_wait(self, node, stage, expected_status, timeout):
+        """Wait for expected_status on the fleet poller, recording the wait as a span of node; returns (ok, status)."""
+        span = self.spans.start(node.hostname, stage)
+        ok, status = await self.poller.wait_for_async(node.system_id, expected_status, node.hostname, timeout)
+        self.spans.end(span, "ok" if ok else status)
+        return ok, status
+
+    async def check_ssh(self, node):
+        """Wait on the shared SSH prober; the ssh stage limit bounds its login checks, not the wait."""
+        loop = asyncio.get_running_loop()
+        reachable = loop.create_future()
+        span = self.spans.start(node.hostname, "ssh")
+        self.prober.probe(node.row.get("ip"), node.hostname,
+                          lambda ok: loop.call_soon_threadsafe(reachable.set_result, ok))
+        ok = await reachable
+        self.spans.end(span, "ok" if ok else "unreachable")
+        return "Deployed" if ok else "Deployed-Unreachable"
+
+
+async def _run(inventory, client, limits, cloud_init_template, preserve_cloud_init, ssh_user, storage_layout,
+               storage_layout_template, logger, poll_min_interval, poll_max_interval, on_node_done, journal,
+               resume_points, ssh_probe, throttle, spans, retries, status, adaptive=None, until=None):
+    async_client = async_client_for(client, pool_size=max(limits.values()))
+    if adaptive:
+        async_client = ObservedAsyncClient(async_client, adaptive)
+    poller = AsyncFleetPoller(async_client, logger, poll_min_interval, poll_max_interval)
+    poller_task = asyncio.create_task(poller.run())
+    prober = SshProber(ssh_user, logger, max_checks=limits["ssh"], **(ssh_probe or {})).start()
+    flow = AsyncProvisioningFlow(async_client, client, poller, limits, cloud_init_template, preserve_cloud_init,
+                                 prober, storage_layout, storage_layout_template, logger, on_node_done, journal,
+                                 throttle, spans, retries, inventory, status, adaptive, until)
+    try:
+        await asyncio.gather(*(flow.provision(row, *resume_points.get(row["hostname"], ("create", None, None)))
+                               for row in inventory))
+    finally:
+        poller.stop()
+        await poller_task
+        await asyncio.to_thread(prober.stop)
+        await async_client.close()
+        logger.info(f"Fleet poller made {poller.ticks} bulk status calls")
+
+
+def add_machines_from_csv(csv_file,client,max_workers,cloud_init_template,preserve_cloud_init,ssh_user,storage_layout,storage_layout_template, logger, poll_min_interval=5, poll_max_interval=60, stage_limits=None, on_node_done=None, journal=None, resume=False, ssh_probe=None, throttle=None, spans=None, retries=None, enlist=False, exclude=(), adaptive=None, stage=None):
+    """Drop-in asyncio replacement for maasHelper.add_machines_from_csv (--engine async)."""
+    inventory = Inventory.load(csv_file, require_cloud_init=not cloud_init_template)
+    provisioned = inventory.without(exclude) if exclude else inventory
+    if adaptive:
+        client = ObservedClient(client, adaptive)
+
+    limits = {stage: max_workers for stage in STAGES}
+    limits.update({stage: limit for stage, limit in (stage_limits or {}).items() if limit})
+    logger.info("Async engine stage concurrency limits: " + ", ".join(f"{stage}={limit}" for stage, limit in limits.items()))
+
+    if storage_layout != "no":
+        storage_layout_template = storageLayout.LayoutSpec.load(storage_layout_template)
+    if enlist:
+        resume_points = maasHelper.plan_enlistment(client, provisioned, journal if resume else None, storage_layout,
+                                                   logger, limits["create"], throttle, retries)
+    else:
+        resume_points = maasHelper.plan_resume(client, provisioned, journal, storage_layout, logger,
+                                               redo=(stage,) if stage else ()) if resume or stage else {}
+    if stage:
+        resume_points, left = maasHelper.stage_plan(resume_points, stage, logger)
+        provisioned = provisioned.without(left)
+    status = StatusWriter(inventory, logger, previous=RunState(inventory.path, journal.path if journal else None).previous()).start()
+    try:
+        asyncio.run(_run(provisioned, client, limits, cloud_init_template, preserve_cloud_init, ssh_user, storage_layout,
+                         storage_layout_template, logger, poll_min_interval, poll_max_interval, on_node_done, journal,
+                         resume_points, ssh_probe, throttle, spans, retries, status, adaptive,
+                         maasHelper.STAGE_WINDOWS[stage][1] if stage else None))
+    finally:
+        status.stop()
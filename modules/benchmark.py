@@ -0,0 +1,355 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import socket
+import tarfile
+import argparse
+import resource
+import selectors
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from urllib.request import urlopen
+
+from modules import maasHelper, maasClient, onboard
+from modules.journal import Journal, journal_path
+from modules.maasStub import STUB_API_KEY
+from modules.timing import SpanRecorder, ONBOARD_PREFIX
+from modules.statusWriter import updated_csv_path
+from modules.inventory import Inventory
+from modules.logPipeline import setup_logger
+from modules.adaptiveConcurrency import AdaptiveConcurrency
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREREQUISITES = os.path.join(REPO_DIR, "prerequisites.tar.gz")
+# Files the workflow reads from its working directory, taken from the prerequisites bundle.
+TEMPLATES = ("cloud-init_template.yaml", "lv_config_template.json", "vars_template.j2")
+INVENTORY = "bench_machines.csv"
+# The first --enlisted rows of the inventory, which the stub starts with as New machines.
+ENLISTED = "bench_enlisted.csv"
+FIELDS = ["hostname", "architecture", "mac_addresses", "power_type", "power_user", "power_pass", "power_driver",
+          "power_address", "cipher_suite_id", "power_boot_type", "privilege_level", "k_g", "ip", "cloud_init"]
+
+
+class FakeSshd:
+    """Stands in for the sshd of every deployed machine: accepts and closes TCP connections on one port.
+
+    It listens on all addresses, so every 127.x.y.z address of the generated
+    inventory reaches it; the login itself is answered by the fake ssh client.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("0.0.0.0", 0))
+        self.sock.listen(1024)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.accepted = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="fake-sshd", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            while not self._stopped.is_set():
+                for _ in selector.select(0.2):
+                    try:
+                        while True:
+                            conn, _ = self.sock.accept()
+                            conn.close()
+                            self.accepted += 1
+                    except BlockingIOError:
+                        pass
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.sock.close()
+
+
+def open_fds():
+    """Open file descriptors of this process (0 where /proc is not available)."""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+
+class PeakSampler:
+    """Samples the number of live threads and open file descriptors in the background and keeps the peaks."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.peak_fds = open_fds()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            # The sampler thread itself does not count.
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+            self.peak_fds = max(self.peak_fds, open_fds())
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_executable(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def prepare_workspace(workdir, nodes, stub_url, pcd_seconds, enlisted=0):
+    """Lay out a working directory the workflow can run in without MAAS, PCD or real machines.
+
+    bin/ holds fake `maas` (the stub behind the CLI interface), `ssh` (always
+    logs in) and pcd_ansible-pcd_develop/ a fake `pcdExpress` (sleeps
+    pcd_seconds); each appends its name to forks.log when it runs.
+    """
+    with tarfile.open(PREREQUISITES) as bundle:
+        for name in TEMPLATES:
+            with bundle.extractfile(name) as src, open(os.path.join(workdir, name), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+    bin_dir = os.path.join(workdir, "bin")
+    pcd_dir = os.path.join(workdir, "pcd_ansible-pcd_develop")
+    os.makedirs(bin_dir, exist_ok=True)
+    os.makedirs(os.path.join(pcd_dir, os.path.dirname(onboard.HOST_TEMPLATE)), exist_ok=True)
+    write_executable(os.path.join(bin_dir, "maas"), "\n".join([
+        f"#!{sys.executable}",
+        "import os, sys",
+        f"sys.path.insert(0, {REPO_DIR!r})",
+        "with open(os.environ['BENCH_FORKS'], 'a') as f:",
+        "    f.write('maas\\n')",
+        "from modules.maasStub import fake_cli",
+        f"sys.exit(fake_cli(sys.argv[1:], {stub_url!r}))",
+        ""]))
+    write_executable(os.path.join(bin_dir, "ssh"), '#!/bin/sh\necho ssh >> "$BENCH_FORKS"\necho SSH_OK\n')
+    write_executable(os.path.join(pcd_dir, "pcdExpress"),
+                     f'#!/bin/sh\necho pcdExpress >> "$BENCH_FORKS"\nsleep {pcd_seconds}\n')
+
+    with open(os.path.join(workdir, INVENTORY), "w", newline="") as f, \
+            open(os.path.join(workdir, ENLISTED), "w", newline="") as e:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        enlisted_writer = csv.DictWriter(e, fieldnames=FIELDS)
+        writer.writeheader()
+        enlisted_writer.writeheader()
+        for i in range(nodes):
+            row = {
+                "hostname": f"bench-{i:05d}", "architecture": "amd64/generic",
+                "mac_addresses": "52:54:00:{:02x}:{:02x}:{:02x}".format(i >> 16 & 255, i >> 8 & 255, i & 255),
+                "power_type": "ipmi", "power_user": "admin", "power_pass": "admin", "power_driver": "LAN_2_0",
+                "power_address": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", "cipher_suite_id": "3",
+                "power_boot_type": "auto", "privilege_level": "ADMIN", "k_g": "",
+                "ip": f"127.1.{i // 250}.{i % 250 + 1}", "cloud_init": "cloud-init_template.yaml",
+            }
+            writer.writerow(row)
+            if i < enlisted:
+                enlisted_writer.writerow(row)
+
+
+def start_stub(port, args):
+    command = [sys.executable, "-m", "modules.maasStub", "--port", str(port),
+               "--commission_seconds", str(args.commission_seconds), "--deploy_seconds", str(args.deploy_seconds),
+               "--jitter", str(args.jitter), "--commission_failure_rate", str(args.commission_failure_rate),
+               "--deploy_failure_rate", str(args.deploy_failure_rate), "--api_latency", str(args.api_latency),
+               "--api_error_rate", str(args.api_error_rate)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    if args.enlisted:
+        command += ["--enlisted", os.path.abspath(ENLISTED)]
+    process = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("MAAS stub did not start")
+
+
+def bench_logger(log_dir, node_logs=False):
+    return setup_logger("maas_benchmark", log_dir, "maas_deployment.log", console=False,
+                        node_log_dir=os.path.join(log_dir, "nodes") if node_logs else None)
+
+
+def first_end(spans, stage, started):
+    ends = [span.end for span in spans.spans if span.stage == stage and span.outcome == "ok"]
+    return round(min(ends) - started, 3) if ends else None
+
+
+def run(args):
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="maas-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    port = free_port()
+    stub_url = f"http://127.0.0.1:{port}/MAAS/"
+    prepare_workspace(workdir, args.nodes, stub_url, args.pcd_seconds, args.enlisted)
+    forks_log = os.path.join(workdir, "forks.log")
+    open(forks_log, "w").close()
+    os.environ["PATH"] = os.path.join(workdir, "bin") + os.pathsep + os.environ["PATH"]
+    os.environ["BENCH_FORKS"] = forks_log
+
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    stub = start_stub(port, args)
+    sshd = FakeSshd().start()
+    logger = bench_logger(os.path.join(workdir, "deploy_logs"), args.node_logs == "yes")
+    spans = SpanRecorder(os.path.join(workdir, "deploy_logs", "stage_spans.jsonl"))
+    journal = Journal(journal_path(INVENTORY))
+    client = maasClient.get_client("bench", args.maas_client, stub_url, STUB_API_KEY, args.max_workers, logger)
+    engine = maasHelper
+    if args.engine == "async":
+        from modules import asyncEngine as engine
+    stream = None
+    if args.onboarding == "incremental":
+        stream = onboard.OnboardingStream("ubuntu", "bench", "region", "env", "https://pcd-bench.example.com/", "no",
+                                          None, "no", logger, batch_size=args.onboard_batch_size,
+                                          batch_window=args.onboard_batch_window, current_dir=workdir,
+                                          journal=journal, spans=spans, shards=args.onboard_shards).start()
+    inventory = Inventory.load(INVENTORY)
+    adaptive = AdaptiveConcurrency(logger, len(inventory), canary=args.adaptive_canary) if args.adaptive == "yes" else None
+    sampler = PeakSampler().start()
+    started = time.time()
+    try:
+        engine.add_machines_from_csv(
+            inventory, client, args.max_workers, None, "no", "ubuntu", args.storage_layout,
+            "lv_config_template.json", logger, poll_min_interval=args.poll_min_interval,
+            poll_max_interval=args.poll_max_interval, on_node_done=stream.add if stream else None, journal=journal,
+            ssh_probe={"port": sshd.port, "deadline": args.ssh_deadline, "min_backoff": 0.5, "max_backoff": 5,
+                       "control_dir": os.path.join(workdir, "cp")},
+            spans=spans, enlist=args.enlist == "yes", adaptive=adaptive)
+        if stream:
+            stream.close()
+        elif args.onboarding == "final":
+            try:
+                if not onboard.start_pcd_onboarding(INVENTORY, "ubuntu", "bench", "region", "env",
+                                                    "https://pcd-bench.example.com/", "no", None, "no", logger, spans,
+                                                    args.onboard_shards, rows=inventory.rows):
+                    logger.error("Final onboarding failed")
+            except SystemExit:
+                logger.error("Final onboarding failed")
+        wall = time.time() - started
+        sampler.stop()
+        with urlopen(stub_url + "_stub/stats") as response:
+            stub_stats = json.load(response)
+    finally:
+        client.close()
+        journal.close()
+        spans.close()
+        sshd.stop()
+        stub.terminate()
+        stub.wait()
+        os.chdir(previous_dir)
+
+    with open(updated_csv_path(os.path.join(workdir, INVENTORY)), newline="") as f:
+        statuses = Counter(row["deployment_status"] for row in csv.DictReader(f))
+    with open(forks_log) as f:
+        forks = Counter(line.strip() for line in f if line.strip())
+    result = {
+        "nodes": args.nodes,
+        "engine": args.engine,
+        "maas_client": args.maas_client,
+        "wall_seconds": round(wall, 3),
+        "statuses": dict(statuses),
+        "api_calls": stub_stats["total_calls"],
+        "api_calls_by_route": stub_stats["calls"],
+        "api_errors_injected": stub_stats["errors_injected"],
+        "forks": dict(forks),
+        "peak_threads": sampler.peak_threads,
+        "peak_fds": sampler.peak_fds,
+        "adaptive_limits": [limit for _, _, limit in adaptive.adjustments] if adaptive else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "first_deployed_seconds": first_end(spans, "ssh", started),
+        "first_onboarded_seconds": first_end(spans, ONBOARD_PREFIX + "apply-hosts-onboard", started),
+        "workdir": workdir,
+    }
+    return result, spans
+
+
+def report(result, spans):
+    lines = [
+        f"{result['nodes']} nodes, {result['engine']} engine, {result['maas_client']} client: "
+        f"{result['wall_seconds']:.1f}s wall clock",
+        "Final statuses: " + ", ".join(f"{status} {count}" for status, count in result["statuses"].items()),
+        f"MAAS API calls: {result['api_calls']} ({result['api_errors_injected']} failed on purpose)",
+    ]
+    lines += [f"  {route}: {count}" for route, count in result["api_calls_by_route"].items()]
+    lines += [
+        "Forks: " + (", ".join(f"{tool} {count}" for tool, count in result["forks"].items()) or "none"),
+        f"Peak threads: {result['peak_threads']}, peak open files: {result['peak_fds']}, peak RSS: {result['peak_rss_mb']} MB",
+        f"First host deployed and reachable after: {result['first_deployed_seconds']}s",
+        f"First host onboarded after: {result['first_onboarded_seconds']}s",
+    ]
+    if result["adaptive_limits"] is not None:
+        lines.append("Adaptive limits: " + (" -> ".join(map(str, result["adaptive_limits"])) or "unchanged"))
+    return lines + spans.summary() + [f"Workspace: {result['workdir']}"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the provisioning workflow against a simulated MAAS and report how it scales")
+    parser.add_argument("--nodes", type=int, default=100, help="Machines in the generated inventory (default: 100)")
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread")
+    parser.add_argument("--maas_client", choices=["api", "cli"], default="api",
+                        help="REST API, or fork the (fake) maas CLI for every call")
+    parser.add_argument("--max_workers", type=int, default=10)
+    parser.add_argument("--storage_layout", choices=["yes", "no", "plan"], default="no")
+    parser.add_argument("--onboarding", choices=["incremental", "final", "none"], default="incremental")
+    parser.add_argument("--onboard_batch_size", type=int, default=50)
+    parser.add_argument("--onboard_batch_window", type=float, default=30)
+    parser.add_argument("--onboard_shards", type=int, default=1)
+    parser.add_argument("--poll_min_interval", type=float, default=1)
+    parser.add_argument("--poll_max_interval", type=float, default=10)
+    parser.add_argument("--ssh_deadline", type=float, default=60)
+    parser.add_argument("--commission_seconds", type=float, default=10)
+    parser.add_argument("--deploy_seconds", type=float, default=20)
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--commission_failure_rate", type=float, default=0.0)
+    parser.add_argument("--deploy_failure_rate", type=float, default=0.0)
+    parser.add_argument("--api_latency", type=float, default=0.01)
+    parser.add_argument("--api_error_rate", type=float, default=0.0)
+    parser.add_argument("--pcd_seconds", type=float, default=1, help="How long each fake pcdExpress step takes")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--enlisted", type=int, default=0,
+                        help="How many of the machines MAAS has already enlisted (as New) when the run starts")
+    parser.add_argument("--enlist", choices=["yes", "no"], default="no", help="Run with --enlist")
+    parser.add_argument("--adaptive", choices=["yes", "no"], default="no", help="Run with --adaptive")
+    parser.add_argument("--adaptive_canary", type=int, default=5)
+    parser.add_argument("--node_logs", choices=["yes", "no"], default="no", help="Also write a log file per node")
+    parser.add_argument("--workdir", help="Working directory to keep (default: a new temporary directory)")
+    parser.add_argument("--json", help="Also write the results as JSON to this file, for comparing runs")
+    args = parser.parse_args(argv)
+    result, spans = run(args)
+    print("\n".join(report(result, spans)))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
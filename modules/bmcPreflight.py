@@ -0,0 +1,209 @@
+import os
+import csv
+import ssl
+import time
+import base64
+import shutil
+import socket
+import subprocess
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor
+from modules.statusWriter import write_atomic
+
+# Port each power type's BMC is reached on: IPMI over LAN (UDP) and Redfish (HTTPS).
+BMC_PORTS = {"ipmi": 623, "redfish": 443}
+# RMCP/IPMI 1.5 "Get Channel Authentication Capabilities" request. Any BMC
+# answers it before a session exists, so it needs no credentials.
+IPMI_PING = bytes.fromhex("0600ff07000000000000000000092018c88100388e04b5")
+UDP_ATTEMPTS = 3
+PREFLIGHT_STATUS = "BMC Preflight Failed"
+# Above this many machines only the failures are logged as a table.
+TABLE_ROWS = 50
+REPORT_COLUMNS = ("hostname", "power_type", "power_address", "reach", "auth", "result", "detail")
+# ipmitool -I interface per MAAS power_driver, and -L per privilege_level.
+IPMI_INTERFACES = {"LAN": "lan", "LAN_2_0": "lanplus"}
+IPMI_PRIVILEGES = {"ADMIN": "ADMINISTRATOR", "OPERATOR": "OPERATOR", "USER": "USER"}
+
+
+class BmcResult:
+    """Outcome of the preflight of one row: reachable and auth are True, False or None (not checked)."""
+
+    def __init__(self, row):
+        self.hostname = row["hostname"]
+        self.power_type = row.get("power_type")
+        self.address = (row.get("power_address") or "").strip()
+        self.reachable = None
+        self.auth = None
+        self.detail = ""
+        self.seconds = 0.0
+
+    @property
+    def ok(self):
+        return self.reachable is not False and self.auth is not False
+
+    def columns(self):
+        def mark(value):
+            return "-" if value is None else ("ok" if value else "FAIL")
+        return [self.hostname, self.power_type or "", self.address, mark(self.reachable), mark(self.auth),
+                "pass" if self.ok else "FAIL", self.detail]
+
+
+def udp_reachable(address, port, timeout):
+    """(True, detail) if the BMC at address answers the IPMI ping on UDP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            # Connected, so an ICMP port unreachable comes back as ConnectionRefusedError.
+            sock.connect((address, port))
+            for _ in range(UDP_ATTEMPTS):
+                sock.send(IPMI_PING)
+                try:
+                    reply = sock.recv(512)
+                except socket.timeout:
+                    continue
+                if reply[:1] == b"\x06":
+                    return True, ""
+                return False, f"unexpected reply on UDP {port}"
+        except ConnectionRefusedError:
+            return False, f"UDP {port} refused"
+        except OSError as e:
+            return False, f"UDP {port}: {e}"
+    return False, f"no reply on UDP {port} after {UDP_ATTEMPTS} tries"
+
+
+def tcp_reachable(address, port, timeout):
+    """(True, detail) if address accepts a TCP connection on port."""
+    try:
+        socket.create_connection((address, port), timeout=timeout).close()
+        return True, ""
+    except socket.timeout:
+        return False, f"TCP {port} timed out"
+    except OSError as e:
+        return False, f"TCP {port}: {e.strerror or e}"
+
+
+def ipmitool_auth(row, address, port, timeout):
+    """(True, detail) if ipmitool can log in to the BMC with the row's credentials."""
+    command = ["ipmitool", "-I", IPMI_INTERFACES.get((row.get("power_driver") or "").upper(), "lanplus"),
+               "-H", address, "-p", str(port), "-U", row.get("power_user") or "", "-E", "-N", str(int(timeout)),
+               "-R", "1"]
+    if row.get("cipher_suite_id"):
+        command += ["-C", row["cipher_suite_id"]]
+    if row.get("privilege_level"):
+        command += ["-L", IPMI_PRIVILEGES.get(row["privilege_level"].upper(), row["privilege_level"])]
+    if row.get("k_g"):
+        command += ["-y", row["k_g"]]
+    try:
+        # -E: the password comes from IPMI_PASSWORD, not the command line other users can see.
+        result = subprocess.run(command + ["chassis", "power", "status"], capture_output=True, text=True,
+                                timeout=timeout * 4, env={**os.environ, "IPMI_PASSWORD": row.get("power_pass") or ""})
+    except subprocess.TimeoutExpired:
+        return False, "ipmitool timed out"
+    if result.returncode == 0:
+        return True, ""
+    lines = (result.stderr or result.stdout).strip().splitlines()
+    return False, lines[-1] if lines else f"ipmitool exited with {result.returncode}"
+
+
+def redfish_auth(row, address, port, timeout):
+    """(True, detail) if the Redfish service accepts the row's credentials."""
+    credentials = base64.b64encode(f"{row.get('power_user') or ''}:{row.get('power_pass') or ''}".encode()).decode()
+    request = Request(f"https://{address}:{port}/redfish/v1/Systems",
+                      headers={"Authorization": f"Basic {credentials}"})
+    # BMCs serve self-signed certificates; this only checks the credentials.
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    try:
+        with urlopen(request, timeout=timeout, context=context):
+            return True, ""
+    except HTTPError as e:
+        return False, "credentials rejected" if e.code in (401, 403) else f"Redfish returned HTTP {e.code}"
+    except (URLError, OSError) as e:
+        return False, f"Redfish: {getattr(e, 'reason', e)}"
+
+
+# Per power type: the reachability check and the credential check. Other power
+# types (manual, virsh, ...) are not checked.
+REACHABILITY_CHECKS = {"ipmi": udp_reachable, "redfish": tcp_reachable}
+AUTH_CHECKS = {"ipmi": ipmitool_auth, "redfish": redfish_auth}
+
+
+class BmcPreflight:
+    """Checks the BMC of every row at once, before any machine is created in MAAS.
+
+    A wrong power_address or bad credentials otherwise only show as a machine
+    that never finishes commissioning, some 700 seconds in. Each row's BMC is
+    checked on a pool of max_workers threads: the IPMI port (UDP 623) must
+    answer an IPMI ping, or the Redfish port (TCP 443) accept a connection,
+    and with auth the row's credentials must be accepted (ipmitool chassis
+    power status, or GET /redfish/v1/Systems). Each check takes at most a few
+    timeouts, so the whole CSV is done in seconds.
+
+    The checks are looked up per power type in reachability_checks and
+    auth_checks, which can be replaced (e.g. to point at a local stand-in),
+    as can the port of each power type.
+    """
+
+    def __init__(self, logger, auth=False, max_workers=64, timeout=2.0, reachability_checks=None, auth_checks=None,
+                 ports=None):
+        self.logger = logger
+        self.auth = auth
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.reachability_checks = reachability_checks or REACHABILITY_CHECKS
+        self.auth_checks = auth_checks or AUTH_CHECKS
+        self.ports = {**BMC_PORTS, **(ports or {})}
+
+    def run(self, inventory):
+        """Check every row of inventory; returns one BmcResult per row, in CSV order."""
+        rows = list(inventory)
+        if (self.auth and self.auth_checks.get("ipmi") is ipmitool_auth
+                and any(row.get("power_type") == "ipmi" for row in rows) and not shutil.which("ipmitool")):
+            raise ValueError("BMC credential checks of IPMI machines need ipmitool, which is not installed")
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(rows)) or 1,
+                                thread_name_prefix="bmc-preflight") as pool:
+            results = list(pool.map(self.check, rows))
+        failed = [result for result in results if not result.ok]
+        self.logger.info(f"BMC preflight of {len(results)} machines took {time.monotonic() - started:.1f}s: "
+                         f"{len(results) - len(failed)} passed, {len(failed)} failed")
+        return results
+
+    def check(self, row):
+        result = BmcResult(row)
+        started = time.monotonic()
+        reachable = self.reachability_checks.get(result.power_type)
+        if reachable is None or not result.address:
+            result.detail = "not checked"
+            return result
+        port = self.ports.get(result.power_type)
+        try:
+            result.reachable, result.detail = reachable(result.address, port, self.timeout)
+            authenticate = self.auth_checks.get(result.power_type)
+            if result.reachable and self.auth and authenticate:
+                result.auth, result.detail = authenticate(row, result.address, port, self.timeout)
+        except Exception as e:
+            result.reachable = result.reachable or False
+            result.detail = f"check failed: {e}"
+        result.seconds = time.monotonic() - started
+        return result
+
+
+def log_table(results, logger, failed_only=False):
+    """Log the results as a table, one line per machine."""
+    header = list(REPORT_COLUMNS)
+    rows = [result.columns() for result in results if not (failed_only and result.ok)]
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header) - 1)]
+    for row in [header] + rows:
+        logger.info("BMC  " + "  ".join(str(value).ljust(width) for value, width in zip(row, widths)) + "  " + row[-1])
+
+
+def write_report(results, path):
+    """Write the results as CSV to path."""
+    def write(f):
+        writer = csv.writer(f)
+        writer.writerow(REPORT_COLUMNS)
+        writer.writerows(result.columns() for result in results)
+    write_atomic(path, write, newline='')
@@ -0,0 +1,182 @@
+import time
+import threading
+from modules.maasClient import MaasError
+
+# Statuses that end a wait unsuccessfully.
+FAILED_STATUSES = ("Failed commissioning", "Failed deployment")
+
+# A machine MAAS momentarily cannot account for (status Unknown, or missing
+# from the listing) is only given up on once it has stayed so this long.
+UNKNOWN_GRACE = 120
+
+# Starting guesses for how long a machine takes to reach each status; replaced by
+# observed durations as machines in this run get there.
+DEFAULT_EXPECTED_SECONDS = {"Ready": 600, "Deployed": 900}
+
+# Above this many tracked machines one unfiltered listing is cheaper than a
+# query string with one id= per machine.
+MAX_FILTERED_IDS = 100
+
+
+class _Watch:
+    def __init__(self, system_id, expected_status, hostname, timeout, callback):
+        self.system_id = system_id
+        self.expected_status = expected_status
+        self.hostname = hostname
+        self.callback = callback
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.unknown_since = None
+
+
+class FleetPoller:
+    """Single background poller for every machine the run is waiting on.
+
+    Each tick reads all watched machines with one bulk `machines read` call,
+    diffs their status against the previous tick and completes only the
+    watches whose machine changed (or timed out). The tick interval adapts:
+    long while every watch is early in its expected commissioning/deploy
+    time, short once one is nearly due or right after transitions were seen.
+    """
+
+    def __init__(self, client, logger, min_interval=5, max_interval=60):
+        self.client = client
+        self.logger = logger
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.statuses = {}
+        self.ticks = 0
+        self._watches = {}
+        self._expected = dict(DEFAULT_EXPECTED_SECONDS)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="fleet-poller", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    @staticmethod
+    def status_query(system_ids):
+        """Filter params for the bulk `machines read` covering system_ids."""
+        return {"id": sorted(system_ids)} if len(system_ids) <= MAX_FILTERED_IDS else {}
+
+    @staticmethod
+    def statuses_from(machines):
+        return {m.get("system_id"): m.get("status_name", "Unknown") for m in machines}
+
+    def _read_statuses(self, system_ids):
+        return self.statuses_from(self.client.call("machines", "read", **self.status_query(system_ids)))
+
+    def _learn(self, expected_status, seconds):
+        previous = self._expected.get(expected_status)
+        self._expected[expected_status] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+
+    def _complete(self, watch, ok, status):
+        watches = self._watches.get(watch.system_id, [])
+        if watch in watches:
+            watches.remove(watch)
+        if not watches:
+            self._watches.pop(watch.system_id, None)
+        return watch, ok, status
+
+    def _watched_ids(self):
+        with self._lock:
+            return set(self._watches)
+
+    def poll_once(self):
+        system_ids = self._watched_ids()
+        current = None
+        if system_ids:
+            try:
+                current = self._read_statuses(system_ids)
+                self.ticks += 1
+            except MaasError as e:
+                self.logger.warning(f"Fleet status poll failed, keeping previous states: {e}")
+            except Exception as e:
+                # Every wait depends on this thread; an unexpected error must not end it.
+                self.logger.error(f"Fleet status poll failed unexpectedly, keeping previous states: {e!r}")
+        return self.apply(system_ids, current)
+
+    def apply(self, system_ids, current):
+        """Diff a bulk read against the last known states and complete the affected watches."""
+        changed = 0
+        finished = []
+        now = time.monotonic()
+        with self._lock:
+            for system_id in system_ids if current is not None else ():
+                status = current.get(system_id, "Unknown")
+                if self.statuses.get(system_id) == status:
+                    continue
+                self.statuses[system_id] = status
+                changed += 1
+                for watch in list(self._watches.get(system_id, [])):
+                    self.logger.info(f"[{watch.hostname}] Status: {status}")
+                    watch.unknown_since = now if status == "Unknown" else None
+                    if status == watch.expected_status:
+                        self._learn(status, now - watch.started)
+                        finished.append(self._complete(watch, True, status))
+                    elif status in FAILED_STATUSES:
+                        finished.append(self._complete(watch, False, status))
+            for watches in list(self._watches.values()):
+                for watch in list(watches):
+                    if now >= watch.deadline:
+                        self.logger.warning(f"[{watch.hostname}] Timeout waiting for status: {watch.expected_status}")
+                        finished.append(self._complete(watch, False, self.statuses.get(watch.system_id, "Unknown")))
+                    elif watch.unknown_since is not None and now - watch.unknown_since >= UNKNOWN_GRACE:
+                        self.logger.warning(f"[{watch.hostname}] Status still Unknown after {UNKNOWN_GRACE}s, giving up.")
+                        finished.append(self._complete(watch, False, "Unknown"))
+        for watch, ok, status in finished:
+            # A failing callback must not stop the poller, which every other wait depends on.
+            try:
+                watch.callback(ok, status)
+            except Exception as e:
+                self.logger.error(f"[{watch.hostname}] Status callback failed: {e}")
+        return changed
+
+    def next_interval(self, changed):
+        if changed:
+            return self.min_interval
+        now = time.monotonic()
+        interval = self.max_interval
+        with self._lock:
+            for watches in self._watches.values():
+                for watch in watches:
+                    expected = self._expected.get(watch.expected_status, self.max_interval)
+                    remaining = expected - (now - watch.started)
+                    interval = min(interval, max(self.min_interval, remaining / 2), max(0, watch.deadline - now))
+        return interval
+
+    def _run(self):
+        while not self._stopped.is_set():
+            changed = self.poll_once()
+            self._wakeup.wait(self.next_interval(changed))
+            self._wakeup.clear()
+
+    def watch(self, system_id, expected_status, hostname, timeout, callback):
+        """Call callback(ok, status) once the machine reaches expected_status, fails or times out."""
+        with self._lock:
+            self._watches.setdefault(system_id, []).append(
+                _Watch(system_id, expected_status, hostname, timeout, callback))
+            # A fresh watch must not trust a status cached by an earlier one.
+            self.statuses.pop(system_id, None)
+        self._notify()
+
+    def _notify(self):
+        self._wakeup.set()
+
+    def wait_for(self, system_id, expected_status, hostname, timeout=600):
+        done = threading.Event()
+        result = []
+        self.watch(system_id, expected_status, hostname, timeout,
+                   lambda ok, status: (result.append(ok), done.set()))
+        done.wait()
+        return result[0]
@@ -0,0 +1,136 @@
+import re
+import csv
+import ipaddress
+
+# Columns every row needs; cloud_init is needed too unless --cloud_init_template is given.
+REQUIRED_COLUMNS = ("hostname", "architecture", "mac_addresses", "power_type", "power_user", "power_pass",
+                    "power_driver", "power_address", "cipher_suite_id", "power_boot_type", "privilege_level",
+                    "k_g", "ip")
+# Columns that may be present but left empty in a row (power_address too, for power_type manual).
+OPTIONAL_VALUES = ("power_user", "power_pass", "power_driver", "cipher_suite_id", "power_boot_type",
+                   "privilege_level", "k_g")
+
+HOSTNAME_PATTERN = re.compile(r"^[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?$")
+ADDRESS_PATTERN = re.compile(r"^[A-Za-z0-9]([A-Za-z0-9.-]{0,251}[A-Za-z0-9])?$")
+MAC_PATTERN = re.compile(r"^[0-9A-Fa-f]{2}([:-][0-9A-Fa-f]{2}){5}$")
+
+
+class InventoryError(ValueError):
+    """The CSV has problems; errors lists every one of them, by CSV line."""
+
+    def __init__(self, path, errors):
+        self.path = path
+        self.errors = errors
+        super().__init__(f"{len(errors)} problem(s) in {path}:\n" + "\n".join(f"  {error}" for error in errors))
+
+
+def normalize_mac(mac):
+    return mac.strip().lower().replace("-", ":")
+
+
+def row_macs(row):
+    return [normalize_mac(mac) for mac in (row.get("mac_addresses") or "").split(",") if mac.strip()]
+
+
+def _is_ip(value):
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
+def row_errors(row, require_cloud_init=False):
+    """Schema problems of one row (without the cross-row duplicate checks)."""
+    errors = []
+    optional = OPTIONAL_VALUES + (("power_address",) if row.get("power_type") == "manual" else ())
+    for column in REQUIRED_COLUMNS + (("cloud_init",) if require_cloud_init else ()):
+        if column not in optional and not (row.get(column) or "").strip():
+            errors.append(f"{column} is empty")
+    hostname = (row.get("hostname") or "").strip()
+    if hostname and not HOSTNAME_PATTERN.match(hostname):
+        errors.append(f"invalid hostname {hostname!r}")
+    for mac in (row.get("mac_addresses") or "").split(","):
+        if mac.strip() and not MAC_PATTERN.match(mac.strip()):
+            errors.append(f"invalid MAC address {mac.strip()!r}")
+    for column in ("ip", "storage_ip"):
+        value = (row.get(column) or "").strip()
+        if value and not _is_ip(value):
+            errors.append(f"invalid {column} {value!r}")
+    power_address = (row.get("power_address") or "").strip()
+    if power_address and not (_is_ip(power_address) or ADDRESS_PATTERN.match(power_address)):
+        errors.append(f"invalid power_address {power_address!r}")
+    return errors
+
+
+class Inventory:
+    """The machines of a run: validated CSV rows plus hostname, IP and system_id indexes.
+
+    load() reads the CSV in one pass, checking every row as it goes, and
+    raises InventoryError listing all problems at once, so a bad CSV is
+    rejected before a single MAAS call is made. by_system_id fills in as
+    machines are created or matched (bind).
+    """
+
+    def __init__(self, path, fieldnames, rows):
+        self.path = path
+        self.fieldnames = fieldnames
+        self.rows = rows
+        self.by_hostname = {row["hostname"]: row for row in rows}
+        self.by_ip = {row["ip"]: row for row in rows}
+        self.by_system_id = {}
+
+    @classmethod
+    def load(cls, path_or_inventory, require_cloud_init=False):
+        if isinstance(path_or_inventory, Inventory):
+            return path_or_inventory
+        path = path_or_inventory
+        errors = []
+        rows = []
+        seen = {"hostname": {}, "ip": {}, "MAC address": {}}
+        with open(path, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            fieldnames = list(reader.fieldnames or [])
+            required = REQUIRED_COLUMNS + (("cloud_init",) if require_cloud_init else ())
+            missing = [column for column in required if column not in fieldnames]
+            if missing:
+                raise InventoryError(path, [f"missing column(s): {', '.join(missing)}"])
+            for row in reader:
+                line = reader.line_num
+                # DictReader fills the columns of a short row with None and keeps the extra
+                # fields of a long one under None.
+                fields = len(fieldnames) - sum(value is None for value in row.values()) + len(row.get(None) or [])
+                if fields != len(fieldnames):
+                    errors.append(f"line {line}: has {fields} field(s), the header has {len(fieldnames)}")
+                errors += [f"line {line}: {error}" for error in row_errors(row, require_cloud_init)]
+                keys = [("hostname", (row.get("hostname") or "").strip().lower()), ("ip", (row.get("ip") or "").strip())]
+                keys += [("MAC address", mac) for mac in row_macs(row)]
+                for kind, value in keys:
+                    if not value:
+                        continue
+                    if value in seen[kind]:
+                        errors.append(f"line {line}: duplicate {kind} {value} (also on line {seen[kind][value]})")
+                    else:
+                        seen[kind][value] = line
+                rows.append(row)
+        if not rows:
+            errors.append("no machines listed")
+        if errors:
+            raise InventoryError(path, errors)
+        return cls(path, fieldnames, rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def without(self, hostnames):
+        """The inventory minus the rows of hostnames (the rows themselves are shared)."""
+        return Inventory(self.path, self.fieldnames, [row for row in self.rows if row["hostname"] not in hostnames])
+
+    def bind(self, hostname, system_id):
+        """Record the MAAS system_id of hostname's machine."""
+        row = self.by_hostname.get(hostname)
+        if row is not None and system_id:
+            self.by_system_id[system_id] = row
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import threading
+
+# Progress events in the order a node reaches them. Resuming picks up after the
+# last one recorded (and still true in MAAS) for each hostname.
+# A storage layout that could not be applied is recorded as storage_failed instead.
+EVENTS = ["created", "commissioned", "storage", "deploy_started", "deployed", "ssh", "onboarded"]
+
+
+def journal_path(csv_file):
+    base, _ = os.path.splitext(csv_file)
+    return f"{base}_journal.jsonl"
+
+
+class Journal:
+    """Append-only JSON-lines log of per-node progress.
+
+    Every entry is flushed and fsynced before record() returns, so a crash
+    loses at most the step that was in flight.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a" if resume else "w")
+
+    def record(self, hostname, event, **fields):
+        entry = {"ts": round(time.time(), 3), "hostname": hostname, "event": event}
+        entry.update({k: v for k, v in fields.items() if v is not None})
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class NodeRecord:
+    """What the journal knows about one hostname."""
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.system_id = None
+        self.events = {}
+        self.status = None
+
+    def done(self, event):
+        return event in self.events
+
+
+def load_journal(path):
+    """Replay a journal into {hostname: NodeRecord}; a torn last line is ignored."""
+    records = {}
+    if not os.path.isfile(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            record = records.setdefault(entry["hostname"], NodeRecord(entry["hostname"]))
+            record.system_id = entry.get("system_id", record.system_id)
+            if entry["event"] == "finished":
+                record.status = entry.get("status")
+            else:
+                if entry["event"] == "storage_failed":
+                    # The layout is no longer the one an earlier run applied.
+                    record.events.pop("storage", None)
+                record.events[entry["event"]] = entry["ts"]
+    return records
@@ -0,0 +1,188 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+NODE_LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(stage_label)s] %(message)s'
+# Detail loggers (children of the main logger) whose records only go to per-node
+# files, never to the console or the main log: storage layout steps.
+DETAIL_LOGGERS = ("storage",)
+STORAGE_LOG_DIR = "storage_layout_logs"
+# Per-node log files kept open at once; the least recently written is closed first.
+MAX_OPEN_NODE_LOGS = 32
+
+# The node the current thread (or asyncio task) is working on: anything with
+# hostname, system_id and stage attributes, read when a record is logged.
+_node = contextvars.ContextVar("node", default=None)
+
+
+class NodeContext:
+    def __init__(self, hostname, system_id=None, stage=None):
+        self.hostname = hostname
+        self.system_id = system_id
+        self.stage = stage
+
+
+@contextmanager
+def node_context(node=None, **fields):
+    """Tag the records logged inside the block with node's hostname, system_id and stage.
+
+    node is a pipeline Node (read when each record is logged, so a later stage
+    or system_id shows up), or fields builds one: hostname=, system_id=, stage=.
+    """
+    token = _node.set(node if node is not None else NodeContext(**fields))
+    try:
+        yield
+    finally:
+        _node.reset(token)
+
+
+def in_node_context(fn):
+    """fn, run on another thread (a pool of the caller's) under the caller's node context."""
+    node = _node.get()
+
+    def run(*args, **kwargs):
+        token = _node.set(node)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _node.reset(token)
+    return run
+
+
+class ContextFilter(logging.Filter):
+    """Adds hostname, system_id and stage to every record, on the thread that logs it."""
+
+    def filter(self, record):
+        node = _node.get()
+        for field in ("hostname", "system_id", "stage"):
+            if not hasattr(record, field):
+                setattr(record, field, getattr(node, field, None) if node is not None else None)
+        return True
+
+
+class MainLogFilter(logging.Filter):
+    """Drops the records of the detail loggers of log_name."""
+
+    def __init__(self, log_name):
+        super().__init__()
+        self.prefixes = tuple(f"{log_name}.{name}" for name in DETAIL_LOGGERS)
+
+    def filter(self, record):
+        return not record.name.startswith(self.prefixes)
+
+
+class NodeFormatter(logging.Formatter):
+    def format(self, record):
+        record.stage_label = record.stage or "-"
+        return super().format(record)
+
+
+class NodeFileHandler(logging.Handler):
+    """Writes each node's records to <log_dir>/<hostname>.log, keeping at most max_open files open.
+
+    Only records with a hostname are written, and with name only those of that
+    logger and its children. It runs on the listener thread alone, so the
+    open files are only ever touched by one thread.
+    """
+
+    def __init__(self, log_dir, name="", max_open=MAX_OPEN_NODE_LOGS):
+        super().__init__()
+        self.log_dir = log_dir
+        self.max_open = max_open
+        self.setFormatter(NodeFormatter(NODE_LOG_FORMAT))
+        if name:
+            self.addFilter(logging.Filter(name))
+        self._files = OrderedDict()
+
+    def emit(self, record):
+        if not record.hostname:
+            return
+        try:
+            f = self._files.pop(record.hostname, None)
+            if f is None:
+                os.makedirs(self.log_dir, exist_ok=True)
+                f = open(os.path.join(self.log_dir, f"{record.hostname}.log"), "a")
+                while len(self._files) >= self.max_open:
+                    self._files.popitem(last=False)[1].close()
+            self._files[record.hostname] = f
+            f.write(self.format(record) + "\n")
+            f.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        while self._files:
+            self._files.popitem()[1].close()
+        super().close()
+
+
+class LogPipeline:
+    """A queue every logging thread puts its records on, and one listener thread writing them out."""
+
+    def __init__(self, handlers):
+        self.queue = queue.SimpleQueue()
+        self.handler = QueueHandler(self.queue)
+        self.handler.addFilter(ContextFilter())
+        self.handlers = handlers
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self):
+        self.listener.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """Write out whatever is still queued and close the handlers."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+def setup_logger(log_name="maas_logger", log_dir="deploy_logs", log_file="maas_deployment.log", node_log_dir=None,
+                 storage_log_dir=STORAGE_LOG_DIR, console=True):
+    """The run's logger: a 1 MB rotating log file and the console, written by one listener thread.
+
+    Logging only puts the record on a queue, so worker threads never wait on a
+    file or the console. Records are tagged with the node being worked on
+    (see node_context). The storage layout details of each node go to
+    <storage_log_dir>/<hostname>.log, and with node_log_dir every record
+    that names a node also goes to <node_log_dir>/<hostname>.log.
+    """
+    logger = logging.getLogger(log_name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if logger.handlers:
+        return logger
+
+    os.makedirs(log_dir, exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT)
+    main_filter = MainLogFilter(log_name)
+    file_handler = RotatingFileHandler(os.path.join(log_dir, log_file), maxBytes=1 * 1024 * 1024, backupCount=5)
+    handlers = [file_handler]
+    if console:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    for handler in handlers:
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(formatter)
+        handler.addFilter(main_filter)
+    handlers.append(NodeFileHandler(storage_log_dir, f"{log_name}.storage"))
+    if node_log_dir:
+        handlers.append(NodeFileHandler(node_log_dir))
+
+    logger.pipeline = LogPipeline(handlers).start()
+    logger.addHandler(logger.pipeline.handler)
+    return logger
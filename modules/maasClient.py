@@ -0,0 +1,306 @@
+import os
+import re
+import json
+import time
+import queue
+import uuid
+import sqlite3
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit, urlencode, quote
+
+# MAAS CLI resource names mapped to REST paths (relative to /api/2.0/).
+# Positional ids are substituted in order, exactly as the CLI takes them.
+ROUTES = {
+    "machines": "machines/",
+    "machine": "machines/{0}/",
+    "volume-groups": "nodes/{0}/volume-groups/",
+    "volume-group": "nodes/{0}/volume-group/{1}/",
+    "block-devices": "nodes/{0}/blockdevices/",
+    "block-device": "nodes/{0}/blockdevices/{1}/",
+    "partitions": "nodes/{0}/blockdevices/{1}/partitions/",
+    "partition": "nodes/{0}/blockdevices/{1}/partition/{2}",
+    "subnets": "subnets/",
+}
+
+# Connection-level failures that mean a pooled keep-alive socket went stale.
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                           ConnectionResetError, BrokenPipeError)
+
+
+# HTTP statuses worth retrying: the region is overloaded, restarting or timed out.
+TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+# The maas CLI reports HTTP and connection failures only as text.
+TRANSIENT_PATTERN = re.compile(r"\bHTTP (408|429|50[0234])\b|Service Unavailable|Internal Server Error|Bad Gateway|"
+                               r"Gateway Time-?out|Too Many Requests|Connection (refused|reset|aborted)|timed out",
+                               re.IGNORECASE)
+
+# How long one maas CLI call may take before it counts as a (transient) failure.
+CLI_TIMEOUT = 300
+
+
+class MaasError(Exception):
+    """Raised when a MAAS call fails, whichever backend issued it.
+
+    transient tells whether the same call may well succeed if retried; unless
+    given, it is derived from the HTTP status or, failing that, the message.
+    """
+
+    def __init__(self, message, status=None, body="", transient=None):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+        if transient is None:
+            transient = status in TRANSIENT_STATUSES if status else bool(TRANSIENT_PATTERN.search(body or message))
+        self.transient = transient
+
+
+def load_profile(maas_user, db_path=None):
+    """Read the URL and API key saved by `maas login <maas_user> ...`."""
+    db_path = db_path or os.path.expanduser("~/.maascli.db")
+    if not os.path.isfile(db_path):
+        return None, None
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute("SELECT data FROM profiles WHERE name = ?", (maas_user,)).fetchone()
+    except sqlite3.Error:
+        return None, None
+    finally:
+        conn.close()
+    if not row:
+        return None, None
+    profile = json.loads(row[0])
+    credentials = profile.get("credentials")
+    if isinstance(credentials, (list, tuple)):
+        credentials = ":".join(credentials)
+    return profile.get("url"), credentials
+
+
+def _request_for(resource, action):
+    """Translate a CLI-style (resource, action) pair into (HTTP method, op)."""
+    if action == "read":
+        return "GET", None
+    if action == "update":
+        return "PUT", None
+    if action == "delete":
+        return "DELETE", None
+    if action == "create" and resource.endswith("s"):
+        return "POST", None
+    return "POST", action.replace("-", "_")
+
+
+def _flatten_params(params):
+    pairs = []
+    for key, value in params.items():
+        if value is None:
+            continue
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            pairs.append((key, item if isinstance(item, str) else str(item)))
+    return pairs
+
+
+def parse_api_url(url):
+    """Split a MAAS URL into (scheme, netloc, API base path ending in api/2.0/)."""
+    parts = urlsplit(url)
+    path = parts.path if parts.path.endswith("/") else parts.path + "/"
+    if not path.endswith("api/2.0/"):
+        path += "api/2.0/"
+    return parts.scheme or "http", parts.netloc, path
+
+
+def parse_api_key(api_key):
+    try:
+        consumer_key, token_key, token_secret = api_key.split(":")
+    except (AttributeError, ValueError):
+        raise MaasError("MAAS API key must have the form <consumer_key>:<token_key>:<token_secret>")
+    return consumer_key, token_key, token_secret
+
+
+def oauth_header(consumer_key, token_key, token_secret):
+    params = {
+        "oauth_version": "1.0",
+        "oauth_signature_method": "PLAINTEXT",
+        "oauth_consumer_key": consumer_key,
+        "oauth_token": token_key,
+        "oauth_signature": "&" + token_secret,
+        "oauth_nonce": uuid.uuid4().hex,
+        "oauth_timestamp": str(int(time.time())),
+    }
+    return "OAuth " + ", ".join(f'{k}="{quote(v, safe="")}"' for k, v in params.items())
+
+
+def prepare_request(base_path, resource, action, ids, params):
+    """Return (method, path, body, content type) for a CLI-style MAAS call."""
+    if resource not in ROUTES:
+        raise MaasError(f"Unsupported MAAS resource: {resource}")
+    method, op = _request_for(resource, action)
+    path = base_path + ROUTES[resource].format(*ids)
+    pairs = _flatten_params(params)
+    query = [("op", op)] if op else []
+    body, content_type = None, None
+    if method in ("GET", "DELETE"):
+        query += pairs
+    else:
+        body = urlencode(pairs)
+        content_type = "application/x-www-form-urlencoded"
+    if query:
+        path += "?" + urlencode(query)
+    return method, path, body, content_type
+
+
+def cli_command(maas_user, resource, action, ids, params):
+    command = ["maas", maas_user, resource, action, *map(str, ids)]
+    return command + [f"{key}={value}" for key, value in _flatten_params(params)]
+
+
+def parse_cli_result(command, returncode, stdout, stderr):
+    if returncode != 0:
+        output = (stderr.strip() or stdout.strip())
+        status = 404 if "not found" in output.lower() else None
+        raise MaasError(f"{' '.join(command[:5])} exited with {returncode}: {output}",
+                        status=status, body=output)
+    return decode_response(stdout.encode(), "")
+
+
+def parse_http_result(method, path, status, content_type, data):
+    if status >= 400:
+        text = data.decode("utf-8", errors="replace").strip()
+        raise MaasError(f"{method} {path} returned HTTP {status}: {text}", status=status, body=text)
+    return decode_response(data, content_type)
+
+
+def decode_response(body, content_type):
+    if not body:
+        return {}
+    text = body.decode("utf-8", errors="replace")
+    if "json" in (content_type or ""):
+        return json.loads(text)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+class MaasApiClient:
+    """In-process MAAS REST client.
+
+    Requests are signed with OAuth1 PLAINTEXT (what MAAS API keys use) and sent
+    over a bounded pool of keep-alive connections, so a worker thread reuses an
+    open socket instead of forking the `maas` CLI for every call.
+    """
+
+    mode = "api"
+
+    def __init__(self, url, api_key, pool_size=10, timeout=60):
+        self.url = url
+        self.api_key = api_key
+        self.scheme, self.netloc, self.base_path = parse_api_url(url)
+        self.credentials = parse_api_key(api_key)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+
+    def _new_connection(self):
+        with self._stats_lock:
+            self.connections_opened += 1
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _send(self, method, path, body, headers):
+        with self._slots:
+            try:
+                conn, reused = self._idle.get_nowait(), True
+            except queue.Empty:
+                conn, reused = self._new_connection(), False
+            while True:
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except STALE_CONNECTION_ERRORS:
+                    conn.close()
+                    if not reused:
+                        raise
+                    # The server dropped an idle keep-alive socket; retry once on a fresh one.
+                    conn, reused = self._new_connection(), False
+                    continue
+                except Exception:
+                    conn.close()
+                    raise
+                break
+            if response.will_close:
+                conn.close()
+            else:
+                self._idle.put(conn)
+            return response.status, response.getheader("Content-Type", ""), data
+
+    def call(self, resource, action, *ids, **params):
+        method, path, body, content_type = prepare_request(self.base_path, resource, action, ids, params)
+        headers = {"Authorization": oauth_header(*self.credentials), "Accept": "application/json"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        with self._stats_lock:
+            self.requests += 1
+        try:
+            status, content_type, data = self._send(method, path, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            raise MaasError(f"{method} {path} failed: {e}", transient=True)
+        return parse_http_result(method, path, status, content_type, data)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class MaasCliClient:
+    """Fallback backend that shells out to `maas <profile> ...` for each call."""
+
+    mode = "cli"
+
+    def __init__(self, maas_user, timeout=CLI_TIMEOUT):
+        self.maas_user = maas_user
+        self.timeout = timeout
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+
+    def call(self, resource, action, *ids, **params):
+        command = cli_command(self.maas_user, resource, action, ids, params)
+        with self._stats_lock:
+            self.requests += 1
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise MaasError(f"{' '.join(command[:5])} timed out after {self.timeout}s", transient=True)
+        return parse_cli_result(command, result.returncode, result.stdout, result.stderr)
+
+    def close(self):
+        pass
+
+
+def get_client(maas_user, mode="api", url=None, api_key=None, pool_size=10, logger=None):
+    """Build the MAAS client for this run.
+
+    The API backend takes its URL and key from the arguments or, failing that,
+    from the `maas login` profile; if neither is available we fall back to the CLI.
+    """
+    if mode == "cli":
+        return MaasCliClient(maas_user)
+    if not (url and api_key):
+        profile_url, profile_key = load_profile(maas_user)
+        url = url or profile_url
+        api_key = api_key or profile_key
+    if not (url and api_key):
+        if logger:
+            logger.warning(f"No MAAS URL/API key found for profile '{maas_user}', falling back to the maas CLI.")
+        return MaasCliClient(maas_user)
+    if logger:
+        logger.info(f"Using MAAS REST API at {url} (connection pool size {pool_size})")
+    return MaasApiClient(url, api_key, pool_size=pool_size)
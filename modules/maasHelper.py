@@ -1,99 +1,112 @@
 import os
-import sys
-import csv
 import json
-import time
-import logging
+import base64
+import threading
 from string import Template
-from datetime import datetime
-import subprocess
-from logging.handlers import RotatingFileHandler
 from concurrent.futures import ThreadPoolExecutor
 from modules import  storageLayout
+from modules.fleetPoller import FleetPoller
+from modules.sshProber import SshProber
+from modules.throttling import Throttle
+from modules.retry import Retries, RetryPolicy
+from modules.timing import SpanRecorder
+from modules.pipeline import Pipeline, Node, STAGES
+from modules.journal import load_journal
+from modules.maasClient import MaasError
+from modules.inventory import Inventory, row_macs
+from modules.statusWriter import StatusWriter
+from modules.runState import RunState
+from modules.logPipeline import node_context
+from modules.adaptiveConcurrency import ObservedClient
 
-def setup_logger(log_name="maas_logger", log_dir="deploy_logs", log_file="maas_deployment.log"):
-    os.makedirs(log_dir, exist_ok=True)
-    log_path = os.path.join(log_dir, log_file)
-    logger = logging.getLogger(log_name)
-    logger.setLevel(logging.INFO)
-    logger.propagate = False
+def add_machines_from_csv(csv_file,client,max_workers,cloud_init_template,preserve_cloud_init,ssh_user,storage_layout,storage_layout_template, logger, poll_min_interval=5, poll_max_interval=60, stage_limits=None, on_node_done=None, journal=None, resume=False, ssh_probe=None, throttle=None, spans=None, retries=None, enlist=False, exclude=(), adaptive=None, stage=None):
+    """Provision every machine of csv_file (a path or an already loaded Inventory) but those named in exclude.
 
-    file_handler = RotatingFileHandler(log_path, maxBytes=1 * 1024 * 1024, backupCount=5)
-    file_handler.setLevel(logging.INFO)
-
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
-
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    if not logger.handlers:
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
+    Excluded rows are left out of MAAS altogether; they keep whatever
+    deployment_status the caller gave them in the status files. With adaptive
+    (an AdaptiveConcurrency) machines are let in as it allows instead of all
+    at once, and it sees the latency of every MAAS call. With stage (a key of
+    STAGE_WINDOWS) only that stage is run, on the machines MAAS has at it
+    (see stage_plan); the others are left as the status file says they are.
+    """
+    try:
+        inventory = Inventory.load(csv_file, require_cloud_init=not cloud_init_template)
+        provisioned = inventory.without(exclude) if exclude else inventory
+        rows = provisioned.rows
 
-    return logger
+        limits = {stage: max_workers for stage in STAGES}
+        limits.update({stage: limit for stage, limit in (stage_limits or {}).items() if limit})
+        if adaptive:
+            client = ObservedClient(client, adaptive)
+        logger.info("Stage concurrency limits: " + ", ".join(f"{stage}={limit}" for stage, limit in limits.items()))
 
-def add_machines_from_csv(csv_file,maas_user,max_workers,cloud_init_template,preserve_cloud_init,ssh_user,storage_layout,storage_layout_template, logger):
-    try:
-        with open(csv_file, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            rows = list(reader)
-        
-        # Create machines
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = [executor.submit(create_machine, maas_user, row,logger) for row in rows]
-            results = [f.result() for f in futures]
-
-        # Deploy machines
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            executor.map(lambda args: configure_and_deploy(maas_user, *args, cloud_init_template,preserve_cloud_init,ssh_user,storage_layout,storage_layout_template,logger), results)
-        
-        save_csv(csv_file,rows,logger)
+        if storage_layout != "no":
+            storage_layout_template = storageLayout.LayoutSpec.load(storage_layout_template)
+        if enlist:
+            resume_points = plan_enlistment(client, provisioned, journal if resume else None, storage_layout, logger,
+                                            limits["create"], throttle, retries)
+        else:
+            resume_points = plan_resume(client, provisioned, journal, storage_layout, logger,
+                                        redo=(stage,) if stage else ()) if resume or stage else {}
+        if stage:
+            resume_points, left = stage_plan(resume_points, stage, logger)
+            provisioned = provisioned.without(left)
+            rows = provisioned.rows
+        # Each machine moves create -> commission -> storage -> deploy -> ssh on its own;
+        # commissioning and deploy waits are watches on one shared bulk status poller,
+        # and waiting for SSH is a probe on one shared prober.
+        poller = FleetPoller(client, logger, poll_min_interval, poll_max_interval).start()
+        prober = SshProber(ssh_user, logger, max_checks=limits["ssh"], **(ssh_probe or {})).start()
+        status = StatusWriter(inventory, logger, previous=RunState(inventory.path, journal.path if journal else None).previous()).start()
+        pipeline = Pipeline(limits, logger, on_node_done, journal, status, adaptive)
+        flow = ProvisioningFlow(client, poller, pipeline, cloud_init_template, preserve_cloud_init, prober, storage_layout, storage_layout_template, logger, throttle, spans, retries, provisioned,
+                                STAGE_WINDOWS[stage][1] if stage else None)
+        try:
+            pipeline.admit(rows, lambda row: flow.start(row, *resume_points.get(row["hostname"], ("create", None, None))))
+            pipeline.wait()
+        finally:
+            poller.stop()
+            prober.stop()
+            status.stop()
+            logger.info(f"Fleet poller made {poller.ticks} bulk status calls")
 
     except Exception as e:
         logger.error(f"Error reading CSV file: {str(e)}")
         raise
 
-def get_machine_status(maas_user, system_id):
-    result = subprocess.run(["maas", maas_user, "machine", "read", system_id], capture_output=True, text=True)
-    if result.returncode == 0:
-        machine_info = json.loads(result.stdout)
-        return machine_info.get("status_name", "Unknown")
-    return "Unknown"
-
-def wait_for_status(maas_user, system_id, expected_status, hostname,logger, timeout=600, interval=30):
-    elapsed = 0
-    while elapsed < timeout:
-        status = get_machine_status(maas_user, system_id)
-        logger.info(f"[{hostname}] Status: {status}")
-        if status == "Failed commissioning" or status == "Unknown":
-            return False
-        if status == expected_status:
-            return True
-        time.sleep(interval)
-        elapsed += interval
-    logger.warning(f"[{hostname}] Timeout waiting for status: {expected_status}")
-    return False
-
-def generate_cloud_init(template_file, output_file, ip, storage_ip):
-    with open(template_file, 'r') as f:
-        template = Template(f.read())
-    values = {"ip": ip}
-    if storage_ip:
-        values["storage_ip"] = storage_ip
-
-    rendered = template.safe_substitute(values)
-    rendered = template.safe_substitute(ip=ip, storage_ip=storage_ip)
-    with open(output_file, 'w') as f:
-        f.write(rendered)
-
-def create_machine(maas_user, row,logger):
-    hostname = row["hostname"]
-    architecture = row["architecture"]
-    mac_addresses = row["mac_addresses"]
-    power_type = row["power_type"]
+class CloudInitTemplates:
+    """Cloud-init templates compiled once per distinct path and shared by all workers.
+
+    A CSV usually points most rows at the same few templates, so each file is
+    read and parsed on first use only; a missing file is remembered as None.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
 
+    def get(self, template_file):
+        with self._lock:
+            if template_file not in self._templates:
+                template = None
+                if os.path.isfile(template_file):
+                    with open(template_file, 'r') as f:
+                        template = Template(f.read())
+                self._templates[template_file] = template
+            return self._templates[template_file]
+
+    def render(self, template_file, ip, storage_ip):
+        template = self.get(template_file)
+        if template is None:
+            return None
+        values = {"ip": ip}
+        if storage_ip:
+            values["storage_ip"] = storage_ip
+        return template.safe_substitute(values)
+
+cloud_init_templates = CloudInitTemplates()
+
+def machine_create_params(row):
     power_parameters = {
         "power_user": row["power_user"],
         "power_pass": row["power_pass"],
@@ -104,143 +117,439 @@ def create_machine(maas_user, row,logger):
         "privilege_level": row["privilege_level"],
         "k_g": row["k_g"]
     }
+    return {
+        "hostname": row["hostname"],
+        "architecture": row["architecture"],
+        "mac_addresses": row["mac_addresses"],
+        "power_type": row["power_type"],
+        "power_parameters": json.dumps(power_parameters)
+    }
+
+def created_machine(machines, row):
+    """The machine among machines that a create of row made: same hostname and one of its MACs."""
+    macs = {mac.strip().lower() for mac in row.get("mac_addresses", "").split(",") if mac.strip()}
+    for machine in machines:
+        if machine.get("hostname") != row["hostname"]:
+            continue
+        if not macs or macs & {(i.get("mac_address") or "").lower() for i in machine.get("interface_set") or []}:
+            return machine
+    return None
 
-    create_command = [
-        "maas", maas_user, "machines", "create",
-        f"hostname={hostname}",
-        f"architecture={architecture}",
-        f"mac_addresses={mac_addresses}",
-        f"power_type={power_type}",
-        f"power_parameters={json.dumps(power_parameters)}"
-    ]
+def already_in_progress(error):
+    """Recovery check for commission/deploy: a 409 after a timed-out attempt means that attempt went through."""
+    return {} if error.status == 409 else None
+
+def create_machine(client, row,logger, retry=None, span=None):
+    hostname = row["hostname"]
+
+    def already_created(error):
+        # An earlier attempt that timed out may have created the machine after all.
+        if "already exists" not in str(error):
+            return None
+        try:
+            return created_machine(client.call("machines", "read", hostname=hostname), row)
+        except MaasError:
+            return None
 
+    retry = retry or RetryPolicy("create", attempts=1)
     try:
-        result = subprocess.run(create_command, check=True, capture_output=True, text=True)
+        response = retry.call(lambda: client.call("machines", "create", **machine_create_params(row)),
+                              hostname, logger, span, already_created)
         logger.info(f"[{hostname}] Machine created.")
-        response = json.loads(result.stdout)
         return hostname, response.get("system_id"), row
-    except subprocess.CalledProcessError as e:
-        logger.error(f"[{hostname}] Error creating machine:{e.returncode}")
-        logger.error(f"STDERR: {e.stderr.strip()}")
-        logger.error(f"STDOUT: {e.stdout.strip()}")
+    except MaasError as e:
+        logger.error(f"[{hostname}] Error creating machine: {e}")
         return hostname, None, row
 
-def configure_and_deploy(maas_user, hostname, system_id, row, cloud_init_template,preserve_cloud_init,ssh_user,storage_layout,storage_layout_template,logger):
-    if not system_id:
-        logger.warning(f"[{hostname}] Skipping: no system_id.")
-        row["deployment_status"] = "System ID Missing Machine Was Not Created"
-        return
-
-    if wait_for_status(maas_user, system_id, "Ready", hostname,logger, 700, 30):
-        if storage_layout == "yes":
-            storageLayout.create_storage_layout(system_id,hostname,storage_layout_template,logger)
-        current_dir = os.getcwd()
-        temp_cloud_init_dir = os.path.join(current_dir, "maas-cloud-init")
-        os.makedirs(temp_cloud_init_dir, exist_ok=True)
-        temp_cloud_init = f"{temp_cloud_init_dir}/cloud-init-{hostname}.yaml"
-        storage_ip = row["storage_ip"] if "storage_ip" in row else None
-        if not cloud_init_template:
-            cloud_init_template = row.get("cloud_init")
-            if not cloud_init_template:
-                logger.error(f"[{hostname}] No cloud-init template provided via CSV. Skipping.")
-                row["deployment_status"] = "Cloud-init Template Missing"
-                return
-            if not os.path.isfile(cloud_init_template):
-                logger.error(f"[{hostname}] Cloud-init template file does not exist: {cloud_init_template}")
-                row["deployment_status"] = "Cloud-init Template Missing"
-                return
-        generate_cloud_init(cloud_init_template, temp_cloud_init, row["ip"], storage_ip)
+class ProvisioningFlow:
+    """The MAAS steps of a run, wired onto the stage pipeline one node at a time.
+
+    until, a resume point, is where a node stops (as Ready) instead of going
+    on to the end: wait_ready once commissioned, storage once its layout is done.
+    """
+
+    def __init__(self, client, poller, pipeline, cloud_init_template, preserve_cloud_init, prober, storage_layout, storage_layout_template, logger, throttle=None, spans=None, retries=None, inventory=None, until=None):
+        self.client = client
+        self.poller = poller
+        self.pipeline = pipeline
+        self.cloud_init_template = cloud_init_template
+        self.preserve_cloud_init = preserve_cloud_init
+        self.prober = prober
+        self.throttle = throttle or Throttle()
+        self.spans = spans or SpanRecorder()
+        self.retries = retries or Retries()
+        self.storage_layout = storage_layout
+        self.storage_layout_template = storage_layout_template
+        self.logger = logger
+        self.inventory = inventory
+        self.until = until
+
+    def start(self, row, resume_at="create", system_id=None, record=None):
+        node = Node(row)
+        node.system_id = system_id
+        node.onboarded = bool(record and record.done("onboarded"))
+        if resume_at == "create":
+            self.pipeline.add(node, "create", self.create)
+            return
+        self.logger.info(f"[{node.hostname}] Resuming at {resume_at} (system_id {system_id}).")
+        if resume_at == "done":
+            self.pipeline.add(node)
+            self.pipeline.finish(node, "Deployed")
+        elif resume_at == "commission":
+            self.pipeline.add(node, "create", self.commission)
+        elif resume_at == "wait_ready":
+            self.pipeline.add(node)
+            self.watch_commissioning(node)
+        elif resume_at in ("storage", "deploy", "ssh"):
+            self.pipeline.add(node, resume_at, getattr(self, {"ssh": "verify"}.get(resume_at, resume_at)))
+        elif resume_at == "wait_deployed":
+            self.pipeline.add(node)
+            self.watch_deployment(node)
+        else:
+            self.pipeline.add(node)
+            self.pipeline.finish(node, f"Not Resumed, MAAS Status {resume_at}")
+
+    def create(self, node):
+        with self.throttle.slot("create", node.row), self.spans.span(node.hostname, "create") as span:
+            _, node.system_id, _ = create_machine(self.client, node.row, self.logger, self.retries["create"], span)
+            span.outcome = "ok" if node.system_id else "failed"
+        if not node.system_id:
+            self.logger.warning(f"[{node.hostname}] Skipping: no system_id.")
+            self.pipeline.finish(node, "System ID Missing Machine Was Not Created")
+            return
+        if self.inventory:
+            self.inventory.bind(node.hostname, node.system_id)
+        self.pipeline.record(node, "created")
+        self.watch_commissioning(node)
+
+    def commission(self, node):
         try:
-            deploy_command = f'maas {maas_user} machine deploy {system_id} user_data="$(base64 -w 0 {temp_cloud_init})"'
-            subprocess.run(deploy_command, shell=True, check=True, capture_output=True, text=True)
-            logger.info(f"[{hostname}] Deploy triggered with cloud-init.")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"[{hostname}] Deploy failed:{e.returncode}")
-            logger.error(f"STDERR: {e.stderr.strip()}")
-            logger.error(f"STDOUT: {e.stdout.strip()}")
-            row["deployment_status"] = "Deploy Failed"
-            os.remove(temp_cloud_init)
+            with self.throttle.slot("create", node.row), self.spans.span(node.hostname, "commission") as span:
+                self.retries["commission"].call(lambda: self.client.call("machine", "commission", node.system_id),
+                                                node.hostname, self.logger, span, already_in_progress)
+            self.logger.info(f"[{node.hostname}] Commissioning started.")
+        except MaasError as e:
+            self.logger.error(f"[{node.hostname}] Commissioning failed to start: {e}")
+            self.pipeline.finish(node, "Not Ready,Commissioning Was Not Done")
             return
+        self.watch_commissioning(node)
+
+    def watch_commissioning(self, node):
+        self.poller.watch(node.system_id, "Ready", node.hostname, 700,
+                          self.timed(node, "commissioning", lambda ok, status: self.commissioned(node, ok, status)))
 
-        if wait_for_status(maas_user, system_id, "Deployed", hostname,logger, 1200, 60):
-            logger.info(f"[{hostname}] Deployment completed.")
-            update_ipmi_user(system_id, hostname,maas_user, row)
-            logger.info(f"[{hostname}] checking connectivity.")
-            max_wait = 60  
-            interval = 5   
-            elapsed = 0
-            while elapsed < max_wait:
-                if check_ssh_connection(row, ssh_user, hostname, logger):
-                    break
-                time.sleep(interval)
-                elapsed += interval
-            else:
-                logger.warning(f"[{hostname}] SSH connectivity check failed after {max_wait}s.")
-                row["deployment_status"] = "Deployed-Unreachable"
+    def timed(self, node, stage, callback):
+        """Wrap a wait callback so the wait is recorded as a span of node.
+
+        The callback runs on the poller or prober thread; if it raises, the
+        node is finished as failed, as a stage would be, so the run still ends.
+        """
+        span = self.spans.start(node.hostname, stage)
+
+        def done(ok, *args):
+            self.spans.end(span, "ok" if ok else (args[0] if args else "failed"))
+            with node_context(node):
+                try:
+                    callback(ok, *args)
+                except Exception as e:
+                    self.logger.error(f"[{node.hostname}] Unexpected error after {stage}: {e}")
+                    if node.finished is None:
+                        self.pipeline.finish(node, f"Error During {stage.capitalize()}")
+        return done
+
+    def commissioned(self, node, ok, status=None):
+        if not ok and status == "Failed commissioning" and node.commission_retries < self.retries.commission_retries:
+            node.commission_retries += 1
+            if self.pipeline.adaptive:
+                self.pipeline.adaptive.commission_failed()
+            self.logger.warning(f"[{node.hostname}] Failed commissioning, commissioning again "
+                                f"(retry {node.commission_retries} of {self.retries.commission_retries}).")
+            self.pipeline.advance(node, "create", self.commission)
+            return
+        if not ok:
+            self.logger.warning(f"[{node.hostname}] Not Ready. Skipping deployment.")
+            self.pipeline.finish(node, "Not Ready,Commissioning Was Not Done")
+            return
+        self.pipeline.record(node, "commissioned")
+        if self.until == "wait_ready":
+            self.pipeline.finish(node, "Ready")
+        elif self.storage_layout != "no":
+            self.pipeline.advance(node, "storage", self.storage)
         else:
-            logger.warning(f"[{hostname}] Did not reach Deployed state.")
-            row["deployment_status"] = "Deployment Timeout"
-        if preserve_cloud_init == "no" and os.path.exists(temp_cloud_init):
-            try:
-                os.remove(temp_cloud_init)
-            except Exception as e:
-                logger.warning(f"Failed to remove temp cloud-init file: {e}")
+            self.pipeline.advance(node, "deploy", self.deploy)
+
+    def storage(self, node):
+        with self.throttle.slot("storage", node.row), self.spans.span(node.hostname, "storage") as span:
+            ok = storageLayout.create_storage_layout(self.client, node.system_id, node.hostname, self.storage_layout_template, self.logger,
+                                                     dry_run=self.storage_layout == "plan", retry=self.retries["storage"], span=span)
+            if not ok:
+                span.outcome = "failed"
+        if self.storage_layout == "yes":
+            self.pipeline.record(node, "storage" if ok else "storage_failed")
+        if self.until == "storage":
+            self.pipeline.finish(node, "Ready")
+        else:
+            self.pipeline.advance(node, "deploy", self.deploy)
+
+    def deploy(self, node):
+        hostname = node.hostname
+        user_data = prepare_user_data(node, self.cloud_init_template, self.preserve_cloud_init, self.logger)
+        if not user_data:
+            self.pipeline.finish(node, "Cloud-init Template Missing")
+            return
+        try:
+            with self.throttle.slot("deploy", node.row), self.spans.span(hostname, "deploy") as span:
+                self.retries["deploy"].call(lambda: self.client.call("machine", "deploy", node.system_id, user_data=user_data),
+                                            hostname, self.logger, span, already_in_progress)
+            self.logger.info(f"[{hostname}] Deploy triggered with cloud-init.")
+        except MaasError as e:
+            self.logger.error(f"[{hostname}] Deploy failed: {e}")
+            self.pipeline.finish(node, "Deploy Failed")
+            return
+        self.pipeline.record(node, "deploy_started")
+        self.watch_deployment(node)
+
+    def watch_deployment(self, node):
+        self.poller.watch(node.system_id, "Deployed", node.hostname, 1200,
+                          self.timed(node, "deploying", lambda ok, status: self.deployed(node, ok, status)))
+
+    def deployed(self, node, ok, status=None):
+        if not ok:
+            self.logger.warning(f"[{node.hostname}] Did not reach Deployed state.")
+            self.pipeline.finish(node, "Deployment Failed" if status == "Failed deployment" else "Deployment Timeout")
+            return
+        self.logger.info(f"[{node.hostname}] Deployment completed.")
+        self.pipeline.record(node, "deployed")
+        self.pipeline.advance(node, "ssh", self.verify)
+
+    def verify(self, node):
+        hostname, row = node.hostname, node.row
+        with self.throttle.slot("power-update", row), self.spans.span(hostname, "power-update") as span:
+            update_ipmi_user(self.client, node.system_id, hostname, row, self.logger, self.retries["power-update"], span)
+        self.logger.info(f"[{hostname}] checking connectivity.")
+        self.prober.probe(row.get("ip"), hostname, self.timed(node, "ssh", lambda ok: self.verified(node, ok)))
+
+    def verified(self, node, ok):
+        if ok:
+            self.pipeline.record(node, "ssh")
+        self.pipeline.finish(node, "Deployed" if ok else "Deployed-Unreachable")
+
+def index_machines(machines):
+    """Hash the MAAS machine list by system_id, hostname and (lower-cased) MAC address."""
+    by_id, by_hostname, by_mac = {}, {}, {}
+    for machine in machines:
+        by_id[machine.get("system_id")] = machine
+        by_hostname[machine.get("hostname")] = machine
+        for interface in machine.get("interface_set") or []:
+            if interface.get("mac_address"):
+                by_mac[interface["mac_address"].lower()] = machine
+    return by_id, by_hostname, by_mac
+
+def find_machine(row, index, system_id=None):
+    by_id, by_hostname, by_mac = index
+    if system_id and system_id in by_id:
+        return by_id[system_id]
+    if row.get("hostname") in by_hostname:
+        return by_hostname[row["hostname"]]
+    for mac in row.get("mac_addresses", "").split(","):
+        if mac.strip().lower() in by_mac:
+            return by_mac[mac.strip().lower()]
+    return None
+
+def check_layout_fits(client, inventory, spec):
+    """Raise ValueError naming every machine MAAS already has whose boot disk the layout does not fit.
+
+    One bulk listing; machines MAAS does not have yet are checked in their
+    storage stage, once commissioning has reported their boot disk.
+    """
+    index = index_machines(client.call("machines", "read"))
+    errors = []
+    for row in inventory:
+        machine = find_machine(row, index) or {}
+        try:
+            spec.check_fits((machine.get("boot_disk") or {}).get("size"))
+        except ValueError as e:
+            errors.append(f"{row['hostname']}: {e}")
+    if errors:
+        raise ValueError("Storage layout does not fit: " + "; ".join(errors))
+
+# Where a resumed node can pick up, in pipeline order. resume_point() may also
+# return "done" (nothing left to do) or, for a status we cannot resume from,
+# the MAAS status itself.
+RESUME_POINTS = ["create", "commission", "wait_ready", "storage", "deploy", "wait_deployed", "ssh"]
+# The resume points each stage of main_script (provision, storage, deploy) runs, first to last.
+STAGE_WINDOWS = {"provision": ("create", "wait_ready"), "storage": ("storage", "storage"), "deploy": ("deploy", "ssh")}
+
+def resume_point(record, machine, storage_layout, redo=()):
+    """Where a resumed node picks up, judged from its journal record and its current MAAS status.
+
+    With "storage" in redo, a Ready machine gets its storage layout again even if the journal has it done.
+    """
+    if not machine:
+        return "create"
+    status = machine.get("status_name")
+    if status == "Deployed":
+        return "done" if record and record.status == "Deployed" else "ssh"
+    if status in ("New", "Failed commissioning"):
+        return "commission"
+    if status == "Commissioning":
+        return "wait_ready"
+    if status in ("Ready", "Allocated"):
+        if storage_layout != "no" and status == "Ready" and ("storage" in redo or not (record and record.done("storage"))):
+            return "storage"
+        return "deploy"
+    if status == "Deploying":
+        return "wait_deployed"
+    return status
+
+def plan_resume(client, inventory, journal, storage_layout, logger, redo=()):
+    """Match the inventory's rows to existing machines (one bulk listing) and decide where each resumes."""
+    records = load_journal(journal.path) if journal else {}
+    machines = client.call("machines", "read")
+    index = index_machines(machines)
+    points = {}
+    for row in inventory:
+        record = records.get(row["hostname"])
+        machine = find_machine(row, index, record.system_id if record else None)
+        system_id = machine.get("system_id") if machine else None
+        inventory.bind(row["hostname"], system_id)
+        points[row["hostname"]] = (resume_point(record, machine, storage_layout, redo), system_id, record)
+    log_plan("Resume plan", points, logger)
+    return points
+
+def stage_plan(points, stage, logger):
+    """Split a resume plan for one stage: (the points of the machines that run it, the hostnames left alone).
+
+    A machine runs the stage if it would resume inside the stage's window;
+    one that has not got that far yet, or is already past it (or in a MAAS
+    status no stage resumes from), is not touched.
+    """
+    first, last = (RESUME_POINTS.index(point) for point in STAGE_WINDOWS[stage])
+    run, left = {}, {}
+    for hostname, plan in points.items():
+        if plan[0] in RESUME_POINTS and first <= RESUME_POINTS.index(plan[0]) <= last:
+            run[hostname] = plan
+        else:
+            left[hostname] = plan
+    log_plan(f"{stage.capitalize()} stage plan", run, logger)
+    if left:
+        log_plan(f"Left alone by the {stage} stage", left, logger)
+    return run, set(left)
+
+def log_plan(label, points, logger):
+    summary = {}
+    for point, _, _ in points.values():
+        summary[point] = summary.get(point, 0) + 1
+    logger.info(f"{label}: " + ", ".join(f"{point}={count}" for point, count in sorted(summary.items())))
+
+# Machines per bulk `machines accept` call.
+ACCEPT_BATCH = 100
+
+def plan_enlistment(client, inventory, journal, storage_layout, logger, max_workers, throttle=None, retries=None):
+    """--enlist: adopt the machines MAAS already enlisted by itself (PXE booted, status New) instead of creating them.
+
+    One bulk listing is hashed by MAC address and every CSV row is matched
+    to the machine owning one of its MACs (or, with a journal, the machine it
+    recorded). Matched New machines are renamed and given the CSV's power
+    settings (at most max_workers at a time), then accepted, which starts
+    their commissioning, with one `machines accept` per ACCEPT_BATCH
+    machines. Rows without a machine are created as usual; machines past New
+    pick up where resume_point() says.
+    """
+    records = load_journal(journal.path) if journal else {}
+    by_id, _, by_mac = index_machines(client.call("machines", "read"))
+    retries = retries or Retries()
+    points, enlisted = {}, []
+    for row in inventory:
+        record = records.get(row["hostname"])
+        machine = by_id.get(record.system_id) if record and record.system_id else None
+        machine = machine or next((by_mac[mac] for mac in row_macs(row) if mac in by_mac), None)
+        system_id = machine.get("system_id") if machine else None
+        inventory.bind(row["hostname"], system_id)
+        if machine and machine.get("status_name") == "New":
+            enlisted.append((row, system_id))
+        else:
+            if machine and machine.get("hostname") != row["hostname"]:
+                logger.warning(f"[{row['hostname']}] MAC matches machine {system_id} named "
+                               f"{machine.get('hostname')} in MAAS ({machine.get('status_name')}).")
+            points[row["hostname"]] = (resume_point(record, machine, storage_layout), system_id, record)
+
+    def adopt(item):
+        row, system_id = item
+        params = {key: value for key, value in machine_create_params(row).items() if key != "mac_addresses"}
+        try:
+            with (throttle or Throttle()).slot("create", row):
+                retries["create"].call(lambda: client.call("machine", "update", system_id, **params),
+                                       row["hostname"], logger)
+            return system_id
+        except MaasError as e:
+            logger.error(f"[{row['hostname']}] Error adopting enlisted machine {system_id}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="enlist") as pool:
+        adopted = [system_id for system_id in pool.map(adopt, enlisted) if system_id]
+    adopted_ids = set(adopted)
+    accepted = set()
+    if throttle and "create" in throttle.limits:
+        # A bulk accept would power on a whole batch at once, past the per-BMC create limits.
+        logger.info("Create operations are throttled; enlisted machines are commissioned one at a time.")
     else:
-        logger.warning(f"[{hostname}] Not Ready. Skipping deployment.")
-        row["deployment_status"] = "Not Ready,Commissioning Was Not Done"
-
-def check_ssh_connection(row,ssh_user,hostname,logger):
-    ip = row.get("ip")
-    home = os.getenv("HOME")
-    ssh_private_key_file = f"{home}/.ssh/id_rsa"
-    # Try SSH connectivity
-    ssh_command = [
-        "ssh", "-o", "StrictHostKeyChecking=no",
-        "-o", "ConnectTimeout=30",
-        "-i", ssh_private_key_file,
-        f"{ssh_user}@{ip}", "echo", "SSH_OK"
-        ]
-    try:
-        result = subprocess.run(ssh_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if result.returncode == 0 and "SSH_OK" in result.stdout:
-            logger.info(f"[{hostname}] SSH connectivity verified.")
-            row["deployment_status"] = "Deployed"
-            return True
+        for i in range(0, len(adopted), ACCEPT_BATCH):
+            batch = adopted[i:i + ACCEPT_BATCH]
+            try:
+                result = retries["commission"].call(lambda: client.call("machines", "accept", machines=batch),
+                                                    "enlist", logger)
+                # MAAS answers with the machines whose status changed (ids or machine objects).
+                accepted.update(m.get("system_id") if isinstance(m, dict) else m for m in result or [])
+            except MaasError as e:
+                logger.error(f"Bulk accept of {len(batch)} enlisted machines failed, commissioning them one at a time: {e}")
+    for row, system_id in enlisted:
+        if system_id not in adopted_ids:
+            points[row["hostname"]] = ("New", system_id, records.get(row["hostname"]))
         else:
-            logger.info(f"[{hostname}] SSH not ready yet. Retrying...")
-            return False
-    except Exception as e:
-        logger.info(f"[{hostname}] SSH check raised exception: {e}. Retrying...")
-        return False
+            point = "wait_ready" if system_id in accepted else "commission"
+            points[row["hostname"]] = (point, system_id, records.get(row["hostname"]))
+    logger.info(f"Enlistment: {len(enlisted)} machines found already enlisted, {len(adopted)} adopted, "
+                f"{len(accepted)} accepted in bulk")
+    log_plan("Enlistment plan", points, logger)
+    return points
 
-def update_ipmi_user(system_id, hostname,maas_user, row):
-    power_params = json.dumps({
+def prepare_user_data(node, cloud_init_template, preserve_cloud_init, logger):
+    """Render the machine's cloud-init in memory and return it base64-encoded, or None if no template is usable.
+
+    The rendered file is only written (to maas-cloud-init/) when preserve_cloud_init is yes.
+    """
+    hostname, row = node.hostname, node.row
+    storage_ip = row["storage_ip"] if "storage_ip" in row else None
+    if not cloud_init_template:
+        cloud_init_template = row.get("cloud_init")
+        if not cloud_init_template:
+            logger.error(f"[{hostname}] No cloud-init template provided via CSV. Skipping.")
+            return None
+    rendered = cloud_init_templates.render(cloud_init_template, row["ip"], storage_ip)
+    if rendered is None:
+        logger.error(f"[{hostname}] Cloud-init template file does not exist: {cloud_init_template}")
+        return None
+    if preserve_cloud_init == "yes":
+        cloud_init_dir = os.path.join(os.getcwd(), "maas-cloud-init")
+        os.makedirs(cloud_init_dir, exist_ok=True)
+        node.cloud_init_file = f"{cloud_init_dir}/cloud-init-{hostname}.yaml"
+        with open(node.cloud_init_file, 'w') as f:
+            f.write(rendered)
+    return base64.b64encode(rendered.encode()).decode()
+
+def ipmi_user_params(row):
+    return json.dumps({
         "power_user": row["power_user"],
         "power_pass": row["power_pass"]
     })
-    update_command = [
-        "maas", maas_user, "machine", "update", system_id,
-        f"power_parameters={power_params}"
-    ]
-    try:
-        subprocess.run(update_command, check=True, capture_output=True, text=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to update IPMI user for {hostname}: {str(e)}")
-
-def save_csv(csv_file, rows, logger):
-    base, ext = os.path.splitext(csv_file)
-    new_csv_file = f"{base}_updated{ext}"
-    fieldnames = list(rows[0].keys())
-    if "deployment_status" not in fieldnames:
-        fieldnames.append("deployment_status")
 
+def update_ipmi_user(client, system_id, hostname, row, logger, retry=None, span=None):
+    retry = retry or RetryPolicy("power-update", attempts=1)
     try:
-        with open(new_csv_file, "w", newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
-        logger.info(f"Updated CSV with deployment status at {new_csv_file}")
-    except Exception as e:
-        logger.error(f"Error writing to CSV: {str(e)}")
+        retry.call(lambda: client.call("machine", "update", system_id, power_parameters=ipmi_user_params(row)),
+                   hostname, logger, span)
+    except MaasError as e:
+        logger.warning(f"[{hostname}] Failed to update IPMI user: {e}")
 
 
@@ -0,0 +1,469 @@
+import re
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+STUB_API_KEY = "stub:stub:stub"
+DEFAULT_DISK_SIZE = 500 * 1024**3
+
+ROUTE_PATTERNS = [
+    ("machines", re.compile(r"^machines/$")),
+    ("machine", re.compile(r"^machines/(?P<node>[^/]+)/$")),
+    ("block-devices", re.compile(r"^nodes/(?P<node>[^/]+)/blockdevices/$")),
+    ("block-device", re.compile(r"^nodes/(?P<node>[^/]+)/blockdevices/(?P<device>\d+)/$")),
+    ("partitions", re.compile(r"^nodes/(?P<node>[^/]+)/blockdevices/(?P<device>\d+)/partitions/$")),
+    ("partition", re.compile(r"^nodes/(?P<node>[^/]+)/blockdevices/(?P<device>\d+)/partition/(?P<part>\d+)/?$")),
+    ("subnets", re.compile(r"^subnets/$")),
+    ("volume-groups", re.compile(r"^nodes/(?P<node>[^/]+)/volume-groups/$")),
+    ("volume-group", re.compile(r"^nodes/(?P<node>[^/]+)/volume-group/(?P<vg>\d+)/$")),
+]
+
+
+def human_bytes(size):
+    """Read a size the way MAAS does: plain bytes or a K/M/G/T suffix in powers of 1000."""
+    size = str(size).strip().upper()
+    multiplier = {"K": 1000, "M": 1000**2, "G": 1000**3, "T": 1000**4}.get(size[-1:], 1)
+    return int(float(size.rstrip("KMGT") or 0) * multiplier)
+
+
+class StubError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MaasStubState:
+    """In-memory MAAS region: machines, their lifecycle timers and storage objects.
+
+    To simulate a real region at scale, commissioning and deployment take
+    commission_seconds / deploy_seconds, each stretched or shortened at random
+    by up to +-jitter (a fraction), and end in "Failed commissioning" /
+    "Failed deployment" with the given failure rates. Every API call takes
+    api_latency seconds (also jittered) and fails with HTTP 503 at
+    api_error_rate. seed makes a simulation repeatable.
+    """
+
+    def __init__(self, commission_seconds=0.0, deploy_seconds=0.0, disk_size=DEFAULT_DISK_SIZE, jitter=0.0,
+                 commission_failure_rate=0.0, deploy_failure_rate=0.0, api_latency=0.0, api_error_rate=0.0,
+                 seed=None):
+        self.commission_seconds = commission_seconds
+        self.deploy_seconds = deploy_seconds
+        self.disk_size = disk_size
+        self.jitter = jitter
+        self.commission_failure_rate = commission_failure_rate
+        self.deploy_failure_rate = deploy_failure_rate
+        self.api_latency = api_latency
+        self.api_error_rate = api_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.machines = {}
+        self.subnets = []
+        self.calls = Counter()
+        self.errors_injected = 0
+        self._next_id = 1
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _latency(self, seconds):
+        return max(0.0, seconds * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def _schedule(self, machine, seconds, status, failed_status, failure_rate):
+        outcome = failed_status if self.random.random() < failure_rate else status
+        machine["_transition"] = (time.monotonic() + self._latency(seconds), outcome)
+
+    def stats(self):
+        return {"calls": {" ".join(filter(None, key)): count for key, count in self.calls.most_common()},
+                "total_calls": sum(self.calls.values()),
+                "errors_injected": self.errors_injected,
+                "machines": dict(Counter(self._public(m)["status_name"] for m in self.machines.values()))}
+
+    def _refresh(self, machine):
+        transition = machine.get("_transition")
+        if transition and time.monotonic() >= transition[0]:
+            machine["status_name"] = transition[1]
+            machine.pop("_transition")
+
+    def _public(self, machine):
+        self._refresh(machine)
+        return {k: v for k, v in machine.items() if not k.startswith("_")}
+
+    def _machine(self, system_id):
+        machine = self.machines.get(system_id)
+        if not machine:
+            raise StubError(404, "No Machine matches the given query.")
+        return machine
+
+    def add_machine(self, hostname, mac_addresses="", status_name="Commissioning", **extra):
+        system_id = f"stub{len(self.machines) + 1:04d}"
+        disk_id = self._new_id()
+        machine = {
+            "system_id": system_id,
+            "hostname": hostname,
+            "status_name": status_name,
+            "interface_set": [{"mac_address": mac} for mac in mac_addresses.split(",") if mac],
+            "boot_disk": {"id": disk_id, "size": self.disk_size},
+            "_devices": {disk_id: {"id": disk_id, "name": "sda", "type": "physical", "size": self.disk_size,
+                                   "partitions": {}}},
+            "_vgs": {},
+        }
+        machine.update(extra)
+        if status_name == "Commissioning":
+            self._schedule(machine, self.commission_seconds, "Ready", "Failed commissioning",
+                           self.commission_failure_rate)
+        self.machines[system_id] = machine
+        return machine
+
+    def handle(self, method, route, ids, params):
+        op = params.pop("op", [None])[0]
+        if self.api_latency:
+            time.sleep(self._latency(self.api_latency))
+        with self.lock:
+            self.calls[(method, route, op)] += 1
+            if self.api_error_rate and self.random.random() < self.api_error_rate:
+                self.errors_injected += 1
+                raise StubError(503, "Service Unavailable (injected by the stub)")
+            handler = getattr(self, f"_{route.replace('-', '_')}_{(op or method).lower()}", None)
+            if not handler:
+                raise StubError(405, f"{method} {route} op={op} is not supported by the stub")
+            return handler(ids, params)
+
+    # machines
+    def _machines_get(self, ids, params):
+        wanted = set(params.get("id", []))
+        hostnames = set(params.get("hostname", []))
+        macs = set(params.get("mac_address", []))
+        result = []
+        for machine in self.machines.values():
+            if wanted and machine["system_id"] not in wanted:
+                continue
+            if hostnames and machine["hostname"] not in hostnames:
+                continue
+            if macs and not macs & {i["mac_address"] for i in machine["interface_set"]}:
+                continue
+            result.append(self._public(machine))
+        return result
+
+    def _machines_post(self, ids, params):
+        hostname = params.get("hostname", [""])[0]
+        if any(m["hostname"] == hostname for m in self.machines.values()):
+            raise StubError(400, json.dumps({"hostname": [f"Node with hostname \"{hostname}\" already exists."]}))
+        return self._public(self.add_machine(hostname, params.get("mac_addresses", [""])[0],
+                                             power_type=params.get("power_type", [""])[0]))
+
+    def _machines_accept(self, ids, params):
+        accepted = []
+        for system_id in params.get("machines", []):
+            machine = self._machine(system_id)
+            self._refresh(machine)
+            if machine["status_name"] == "New":
+                machine["status_name"] = "Commissioning"
+                self._schedule(machine, self.commission_seconds, "Ready", "Failed commissioning",
+                               self.commission_failure_rate)
+                accepted.append(self._public(machine))
+        return accepted
+
+    def enlist(self, mac_addresses):
+        """Add a machine the way MAAS enlists one that PXE booted on its own: New, with a made-up hostname."""
+        return self.add_machine(f"enlisted-{len(self.machines) + 1:04d}", mac_addresses, status_name="New")
+
+    def _machine_get(self, ids, params):
+        return self._public(self._machine(ids["node"]))
+
+    def _machine_put(self, ids, params):
+        machine = self._machine(ids["node"])
+        for key in ("hostname", "power_type", "architecture"):
+            if key in params:
+                machine[key] = params[key][0]
+        return self._public(machine)
+
+    def _machine_delete(self, ids, params):
+        self._machine(ids["node"])
+        del self.machines[ids["node"]]
+        return {}
+
+    def _machine_deploy(self, ids, params):
+        machine = self._machine(ids["node"])
+        self._refresh(machine)
+        if machine["status_name"] not in ("Ready", "Allocated"):
+            raise StubError(409, f"Machine is in state {machine['status_name']}, cannot deploy.")
+        machine["status_name"] = "Deploying"
+        machine["_user_data"] = params.get("user_data", [""])[0]
+        self._schedule(machine, self.deploy_seconds, "Deployed", "Failed deployment", self.deploy_failure_rate)
+        return self._public(machine)
+
+    def _machine_commission(self, ids, params):
+        machine = self._machine(ids["node"])
+        machine["status_name"] = "Commissioning"
+        self._schedule(machine, self.commission_seconds, "Ready", "Failed commissioning",
+                       self.commission_failure_rate)
+        return self._public(machine)
+
+    def _subnets_get(self, ids, params):
+        return list(self.subnets)
+
+    # storage
+    def _device(self, ids):
+        device = self._machine(ids["node"])["_devices"].get(int(ids["device"]))
+        if not device:
+            raise StubError(404, "No BlockDevice matches the given query.")
+        return device
+
+    def _device_view(self, device):
+        view = {k: v for k, v in device.items() if k != "partitions"}
+        view["partitions"] = list(device["partitions"].values())
+        return view
+
+    def _block_devices_get(self, ids, params):
+        return [self._device_view(d) for d in self._machine(ids["node"])["_devices"].values()]
+
+    def _block_device_delete(self, ids, params):
+        machine = self._machine(ids["node"])
+        device = self._device(ids)
+        del machine["_devices"][device["id"]]
+        for vg in machine["_vgs"].values():
+            vg["logical_volumes"] = [lv for lv in vg["logical_volumes"] if lv["id"] != device["id"]]
+        return {}
+
+    def _block_device_format(self, ids, params):
+        device = self._device(ids)
+        device["filesystem"] = {"fstype": params.get("fstype", [""])[0], "mount_point": None}
+        return self._device_view(device)
+
+    def _block_device_unmount(self, ids, params):
+        device = self._device(ids)
+        (device.get("filesystem") or {})["mount_point"] = None
+        return self._device_view(device)
+
+    def _block_device_mount(self, ids, params):
+        device = self._device(ids)
+        device.setdefault("filesystem", {})["mount_point"] = params.get("mount_point", [""])[0]
+        return self._device_view(device)
+
+    def _partitions_get(self, ids, params):
+        return list(self._device(ids)["partitions"].values())
+
+    def _partitions_post(self, ids, params):
+        device = self._device(ids)
+        size = int(params.get("size", ["0"])[0] or 0)
+        used = sum(p["size"] for p in device["partitions"].values())
+        if size > device["size"] - used:
+            raise StubError(400, json.dumps({"size": ["Partition is larger than the free space on the device."]}))
+        part_id = self._new_id()
+        device["partitions"][part_id] = {"id": part_id, "size": size, "filesystem": None,
+                                         "bootable": params.get("bootable", ["false"])[0] == "true"}
+        return device["partitions"][part_id]
+
+    def _partition(self, ids):
+        part = self._device(ids)["partitions"].get(int(ids["part"]))
+        if not part:
+            raise StubError(404, "No Partition matches the given query.")
+        return part
+
+    def _partition_delete(self, ids, params):
+        del self._device(ids)["partitions"][self._partition(ids)["id"]]
+        return {}
+
+    def _partition_format(self, ids, params):
+        part = self._partition(ids)
+        part["filesystem"] = {"fstype": params.get("fstype", [""])[0], "mount_point": None}
+        return part
+
+    def _partition_unmount(self, ids, params):
+        part = self._partition(ids)
+        (part["filesystem"] or {})["mount_point"] = None
+        return part
+
+    def _partition_mount(self, ids, params):
+        part = self._partition(ids)
+        (part["filesystem"] or part.setdefault("filesystem", {}))["mount_point"] = params.get("mount_point", [""])[0]
+        return part
+
+    def _vg_view(self, machine, vg):
+        view = dict(vg)
+        view["devices"] = [{"id": p} for p in vg["partitions"]]
+        view["logical_volumes"] = [dict(lv, filesystem=machine["_devices"].get(lv["id"], {}).get("filesystem"))
+                                   for lv in vg["logical_volumes"]]
+        return view
+
+    def _volume_groups_get(self, ids, params):
+        machine = self._machine(ids["node"])
+        return [self._vg_view(machine, vg) for vg in machine["_vgs"].values()]
+
+    def _volume_groups_post(self, ids, params):
+        machine = self._machine(ids["node"])
+        vg_id = self._new_id()
+        partitions = [int(p) for p in params.get("partitions", [])]
+        size = sum(p["size"] for d in machine["_devices"].values()
+                   for pid, p in d["partitions"].items() if pid in partitions)
+        machine["_vgs"][vg_id] = {"id": vg_id, "name": params.get("name", [""])[0], "size": size,
+                                  "partitions": partitions, "logical_volumes": []}
+        return machine["_vgs"][vg_id]
+
+    def _vg(self, ids):
+        vg = self._machine(ids["node"])["_vgs"].get(int(ids["vg"]))
+        if not vg:
+            raise StubError(404, "No VolumeGroup matches the given query.")
+        return vg
+
+    def _volume_group_get(self, ids, params):
+        return self._vg_view(self._machine(ids["node"]), self._vg(ids))
+
+    def _volume_group_delete(self, ids, params):
+        machine = self._machine(ids["node"])
+        vg = self._vg(ids)
+        for lv in vg["logical_volumes"]:
+            machine["_devices"].pop(lv["id"], None)
+        del machine["_vgs"][vg["id"]]
+        return {}
+
+    def _volume_group_create_logical_volume(self, ids, params):
+        machine = self._machine(ids["node"])
+        vg = self._vg(ids)
+        lv_id = self._new_id()
+        name = f"{vg['name']}-{params.get('name', [''])[0]}"
+        size = human_bytes(params.get("size", ["0"])[0])
+        lv = {"id": lv_id, "name": name, "size": size}
+        vg["logical_volumes"].append(lv)
+        machine["_devices"][lv_id] = {"id": lv_id, "name": name, "type": "virtual", "size": size, "partitions": {}}
+        return lv
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        state = self.server.state
+        parts = urlsplit(self.path)
+        params = parse_qs(parts.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(parse_qs(self.rfile.read(length).decode(), keep_blank_values=True))
+        try:
+            if parts.path.endswith("/_stub/stats"):
+                # Not MAAS API: lets a benchmark read the call counts after a run.
+                with state.lock:
+                    status, payload = 200, state.stats()
+            else:
+                if not self.headers.get("Authorization", "").startswith("OAuth "):
+                    raise StubError(401, "Authorization required")
+                path = parts.path.split("/api/2.0/", 1)[-1]
+                for route, pattern in ROUTE_PATTERNS:
+                    match = pattern.match(path)
+                    if match:
+                        status, payload = 200, state.handle(self.command, route, match.groupdict(), params)
+                        break
+                else:
+                    raise StubError(404, f"Unknown path {parts.path}")
+        except StubError as e:
+            status, payload = e.status, str(e)
+        body = (json.dumps(payload) if not isinstance(payload, str) else payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json" if status < 400 else "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+
+class MaasStubServer:
+    """Local HTTP server speaking enough of the MAAS 2.0 API for the provisioning workflow.
+
+    Point the tool at it with `--maas_url <server.url> --maas_api_key stub:stub:stub`.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, state=None):
+        self.state = state or MaasStubState()
+        self.httpd = ThreadingHTTPServer((host, port), _StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/MAAS/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="maas-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def fake_cli(argv, url, api_key=STUB_API_KEY):
+    """Run `maas <profile> <resource> <action> [ids...] [key=value...]` against a stub (or any MAAS) URL.
+
+    Prints the JSON result like the real CLI and returns its exit status, so a
+    two-line `maas` script on PATH turns the stub into a fake MAAS CLI.
+    """
+    from modules.maasClient import MaasApiClient, MaasError
+    if len(argv) < 3:
+        print("usage: maas <profile> <resource> <action> [ids...] [key=value...]", file=sys.stderr)
+        return 2
+    _, resource, action, *rest = argv
+    ids = [arg for arg in rest if "=" not in arg]
+    params = {}
+    for arg in rest:
+        if "=" in arg:
+            key, _, value = arg.partition("=")
+            params.setdefault(key, []).append(value)
+    client = MaasApiClient(url, api_key, pool_size=1)
+    try:
+        print(json.dumps(client.call(resource, action, *ids, **params), indent=4))
+        return 0
+    except MaasError as e:
+        print(e.body or str(e), file=sys.stderr)
+        return 2
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local MAAS API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5240)
+    parser.add_argument("--commission_seconds", type=float, default=5.0)
+    parser.add_argument("--deploy_seconds", type=float, default=10.0)
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +- fraction applied to every latency")
+    parser.add_argument("--commission_failure_rate", type=float, default=0.0)
+    parser.add_argument("--deploy_failure_rate", type=float, default=0.0)
+    parser.add_argument("--api_latency", type=float, default=0.0, help="Seconds every API call takes")
+    parser.add_argument("--api_error_rate", type=float, default=0.0, help="Fraction of API calls answered with HTTP 503")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--enlisted", help="CSV whose machines the stub starts with, enlisted as New")
+    args = parser.parse_args()
+    server = MaasStubServer(args.host, args.port, MaasStubState(
+        args.commission_seconds, args.deploy_seconds, jitter=args.jitter,
+        commission_failure_rate=args.commission_failure_rate, deploy_failure_rate=args.deploy_failure_rate,
+        api_latency=args.api_latency, api_error_rate=args.api_error_rate, seed=args.seed))
+    if args.enlisted:
+        with open(args.enlisted, newline="") as f:
+            for row in csv.DictReader(f):
+                server.state.enlist(row["mac_addresses"])
+    print(f"MAAS stub listening on {server.url} (api key {STUB_API_KEY})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
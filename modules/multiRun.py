@@ -0,0 +1,204 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.logPipeline import setup_logger
+from modules.statusWriter import read_status, status_path
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_SCRIPT = os.path.join(REPO_DIR, "main_script.py")
+PCD_DIR = "pcd_ansible-pcd_develop"
+VARS_TEMPLATE = "vars_template.j2"
+# main_script options every target needs, from the target itself or the manifest defaults.
+REQUIRED_OPTIONS = ("maas_user", "csv_filename", "portal", "region", "environment", "url", "ssh_user", "max_workers")
+# Input files given relative to the manifest; they are passed on as absolute paths.
+PATH_OPTIONS = ("cloud_init_template", "storage_layout_template")
+
+
+class Target:
+    """One (portal, region, environment, CSV) run of main_script, in its own workspace."""
+
+    def __init__(self, options, manifest_dir):
+        self.options = dict(options)
+        self.name = self.options.pop("name", None) or "-".join(
+            str(self.options.get(key)) for key in ("portal", "region", "environment"))
+        self.manifest_dir = manifest_dir
+        self.workspace = None
+
+    @property
+    def log_path(self):
+        return os.path.join(self.workspace, "run.log")
+
+    @property
+    def csv_path(self):
+        return os.path.join(self.workspace, os.path.basename(self.options["csv_filename"]))
+
+    def source(self, path):
+        return path if os.path.isabs(path) else os.path.join(self.manifest_dir, path)
+
+    def command(self):
+        command = [sys.executable, MAIN_SCRIPT]
+        for key, value in self.options.items():
+            if key == "csv_filename":
+                value = os.path.basename(value)
+            elif key in PATH_OPTIONS:
+                value = os.path.abspath(self.source(value))
+            for item in value if isinstance(value, list) else [value]:
+                command += [f"--{key}", str(item)]
+        return command
+
+
+def load_manifest(path):
+    """Read a JSON manifest {"defaults": {...}, "targets": [{...}, ...]} into Targets (raises ValueError).
+
+    Every key is a main_script option (without the dashes); a list value
+    repeats the option (--throttle, --retry). A target may have a "name",
+    which is also its workspace directory (default: portal-region-environment).
+    """
+    with open(path) as f:
+        try:
+            manifest = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid manifest {path}: {e}")
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get("defaults", {})
+    targets = [Target({**defaults, **options}, manifest_dir) for options in manifest.get("targets", [])]
+    errors = [] if targets else ["no targets"]
+    seen = set()
+    for i, target in enumerate(targets, 1):
+        missing = [key for key in REQUIRED_OPTIONS if key not in target.options]
+        if missing:
+            errors.append(f"target {i} ({target.name}): missing {', '.join(missing)}")
+        elif not os.path.isfile(target.source(target.options["csv_filename"])):
+            errors.append(f"target {i} ({target.name}): CSV file {target.options['csv_filename']} does not exist")
+        if target.name in seen:
+            errors.append(f"target {i}: more than one target named {target.name}")
+        seen.add(target.name)
+    if errors:
+        raise ValueError(f"Invalid manifest {path}: " + "; ".join(errors))
+    return targets
+
+
+def prepare_workspace(target, workspace_dir, source_dir):
+    """Give target a working directory of its own.
+
+    main_script and pcdExpress work relative to the current directory: vars.yaml,
+    the host onboarding template, user_configs/<portal>/<region>/, deploy_logs/,
+    the journal and the status files all live there. Each workspace therefore
+    gets its own copy of pcd_ansible-pcd_develop (made once and kept, so later
+    runs find the environment already set up), of vars_template.j2, of the
+    CSV and of the cloud-init templates its rows name by relative path
+    (looked up next to the CSV, then in source_dir).
+    """
+    target.workspace = os.path.abspath(os.path.join(workspace_dir, target.name))
+    os.makedirs(target.workspace, exist_ok=True)
+    pcd_dir = os.path.join(target.workspace, PCD_DIR)
+    if not os.path.isdir(pcd_dir):
+        shutil.copytree(os.path.join(source_dir, PCD_DIR), pcd_dir, symlinks=True)
+    shutil.copyfile(os.path.join(source_dir, VARS_TEMPLATE), os.path.join(target.workspace, VARS_TEMPLATE))
+    csv_source = target.source(target.options["csv_filename"])
+    shutil.copyfile(csv_source, target.csv_path)
+    with open(csv_source, newline='') as f:
+        templates = {row.get("cloud_init") for row in csv.DictReader(f)}
+    for template in sorted(t for t in templates if t and not os.path.isabs(t)):
+        for directory in (os.path.dirname(csv_source), source_dir):
+            source = os.path.join(directory, template)
+            if os.path.isfile(source):
+                os.makedirs(os.path.dirname(os.path.join(target.workspace, template)), exist_ok=True)
+                shutil.copyfile(source, os.path.join(target.workspace, template))
+                break
+
+
+class MultiRun:
+    """Runs several targets at once, each main_script in its own workspace and process."""
+
+    def __init__(self, targets, workspace_dir, logger, max_parallel=None, source_dir=None):
+        self.targets = targets
+        self.workspace_dir = workspace_dir
+        self.logger = logger
+        self.max_parallel = max_parallel or len(targets)
+        self.source_dir = source_dir or os.getcwd()
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def run(self):
+        for target in self.targets:
+            prepare_workspace(target, self.workspace_dir, self.source_dir)
+        with ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="target") as pool:
+            try:
+                return list(pool.map(self.run_target, self.targets))
+            except KeyboardInterrupt:
+                self.stop()
+                raise
+
+    def run_target(self, target):
+        started = time.monotonic()
+        self.logger.info(f"[{target.name}] Starting in {target.workspace}, output in {target.log_path}")
+        with open(target.log_path, "ab") as log, self._lock:
+            if self._stopping:
+                return self.result(target, None, 0)
+            process = subprocess.Popen(target.command(), cwd=target.workspace, stdout=log,
+                                       stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+            self._processes[target.name] = process
+        returncode = process.wait()
+        result = self.result(target, returncode, time.monotonic() - started)
+        counts = ", ".join(f"{status} {count}" for status, count in result["statuses"].items()) or "no status"
+        log = self.logger.info if returncode == 0 else self.logger.error
+        log(f"[{target.name}] Finished with exit code {returncode} after {result['seconds']}s: {counts}")
+        return result
+
+    def result(self, target, returncode, seconds):
+        try:
+            status = read_status(status_path(target.csv_path)) or {}
+        except (OSError, ValueError):
+            status = {}
+        return {"name": target.name, "portal": target.options.get("portal"), "region": target.options.get("region"),
+                "environment": target.options.get("environment"), "returncode": returncode,
+                "seconds": round(seconds, 1), "statuses": status.get("counts", {}), "workspace": target.workspace,
+                "log": target.log_path}
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            for process in self._processes.values():
+                if process.poll() is None:
+                    process.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Provision and onboard several portals/regions/environments at once")
+    parser.add_argument("-manifest", "--manifest", required=True, help="JSON manifest of the targets to run")
+    parser.add_argument("-workspace_dir", "--workspace_dir", default="workspaces", help="Directory holding one workspace per target (default: workspaces)")
+    parser.add_argument("-max_parallel", "--max_parallel", type=int, required=False, help="Maximum targets running at once (default: all)")
+    parser.add_argument("-results", "--results", required=False, help="JSON file the per-target results are written to (default: <workspace_dir>/results.json)")
+    args = parser.parse_args(argv)
+    try:
+        targets = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    for name in (PCD_DIR, VARS_TEMPLATE):
+        if not os.path.exists(name):
+            parser.error(f"{name} does not exist in the current directory")
+
+    logger = setup_logger("multi_run_logger", log_file="multi_run.log")
+    logger.info(f"Running {len(targets)} targets: {', '.join(target.name for target in targets)}")
+    results = MultiRun(targets, args.workspace_dir, logger, args.max_parallel).run()
+    results_path = args.results or os.path.join(args.workspace_dir, "results.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    failed = [result["name"] for result in results if result["returncode"] != 0]
+    logger.info(f"{len(results) - len(failed)} of {len(results)} targets succeeded, results in {results_path}"
+                + (f"; failed: {', '.join(failed)}" if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,30 +1,42 @@
 import os
 import csv
 import re
-import subprocess
 import sys
-from jinja2 import Environment, FileSystemLoader
+import time
+import queue
+import threading
+from modules.timing import SpanRecorder
+from modules.onboardExecutor import OnboardingExecutor
+from modules.renderService import render_service
+from modules.stepCache import StepCache
+from modules.statusWriter import read_status, status_path, updated_csv_path
+
+HOST_TEMPLATE = "user_resource_examples/templates/host_onboard_data.yaml.j2"
+# Step, shard and per-host onboarding output, and the vars file each run rendered.
+ONBOARD_LOG_DIR = "deploy_logs/onboard"
+# Inputs and outputs of the cached pcdExpress steps, in ONBOARD_LOG_DIR.
+STEP_CACHE_FILE = "step_cache.json"
 
 def prepare_hosts_from_csv(csv_file, ssh_user, home, logger):
-    base, ext = os.path.splitext(csv_file)
-    new_csv_file = f"{base}_updated{ext}"
+    """Hosts to onboard: the Deployed nodes of the live status file, or of the updated CSV without one."""
     try:
-        with open(new_csv_file, newline='') as csvfile:
-            rows = list(csv.DictReader(csvfile))
+        status = read_status(status_path(csv_file))
+        if status is not None:
+            rows = [{"ip": node["ip"], "deployment_status": node["status"]} for node in status["nodes"]]
+        else:
+            with open(updated_csv_path(csv_file), newline='') as csvfile:
+                rows = list(csv.DictReader(csvfile))
     except Exception as e:
-        logger.error(f"Error reading CSV: {e}")
+        logger.error(f"Error reading deployment status: {e}")
         sys.exit(1)
+    return prepare_hosts(rows, ssh_user, home, logger)
+
 
-    hosts = {}
-    for row in rows:
-        ip = row.get("ip")
-        status = row.get("deployment_status")
-        if ip and status == "Deployed":
-            hosts[ip] = {
-                "ansible_ssh_user": ssh_user,
-                "ansible_ssh_private_key_file": f"{home}/.ssh/id_rsa",
-                "roles": ["node_onboard"]
-            }
+def prepare_hosts(rows, ssh_user, home, logger):
+    """Hosts to onboard: {ip: host entry} of the Deployed rows (the inventory of this run, or as read back)."""
+    entry = host_entry(ssh_user, home)
+    # Every host gets the same entry, so thousands of hosts cost one dict, not one each.
+    hosts = {row["ip"]: entry for row in rows if row.get("ip") and row.get("deployment_status") == "Deployed"}
 
     if not hosts:
         logger.info("No hosts to onboard. Exiting.")
@@ -34,79 +46,226 @@ def prepare_hosts_from_csv(csv_file, ssh_user, home, logger):
 
 
 
+def host_entry(ssh_user, home):
+    return {
+        "ansible_ssh_user": ssh_user,
+        "ansible_ssh_private_key_file": f"{home}/.ssh/id_rsa",
+        "roles": ["node_onboard"]
+    }
+
+
+def write_vars_yaml(current_dir, template_file, output_file, url, region, environment, hosts):
+    render_service.render_to_file(
+        os.path.join(current_dir, os.path.basename(template_file)),
+        output_file,
+        url=url,
+        cloud=region,
+        environment=environment,
+        hosts=hosts
+    )
+
 
 def render_vars_yaml(current_dir, template_file, output_file, url, region, environment, hosts, logger):
     
     try:
-        env = Environment(loader=FileSystemLoader(current_dir))
-        template = env.get_template(os.path.basename(template_file))
-        yaml_content = template.render(
-            url=url,
-            cloud=region,
-            environment=environment,
-            hosts=hosts
-        )
-
-        with open(output_file, "w") as f:
-            f.write(yaml_content)
+        write_vars_yaml(current_dir, template_file, output_file, url, region, environment, hosts)
         logger.info(f"Generated '{output_file}' successfully!")
     except Exception as e:
         logger.error(f"Error rendering vars.yaml: {e}")
         sys.exit(1)
 
-def start_pcd_onboarding(csv_filename, ssh_user,portal, region, environment, url,setup_env,controller_ip,onprem, logger):
+def start_pcd_onboarding(csv_filename, ssh_user,portal, region, environment, url,setup_env,controller_ip,onprem, logger, spans=None, shards=1, rows=None, force_steps=()):
+    """Onboard every Deployed host of the run; returns an OnboardingResult with the outcome per host.
+
+    rows are the run's inventory rows, as provisioning left them; without
+    them the hosts are read back from the status file of csv_filename.
+    """
     current_dir = os.getcwd()
     output_file = os.path.join(current_dir, "vars.yaml")
     template_file = os.path.join(current_dir, "vars_template.j2")
     home = os.getenv("HOME")
-    hosts = prepare_hosts_from_csv(csv_filename, ssh_user, home, logger)
+    if rows is not None:
+        hosts = prepare_hosts(rows, ssh_user, home, logger)
+    else:
+        hosts = prepare_hosts_from_csv(csv_filename, ssh_user, home, logger)
     pcd_dir = os.path.join(current_dir, "pcd_ansible-pcd_develop")
     render_vars_yaml(current_dir, template_file, output_file, url, region, environment, hosts, logger)
-    os.chdir(pcd_dir)
-    run_pcd_onboarding(portal, region, environment, url,output_file,setup_env,controller_ip,onprem, logger)
 
-def run_pcd_onboarding(portal, region, environment, url,output_file,setup_env,controller_ip,onprem, logger):
-    
-    try:
-        
-        subprocess.run(["cp", "-f", output_file, "user_resource_examples/templates/host_onboard_data.yaml.j2"], check=True)
+    def write_vars(ips, path):
+        write_vars_yaml(current_dir, template_file, path, url, region, environment, {ip: hosts[ip] for ip in ips})
+
+    result = run_pcd_onboarding(portal, region, environment, url, list(hosts), write_vars, setup_env, controller_ip,
+                                onprem, logger, pcd_dir, spans, shards, force_steps)
+    logger.info(f"Onboarding finished: {len(result.succeeded)} hosts onboarded, {len(result.failed)} failed")
+    return result
+
+def env_file_path(portal, region, environment):
+    return f"user_configs/{portal}/{region}/{portal}-{region}-{environment}-environment.yaml"
+
+def nodes_data_path(portal, region):
+    return f"user_configs/{portal}/{region}/node-onboarding/{portal}-{region}-nodesdata.yaml"
 
-        subprocess.run([
+def play_data_path(portal, region):
+    """Where create-hostagents-configs writes the Ansible inventory and playbooks of the region."""
+    return f"{portal}-play_data/{region}"
+
+def onboarding_steps(portal, region, environment, url, setup_env, controller_ip, onprem):
+    """The pcdExpress invocations of a full onboarding, in order, as (step name, argv) pairs."""
+    env_file = env_file_path(portal, region, environment)
+    steps = [
+        ("setup-environment", [
             "./pcdExpress","-portal", portal,"-region", region,"-env", environment,"-url", url,"-ostype", "ubuntu",
             "-setup-environment", setup_env
-        ], check=True)
-
-        subprocess.run([
+        ]),
+        ("render-userconfig", [
             "./pcdExpress",
-            "-env-file", f"user_configs/{portal}/{region}/{portal}-{region}-{environment}-environment.yaml",
-            "-render-userconfig", f"user_configs/{portal}/{region}/node-onboarding/{portal}-{region}-nodesdata.yaml"
-        ], check=True)
-
-        subprocess.run([
+            "-env-file", env_file,
+            "-render-userconfig", nodes_data_path(portal, region)
+        ]),
+        ("create-hostagents-configs", [
             "./pcdExpress",
-            "-env-file", f"user_configs/{portal}/{region}/{portal}-{region}-{environment}-environment.yaml",
+            "-env-file", env_file,
             "-create-hostagents-configs", "yes"
-        ], check=True)
-
-        if onprem: 
-            fqdn = url.removeprefix("https://").removesuffix("/")
-            fqdninfra = re.sub(r"-(.*?)\.", ".", fqdn, count=1)
-            subprocess.run([
-                './pcdExpress',
-                '-env-file', f'user_configs/{portal}/{region}/{portal}-{region}-{environment}-environment.yaml',
-                '-onprem', 'yes',
-                '-ip-addr', controller_ip,
-                '-fqdn', fqdn,
-                '-fqdninfra', fqdninfra
-            ], check=True)
-
-        subprocess.run([
-            "./pcdExpress",
-            "-env-file", f"user_configs/{portal}/{region}/{portal}-{region}-{environment}-environment.yaml",
-            "-apply-hosts-onboard", "yes"
-        ], check=True)
+        ]),
+    ]
+    if onprem == "yes":
+        fqdn = url.removeprefix("https://").removesuffix("/")
+        fqdninfra = re.sub(r"-(.*?)\.", ".", fqdn, count=1)
+        steps.append(("onprem", [
+            './pcdExpress',
+            '-env-file', env_file,
+            '-onprem', 'yes',
+            '-ip-addr', controller_ip,
+            '-fqdn', fqdn,
+            '-fqdninfra', fqdninfra
+        ]))
+    steps.append(("apply-hosts-onboard", [
+        "./pcdExpress",
+        "-env-file", env_file,
+        "-apply-hosts-onboard", "yes"
+    ]))
+    return steps
 
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error during subprocess execution: {e}")
-        sys.exit(1)
+def onboarding_executor(portal, region, environment, url, setup_env, controller_ip, onprem, logger, pcd_dir,
+                        spans=None, shards=1, log_dir=ONBOARD_LOG_DIR, force_steps=()):
+    """Executor for the onboarding steps; force_steps (step names, or "all") are run even if cached."""
+    steps = onboarding_steps(portal, region, environment, url, setup_env, controller_ip, onprem)
+    step_cache = StepCache(os.path.join(log_dir, STEP_CACHE_FILE),
+                           (f"user_configs/{portal}/{region}", play_data_path(portal, region)),
+                           nodes_data_path(portal, region), logger, force_steps, input_files=(HOST_TEMPLATE,))
+    return OnboardingExecutor(steps, pcd_dir, nodes_data_path(portal, region), HOST_TEMPLATE, log_dir, logger,
+                              shards, spans, step_cache)
+
+def run_pcd_onboarding(portal, region, environment, url, hosts, write_vars, setup_env, controller_ip, onprem, logger, pcd_dir=None, spans=None, shards=1, force_steps=()):
+    """Run the pcdExpress steps for hosts (IPs); write_vars(ips, path) renders the vars file of some of them."""
+    pcd_dir = pcd_dir or os.path.join(os.getcwd(), "pcd_ansible-pcd_develop")
+    executor = onboarding_executor(portal, region, environment, url, setup_env, controller_ip, onprem, logger,
+                                   pcd_dir, spans, shards, force_steps=force_steps)
+    return executor.run(hosts, write_vars)
+
+
+class OnboardingStream:
+    """Onboards hosts in micro-batches while provisioning is still running.
+
+    Used as the provisioning on_node_done hook: every node that ends up
+    Deployed (SSH reachable) is queued, and a single worker thread onboards the
+    queue whenever it holds batch_size hosts or the oldest queued host has
+    waited batch_window seconds. Batches run one at a time because pcdExpress
+    rewrites shared files under pcd_ansible-pcd_develop. -setup-environment
+    runs once, before the first batch; every batch then writes its hosts
+    straight into the node-onboarding data file and runs render-userconfig,
+    create-hostagents-configs (which regenerates the inventory for the batch),
+    the on-prem step if enabled, and apply-hosts-onboard, through an
+    OnboardingExecutor (so a batch can be sharded and fails per host).
+    """
+
+    def __init__(self, ssh_user, portal, region, environment, url, setup_env, controller_ip, onprem, logger,
+                 batch_size=10, batch_window=300, current_dir=None, journal=None, spans=None, shards=1,
+                 force_steps=()):
+        self.current_dir = current_dir or os.getcwd()
+        self.pcd_dir = os.path.join(self.current_dir, "pcd_ansible-pcd_develop")
+        self.template_file = os.path.join(self.current_dir, "vars_template.j2")
+        self.ssh_user = ssh_user
+        self.portal = portal
+        self.region = region
+        self.environment = environment
+        self.url = url
+        self.setup_env = setup_env
+        self.controller_ip = controller_ip
+        self.onprem = onprem
+        self.logger = logger
+        self.journal = journal
+        self.spans = spans or SpanRecorder()
+        self.executor = onboarding_executor(portal, region, environment, url, setup_env, controller_ip, onprem, logger,
+                                            self.pcd_dir, self.spans, shards,
+                                            os.path.join(self.current_dir, ONBOARD_LOG_DIR), force_steps)
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.home = os.getenv("HOME")
+        self.onboarded = []
+        self.failed = []
+        self._hostnames = {}
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._batches = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="onboarding-stream", daemon=True)
+        self._thread.start()
+        return self
+
+    def add(self, node):
+        ip = node.row.get("ip")
+        if node.onboarded:
+            self.logger.info(f"[{node.hostname}] Already onboarded in an earlier run, skipping.")
+        elif ip and node.status == "Deployed":
+            self._hostnames[ip] = node.hostname
+            self._queue.put(ip)
+
+    def close(self):
+        """Onboard whatever is still queued and wait for the last batch to finish."""
+        self._closed.set()
+        self._thread.join()
+        self.logger.info(f"Incremental onboarding finished: {len(self.onboarded)} hosts onboarded "
+                         f"in {self._batches} batches, {len(self.failed)} failed")
+        return not self.failed
+
+    def _run(self):
+        pending = []
+        first_queued = None
+        while True:
+            timeout = 0.5 if not pending else min(0.5, max(0, first_queued + self.batch_window - time.monotonic()))
+            try:
+                pending.append(self._queue.get(timeout=timeout))
+                first_queued = first_queued or time.monotonic()
+            except queue.Empty:
+                pass
+            closing = self._closed.is_set() and self._queue.empty()
+            due = pending and (len(pending) >= self.batch_size or closing
+                               or time.monotonic() - first_queued >= self.batch_window)
+            if due:
+                batch, pending = pending[:self.batch_size], pending[self.batch_size:]
+                first_queued = time.monotonic() if pending else None
+                self._onboard_batch(batch)
+            elif closing and not pending:
+                return
+
+    def _onboard_batch(self, ips):
+        self._batches += 1
+        label = f"batch {self._batches}"
+        self.logger.info(f"Onboarding {label}: {', '.join(ips)}")
+
+        def write_vars(batch_ips, path):
+            write_vars_yaml(self.current_dir, self.template_file, path, self.url, self.region, self.environment,
+                            dict.fromkeys(batch_ips, host_entry(self.ssh_user, self.home)))
 
+        result = self.executor.run(ips, write_vars, label=f"batch-{self._batches:03d}",
+                                   setup=not self.executor.environment_ready)
+        self.onboarded.extend(result.succeeded)
+        self.failed.extend(result.failed)
+        if self.journal:
+            for ip in result.succeeded:
+                self.journal.record(self._hostnames.get(ip, ip), "onboarded", ip=ip)
+        self.logger.info(f"Onboarding {label} finished: {len(result.succeeded)} hosts onboarded, "
+                         f"{len(result.failed)} failed")
@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from modules.timing import SpanRecorder, ONBOARD_PREFIX
+
+ANSI_PATTERN = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+# Ansible task results name their host in brackets: "ok: [10.0.0.5]", "fatal: [10.0.0.5]: FAILED! => ...".
+HOST_PATTERN = re.compile(r"\[([^\]\s]+)\]")
+# PLAY RECAP line: "10.0.0.5  : ok=12  changed=3  unreachable=0  failed=1  skipped=2 ..."
+RECAP_PATTERN = re.compile(r"^(?P<host>\S+)\s*:\s*ok=\d+\s+changed=\d+\s+unreachable=(?P<unreachable>\d+)\s+"
+                           r"failed=(?P<failed>\d+)")
+
+
+class HostLogs:
+    """Per-host onboarding logs: one JSON line per output line that mentions the host, plus step start/end."""
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def path(self, host):
+        return os.path.join(self.log_dir, f"{host}.jsonl")
+
+    def write(self, hosts, **entry):
+        line = json.dumps({"ts": round(time.time(), 3), **entry}) + "\n"
+        with self._lock:
+            for host in hosts:
+                with open(self.path(host), "a") as f:
+                    f.write(line)
+
+
+class OnboardingResult:
+    """Which hosts an onboarding run brought up, and why the others failed."""
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+
+    def update(self, other):
+        self.succeeded += other.succeeded
+        self.failed.update(other.failed)
+
+    def __bool__(self):
+        return not self.failed
+
+
+class OnboardingExecutor:
+    """Runs the pcdExpress onboarding steps for a set of hosts and reports per host.
+
+    Every line a step prints is streamed as it comes into the step's log
+    (<log_dir>/<label>/<shard>/<step>.log) and the main log, and every line that
+    names a host (an Ansible task result or recap) into that host's log
+    (<log_dir>/hosts/<host>.jsonl), together with the start and end of each
+    step its shard ran. Within a shard the steps run one after another, since
+    each reads what the one before it wrote (render-userconfig the environment,
+    create-hostagents-configs the rendered user config, the on-prem step and
+    apply-hosts-onboard the play_data inventory).
+
+    -setup-environment runs once, for all the hosts. With shards > 1 the hosts
+    are then split into that many shards, and each shard renders its configs
+    and runs apply-hosts-onboard in its own copy of pcd_ansible-pcd_develop
+    (taken after -setup-environment, under <log_dir>/shards/), all shards at
+    once. A host fails when its shard's steps fail or when the Ansible recap
+    shows it failed or unreachable; the other hosts are not affected.
+
+    With a step_cache (StepCache), steps whose inputs and outputs are the same
+    as when they last succeeded are skipped.
+    """
+
+    def __init__(self, steps, pcd_dir, nodes_data, host_template, log_dir, logger, shards=1, spans=None,
+                 step_cache=None):
+        self.steps = steps
+        self.pcd_dir = pcd_dir
+        self.nodes_data = nodes_data
+        self.host_template = host_template
+        self.log_dir = log_dir
+        self.logger = logger
+        self.shards = max(1, shards)
+        self.spans = spans or SpanRecorder()
+        self.host_logs = HostLogs(os.path.join(log_dir, "hosts"))
+        self.step_cache = step_cache
+        self.environment_ready = False
+
+    def run(self, hosts, write_vars, label="all", setup=True):
+        """Onboard hosts (a list of IPs); write_vars(hosts, path) renders the vars file of a set of hosts."""
+        result = OnboardingResult()
+        steps = dict(self.steps)
+        setup_step = steps.pop("setup-environment")
+        label_dir = os.path.join(self.log_dir, label)
+        os.makedirs(label_dir, exist_ok=True)
+        if setup:
+            vars_file = os.path.join(label_dir, "vars.yaml")
+            try:
+                write_vars(hosts, vars_file)
+                shutil.copyfile(vars_file, os.path.join(self.pcd_dir, self.host_template))
+            except Exception as e:
+                return self._fail(result, hosts, f"rendering vars failed: {e}")
+            returncode, _ = self._run_cached("setup-environment", setup_step, self.pcd_dir, hosts, label,
+                                             os.path.join(label_dir, "setup-environment.log"),
+                                             self._cache_begin("setup-environment", setup_step, self.pcd_dir, hosts))
+            if returncode != 0:
+                return self._fail(result, hosts, f"setup-environment exited with {returncode}")
+            self.environment_ready = True
+
+        shards = [hosts[i::self.shards] for i in range(min(self.shards, len(hosts)))]
+        with ThreadPoolExecutor(max_workers=max(1, len(shards)), thread_name_prefix="onboard-shard") as pool:
+            for shard_result in pool.map(lambda i: self._run_shard(i, shards[i], len(shards), steps, write_vars,
+                                                                   label, label_dir), range(len(shards))):
+                result.update(shard_result)
+        return result
+
+    def _run_shard(self, index, hosts, count, steps, write_vars, label, label_dir):
+        result = OnboardingResult()
+        shard = f"shard-{index + 1}"
+        shard_dir = os.path.join(label_dir, shard)
+        os.makedirs(shard_dir, exist_ok=True)
+        span_host = label if count == 1 else f"{label}/{shard}"
+        pcd_dir = self.pcd_dir
+        try:
+            if count > 1:
+                pcd_dir = os.path.join(self.log_dir, "shards", shard, os.path.basename(self.pcd_dir))
+                shutil.copytree(self.pcd_dir, pcd_dir, symlinks=True, dirs_exist_ok=True)
+            vars_file = os.path.join(shard_dir, "vars.yaml")
+            write_vars(hosts, vars_file)
+            # The rendered vars file has no template variables left, so it is exactly
+            # what -setup-environment would have rendered into the nodes data file.
+            shutil.copyfile(vars_file, os.path.join(pcd_dir, self.host_template))
+            nodes_data = os.path.join(pcd_dir, self.nodes_data)
+            os.makedirs(os.path.dirname(nodes_data), exist_ok=True)
+            shutil.copyfile(vars_file, nodes_data)
+        except Exception as e:
+            return self._fail(result, hosts, f"preparing {shard} failed: {e}")
+
+        recap = {}
+        for name, command in steps.items():
+            returncode, step_recap = self._run_cached(name, command, pcd_dir, hosts, span_host,
+                                                      os.path.join(shard_dir, f"{name}.log"),
+                                                      self._cache_begin(name, command, pcd_dir, hosts))
+            recap.update(step_recap)
+            if returncode != 0 and not step_recap:
+                return self._fail(result, hosts, f"{name} exited with {returncode}")
+
+        for host in hosts:
+            if host in recap and recap[host]:
+                result.failed[host] = recap[host]
+            elif host not in recap and any(recap.values()):
+                result.failed[host] = "missing from the Ansible recap"
+            else:
+                result.succeeded.append(host)
+        for host, reason in result.failed.items():
+            self.logger.error(f"[{host}] Onboarding failed: {reason}")
+        return result
+
+    def _fail(self, result, hosts, reason):
+        for host in hosts:
+            result.failed[host] = reason
+        self.logger.error(f"Onboarding of {', '.join(hosts)} failed: {reason}")
+        return result
+
+    def _cache_begin(self, name, command, cwd, hosts):
+        """False to run the step without the cache, True if it can be skipped, or the cache's state for it."""
+        if not (self.step_cache and self.step_cache.cacheable(name)):
+            return False
+        skip, state = self.step_cache.begin(name, command, cwd)
+        if skip:
+            self.host_logs.write(hosts, step=name, event="skipped")
+            return True
+        return state
+
+    def _run_cached(self, name, command, cwd, hosts, span_host, log_path, cache_state):
+        if cache_state is True:
+            return 0, {}
+        returncode, recap = self._run_step(name, command, cwd, hosts, span_host, log_path)
+        if returncode == 0 and cache_state:
+            self.step_cache.store(cache_state)
+        return returncode, recap
+
+    def _run_step(self, name, command, cwd, hosts, span_host, log_path):
+        """Run one step, streaming its output; returns (exit code, {host: failure or None} from the recap)."""
+        wanted = set(hosts)
+        recap = {}
+        self.host_logs.write(hosts, step=name, event="start")
+        with self.spans.span(span_host, ONBOARD_PREFIX + name) as span, open(log_path, "a") as log:
+            try:
+                process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           stdin=subprocess.DEVNULL, text=True, errors="replace", bufsize=1)
+            except OSError as e:
+                self.logger.error(f"[{span_host}] {name} could not start: {e}")
+                span.outcome = "failed"
+                self.host_logs.write(hosts, step=name, event="end", error=str(e))
+                return 127, {}
+            for line in process.stdout:
+                line = ANSI_PATTERN.sub("", line.rstrip("\n"))
+                log.write(line + "\n")
+                self.logger.info(f"[{span_host} {name}] {line}")
+                match = RECAP_PATTERN.match(line.strip())
+                if match and match.group("host") in wanted:
+                    failed, unreachable = int(match.group("failed")), int(match.group("unreachable"))
+                    recap[match.group("host")] = (f"Ansible reported failed={failed} unreachable={unreachable}"
+                                                  if failed or unreachable else None)
+                    mentioned = [match.group("host")]
+                else:
+                    mentioned = [host for host in HOST_PATTERN.findall(line) if host in wanted]
+                if mentioned:
+                    self.host_logs.write(mentioned, step=name, line=line)
+            returncode = process.wait()
+            if returncode != 0:
+                span.outcome = "failed"
+        self.host_logs.write(hosts, step=name, event="end", returncode=returncode)
+        return returncode, recap
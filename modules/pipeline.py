@@ -0,0 +1,128 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from modules.logPipeline import node_context
+
+# Stages a node moves through, in order. Waiting for commissioning and for the
+# deploy to finish is not a stage: those waits are fleet poller watches and
+# hold no worker thread.
+STAGES = ["create", "storage", "deploy", "ssh"]
+
+
+class Node:
+    """Provisioning state of a single CSV row."""
+
+    def __init__(self, row):
+        self.row = row
+        self.hostname = row.get("hostname")
+        self.system_id = None
+        self.stage = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.cloud_init_file = None
+        self.onboarded = False
+        self.commission_retries = 0
+
+    @property
+    def status(self):
+        return self.row.get("deployment_status")
+
+
+class Pipeline:
+    """Event-driven scheduler moving each node through the stages on its own.
+
+    Every stage has its own bounded worker pool, so e.g. at most N creates and
+    M deploys run at once, and a node is handed to the next stage as soon as its
+    previous step completes instead of waiting for the rest of the fleet.
+    """
+
+    def __init__(self, stage_limits, logger, on_node_done=None, journal=None, status=None, adaptive=None):
+        self.logger = logger
+        self.on_node_done = on_node_done
+        self.journal = journal
+        self.status = status
+        self.adaptive = adaptive
+        self._pending = deque()
+        self._start = None
+        self.stage_limits = stage_limits
+        self._pools = {
+            stage: ThreadPoolExecutor(max_workers=max(1, stage_limits[stage]), thread_name_prefix=f"{stage}-stage")
+            for stage in STAGES
+        }
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._idle = threading.Event()
+        self._idle.set()
+        self.nodes = []
+
+    def add(self, node, first_stage=None, fn=None, *args):
+        """Track a node; with first_stage it is queued there, otherwise the caller schedules it."""
+        with self._lock:
+            self._outstanding += 1
+            self._idle.clear()
+            self.nodes.append(node)
+        if first_stage:
+            self.advance(node, first_stage, fn, *args)
+
+    def admit(self, items, start):
+        """Call start(item) for every item: all at once, or as the adaptive controller lets machines in."""
+        with self._lock:
+            self._pending.extend(items)
+        self._admit(start)
+
+    def _admit(self, start=None):
+        self._start = start or self._start
+        while True:
+            with self._lock:
+                if not self._pending or (self.adaptive and not self.adaptive.try_acquire()):
+                    return
+                item = self._pending.popleft()
+            self._start(item)
+
+    def record(self, node, event, **fields):
+        if self.journal:
+            self.journal.record(node.hostname, event, system_id=node.system_id, **fields)
+        if self.status:
+            self.status.update(node.hostname, event, system_id=node.system_id, **fields)
+        if self.adaptive:
+            self.adaptive.record(event)
+            self._admit()
+
+    def advance(self, node, stage, fn, *args):
+        """Queue fn(node, *args) on the stage's pool."""
+        self._pools[stage].submit(self._run_stage, node, stage, fn, args)
+
+    def _run_stage(self, node, stage, fn, args):
+        node.stage = stage
+        try:
+            with node_context(node):
+                fn(node, *args)
+        except Exception as e:
+            self.logger.error(f"[{node.hostname}] Unexpected error in {stage} stage: {e}")
+            self.finish(node, f"Error During {stage.capitalize()}")
+
+    def finish(self, node, status=None):
+        """Mark the node done; status, when given, becomes its deployment_status."""
+        if status is not None:
+            node.row["deployment_status"] = status
+        node.finished = time.monotonic()
+        self.record(node, "finished", status=node.status)
+        if self.on_node_done:
+            try:
+                self.on_node_done(node)
+            except Exception as e:
+                self.logger.error(f"[{node.hostname}] Node completion hook failed: {e}")
+        if self.adaptive:
+            # Admitted before the count drops, so wait() cannot see the run as idle in between.
+            self.adaptive.release(node)
+            self._admit()
+        with self._lock:
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._idle.set()
+
+    def wait(self):
+        self._idle.wait()
+        for pool in self._pools.values():
+            pool.shutdown(wait=True)
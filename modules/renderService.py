@@ -0,0 +1,52 @@
+import os
+import threading
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from modules.statusWriter import write_atomic
+
+
+class RenderService:
+    """Renders Jinja2 templates (vars_template.j2) to files, compiling each template once.
+
+    Templates are kept compiled per (path, modification time), so editing a
+    template takes effect on the next render and every other render reuses
+    the compiled one. There is one Environment per template directory, shared
+    by every render, with a FileSystemBytecodeCache (in the system temporary
+    directory unless bytecode_dir is given) so other processes on the machine,
+    such as the targets of a multi-site run, load the compiled template instead
+    of parsing it again.
+
+    render_to_file() streams the template's output into the file chunk by
+    chunk (through a temporary file and a rename), so the rendered text of
+    thousands of hosts is never held in memory as one string.
+    """
+
+    def __init__(self, bytecode_dir=None):
+        self.bytecode_cache = FileSystemBytecodeCache(bytecode_dir) if bytecode_dir else FileSystemBytecodeCache()
+        self._environments = {}
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def template(self, template_file):
+        path = os.path.abspath(template_file)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                directory, name = os.path.split(path)
+                env = self._environments.get(directory)
+                if env is None:
+                    # cache_size=0: the compiled templates are kept here, keyed by mtime, not by the Environment.
+                    env = Environment(loader=FileSystemLoader(directory), bytecode_cache=self.bytecode_cache,
+                                      cache_size=0, auto_reload=False)
+                    self._environments[directory] = env
+                for stale in [k for k in self._templates if k[0] == path]:
+                    del self._templates[stale]
+                template = self._templates[key] = env.get_template(name)
+        return template
+
+    def render_to_file(self, template_file, output_file, **values):
+        template = self.template(template_file)
+        write_atomic(output_file, lambda f: f.writelines(template.generate(**values)))
+
+
+render_service = RenderService()
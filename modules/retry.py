@@ -0,0 +1,151 @@
+import time
+import random
+import asyncio
+from modules.maasClient import MaasError
+
+# Stages with their own retry policy. commission is the explicit commission
+# call (on resume and after Failed commissioning); the first commissioning
+# starts by itself when the machine is created.
+STAGES = ("create", "commission", "storage", "deploy", "power-update")
+
+# Statuses with which the region turned a request away without acting on it,
+# so even a call that is not idempotent can safely be sent again.
+REJECTED_STATUSES = (429, 503)
+
+DEFAULT_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 2.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_BUDGET = 300.0
+
+
+def is_transient(error):
+    return error.transient
+
+
+def is_rejected(error):
+    return error.status in REJECTED_STATUSES
+
+
+class RetryPolicy:
+    """How one stage retries a MAAS call that failed with a transient error.
+
+    Attempt n (from 1) that fails transiently waits a random time between 0
+    and min(max_delay, base_delay * 2**(n-1)) ("full jitter", so a rack of
+    machines that failed together does not retry together) and tries again,
+    up to attempts calls in all and as long as the time spent on the stage
+    stays within budget seconds. Permanent errors (bad request, conflict,
+    not found, ...) are raised straight away.
+
+    A call that timed out may still have taken effect, so a permanent error
+    after a retry (hostname already exists, machine already deploying) can
+    mean the earlier attempt succeeded; already_done(error) is asked then and
+    its non-None result is returned as the call's result.
+    """
+
+    def __init__(self, stage, attempts=DEFAULT_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 budget=DEFAULT_BUDGET):
+        if stage not in STAGES:
+            raise ValueError(f"unknown stage {stage!r}, expected one of {', '.join(STAGES)}")
+        if attempts < 1:
+            raise ValueError(f"{stage}: attempts must be at least 1")
+        self.stage = stage
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def __str__(self):
+        return (f"{self.stage}: {self.attempts} attempts, backoff {self.base_delay}-{self.max_delay}s, "
+                f"budget {self.budget}s")
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _next_delay(self, error, attempt, started, hostname, logger, span, retry_on):
+        """Seconds to wait before the next attempt, or None if error has to be raised."""
+        if not (retry_on or is_transient)(error) or attempt >= self.attempts:
+            return None
+        delay = self.delay(attempt)
+        if time.monotonic() - started + delay > self.budget:
+            return None
+        if logger:
+            logger.warning(f"[{hostname}] {self.stage} failed ({error}), retrying in {delay:.1f}s "
+                           f"(attempt {attempt + 1} of {self.attempts})")
+        if span:
+            span.retries += 1
+        return delay
+
+    @staticmethod
+    def _recovered(error, attempt, already_done):
+        return already_done(error) if already_done and attempt > 1 else None
+
+    def call(self, fn, hostname="", logger=None, span=None, already_done=None, retry_on=None):
+        """Run fn() until it succeeds, fails permanently or the attempts/budget run out.
+
+        retry_on(error) narrows which errors are retried (default: transient ones).
+        """
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn()
+            except MaasError as e:
+                recovered = self._recovered(e, attempt, already_done)
+                if recovered is not None:
+                    return recovered
+                delay = self._next_delay(e, attempt, started, hostname, logger, span, retry_on)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def call_async(self, fn, hostname="", logger=None, span=None, already_done=None, retry_on=None):
+        """call() for coroutine functions: awaits fn() (and already_done, if it is one) and sleeps on the event loop."""
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await fn()
+            except MaasError as e:
+                recovered = self._recovered(e, attempt, already_done)
+                if asyncio.iscoroutine(recovered):
+                    recovered = await recovered
+                if recovered is not None:
+                    return recovered
+                delay = self._next_delay(e, attempt, started, hostname, logger, span, retry_on)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+
+def parse_policy(spec):
+    """Parse 'deploy,attempts=6,base=2,max=60,budget=900' into a RetryPolicy (raises ValueError)."""
+    stage, *options = [part.strip() for part in spec.split(",")]
+    kwargs = {}
+    names = {"attempts": "attempts", "base": "base_delay", "max": "max_delay", "budget": "budget"}
+    for option in options:
+        name, _, value = option.partition("=")
+        try:
+            if name not in names:
+                raise ValueError(f"unknown option {name!r}")
+            kwargs[names[name]] = int(value) if name == "attempts" else float(value)
+        except ValueError as e:
+            raise ValueError(f"invalid retry policy '{spec}': {e}")
+    return RetryPolicy(stage, **kwargs)
+
+
+class Retries:
+    """The retry policy of every stage; stages without an explicit policy get the defaults.
+
+    commission_retries is how many times a machine that ends in Failed
+    commissioning is sent back to commissioning before it is given up on.
+    """
+
+    def __init__(self, policies=(), commission_retries=2):
+        self.policies = {stage: RetryPolicy(stage) for stage in STAGES}
+        self.policies.update({policy.stage: policy for policy in policies})
+        self.commission_retries = commission_retries
+
+    def __getitem__(self, stage):
+        return self.policies[stage]
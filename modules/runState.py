@@ -0,0 +1,98 @@
+import os
+import csv
+from fnmatch import fnmatchcase
+from modules.journal import load_journal, journal_path
+from modules.statusWriter import read_status, status_path, updated_csv_path
+
+# Status of a machine no run has touched yet, and of one a run left unfinished.
+NOT_STARTED = "Not Started"
+IN_PROGRESS = "In Progress"
+
+
+class RunState:
+    """What the earlier runs against a CSV left behind: its status file (or updated CSV) and its journal.
+
+    Every main_script command reads it, so a command that only runs one
+    stage (or only reports) carries on from where the others stopped. The
+    last status of a machine is taken from the status file, from the updated
+    CSV when there is no status file, and from the journal for machines
+    neither has a status for.
+    """
+
+    def __init__(self, csv_filename, journal=None):
+        self.csv_filename = csv_filename
+        self.journal_path = journal or journal_path(csv_filename)
+        self.records = load_journal(self.journal_path)
+        self.nodes = {}
+        status = read_status(status_path(csv_filename))
+        if status is not None:
+            self.nodes = {node["hostname"]: node for node in status["nodes"]}
+        elif os.path.isfile(updated_csv_path(csv_filename)):
+            with open(updated_csv_path(csv_filename), newline='') as csvfile:
+                self.nodes = {row["hostname"]: {"hostname": row["hostname"], "ip": row.get("ip"), "system_id": None,
+                                                "event": None, "status": row.get("deployment_status") or None,
+                                                "updated": None}
+                              for row in csv.DictReader(csvfile)}
+
+    def status_of(self, hostname):
+        """hostname's last deployment_status, or NOT_STARTED / IN_PROGRESS when it has none."""
+        node = self.nodes.get(hostname) or {}
+        record = self.records.get(hostname)
+        if node.get("status") or (record and record.status):
+            return node.get("status") or record.status
+        return IN_PROGRESS if node.get("event") or (record and record.events) else NOT_STARTED
+
+    def system_id(self, hostname):
+        record = self.records.get(hostname)
+        return (self.nodes.get(hostname) or {}).get("system_id") or (record.system_id if record else None)
+
+    def last_event(self, hostname):
+        record = self.records.get(hostname)
+        if record and record.events:
+            return max(record.events, key=record.events.get)
+        return (self.nodes.get(hostname) or {}).get("event")
+
+    def onboarded(self, hostname):
+        record = self.records.get(hostname)
+        return bool(record and record.done("onboarded"))
+
+    def previous(self):
+        """The last known state of every machine, in the form of a status file (StatusWriter's previous)."""
+        nodes = []
+        for hostname in {**self.nodes, **self.records}:
+            status = self.status_of(hostname)
+            nodes.append({"hostname": hostname, "system_id": self.system_id(hostname), "event": self.last_event(hostname),
+                          "status": None if status in (NOT_STARTED, IN_PROGRESS) else status,
+                          "updated": (self.nodes.get(hostname) or {}).get("updated")})
+        return {"nodes": nodes}
+
+    def apply(self, inventory):
+        """Give every row of inventory its last deployment_status, unless the CSV already has one."""
+        for row in inventory:
+            status = self.status_of(row["hostname"])
+            if not row.get("deployment_status") and status not in (NOT_STARTED, IN_PROGRESS):
+                row["deployment_status"] = status
+
+    def select(self, inventory, hostnames=(), statuses=(), racks=()):
+        """Hostnames of the rows matching every criterion given (any one of its values), in CSV order.
+
+        hostnames may be shell-style patterns (r1-*), statuses are compared
+        with status_of() and racks with the CSV's rack column; without any
+        criteria every row is selected. Raises ValueError for a criterion
+        that cannot match.
+        """
+        rows = list(inventory)
+        errors = []
+        if racks and not any("rack" in row for row in rows[:1]):
+            errors.append("selecting by rack needs a rack column in the CSV")
+        unmatched = [pattern for pattern in hostnames
+                     if not any(fnmatchcase(row["hostname"], pattern) for row in rows)]
+        if unmatched:
+            errors.append(f"no machine in the CSV matches {', '.join(unmatched)}")
+        if errors:
+            raise ValueError("; ".join(errors))
+        wanted_statuses = {status.lower() for status in statuses}
+        return [row["hostname"] for row in rows
+                if (not hostnames or any(fnmatchcase(row["hostname"], pattern) for pattern in hostnames))
+                and (not statuses or self.status_of(row["hostname"]).lower() in wanted_statuses)
+                and (not racks or (row.get("rack") or "") in racks)]
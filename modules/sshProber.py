@@ -0,0 +1,219 @@
+import os
+import time
+import errno
+import queue
+import socket
+import selectors
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared with Ansible (see ansible_environment) so the onboarding playbooks
+# reuse the master connections the probe left open instead of dialing again.
+CONTROL_DIR = os.path.expanduser("~/.ansible/cp")
+CONTROL_PERSIST = "30m"
+
+IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def ssh_options(control_dir=CONTROL_DIR, port=22):
+    return [
+        "-o", "StrictHostKeyChecking=no",
+        "-o", "BatchMode=yes",
+        "-o", "ConnectTimeout=10",
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_dir}/%C",
+        "-o", f"ControlPersist={CONTROL_PERSIST}",
+        "-p", str(port),
+    ]
+
+
+def ansible_environment(control_dir=CONTROL_DIR):
+    """Environment that makes Ansible's ssh connections use the prober's ControlMaster sockets."""
+    return {"ANSIBLE_SSH_CONTROL_PATH_DIR": control_dir,
+            "ANSIBLE_SSH_CONTROL_PATH": f"{control_dir}/%%C"}
+
+
+class _Target:
+    def __init__(self, ip, hostname, callback, deadline, min_backoff):
+        self.ip = ip
+        self.hostname = hostname
+        self.callback = callback
+        self.started = time.monotonic()
+        self.deadline = self.started + deadline
+        self.next_attempt = self.started
+        self.backoff = min_backoff
+        self.sock = None
+        self.connect_started = None
+        self.checking = False
+
+
+class SshProber:
+    """Single background prober for every freshly deployed machine.
+
+    One selector loop makes non-blocking TCP connects to port 22 of all pending
+    hosts; only once the port accepts a connection is the real `ssh ... echo
+    SSH_OK` login attempted, on a small pool of checker threads. Failed
+    attempts back off exponentially (min_backoff doubling up to max_backoff)
+    until the host's deadline. The login opens a ControlMaster socket that is
+    kept for CONTROL_PERSIST, so later Ansible runs against the host reuse it.
+    """
+
+    def __init__(self, ssh_user, logger, max_checks=10, deadline=600, min_backoff=2, max_backoff=30,
+                 connect_timeout=3, port=22, control_dir=CONTROL_DIR):
+        self.ssh_user = ssh_user
+        self.logger = logger
+        self.deadline = deadline
+        self.min_backoff = min_backoff
+        self.max_backoff = max(min_backoff, max_backoff)
+        self.connect_timeout = connect_timeout
+        self.port = port
+        self.control_dir = control_dir
+        self.key_file = f"{os.getenv('HOME')}/.ssh/id_rsa"
+        self.connects = 0
+        self.ssh_checks = 0
+        self._targets = []
+        self._incoming = queue.Queue()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._checkers = ThreadPoolExecutor(max_workers=max(1, max_checks), thread_name_prefix="ssh-check")
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="ssh-prober", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake()
+        if self._thread:
+            self._thread.join()
+        self._checkers.shutdown(wait=True)
+
+    def probe(self, ip, hostname, callback):
+        """Call callback(ok) once ip accepts an SSH login, or with False at the deadline."""
+        self._incoming.put(("new", _Target(ip, hostname, callback, self.deadline, self.min_backoff)))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def ssh_command(self, ip):
+        return ["ssh", *ssh_options(self.control_dir, self.port), "-i", self.key_file,
+                f"{self.ssh_user}@{ip}", "echo", "SSH_OK"]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            for key, _ in self._selector.select(self._next_timeout()):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._connected(key.data)
+            self._drain_incoming()
+            now = time.monotonic()
+            for target in list(self._targets):
+                if target.sock and now - target.connect_started >= self.connect_timeout:
+                    self._close(target)
+                    self._retry(target, now)
+                elif not target.sock and not target.checking and now >= target.next_attempt:
+                    self._connect(target)
+
+    def _next_timeout(self):
+        now = time.monotonic()
+        timeout = 1.0
+        for target in self._targets:
+            if target.sock:
+                timeout = min(timeout, target.connect_started + self.connect_timeout - now)
+            elif not target.checking:
+                timeout = min(timeout, target.next_attempt - now)
+        return max(0, timeout)
+
+    def _drain_incoming(self):
+        while True:
+            try:
+                kind, target, *result = self._incoming.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "new":
+                self._targets.append(target)
+            elif result[0]:
+                self._done(target, True)
+            else:
+                target.checking = False
+                self._retry(target, time.monotonic())
+
+    def _connect(self, target):
+        self.connects += 1
+        try:
+            family = socket.AF_INET6 if ":" in target.ip else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            error = sock.connect_ex((target.ip, self.port))
+        except OSError:
+            self._retry(target, time.monotonic())
+            return
+        if error not in IN_PROGRESS:
+            sock.close()
+            self._retry(target, time.monotonic())
+            return
+        target.sock, target.connect_started = sock, time.monotonic()
+        self._selector.register(sock, selectors.EVENT_WRITE, target)
+
+    def _close(self, target):
+        self._selector.unregister(target.sock)
+        target.sock.close()
+        target.sock = None
+
+    def _connected(self, target):
+        error = target.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self._close(target)
+        if error:
+            self._retry(target, time.monotonic())
+            return
+        target.checking = True
+        self._checkers.submit(self._ssh_check, target)
+
+    def _ssh_check(self, target):
+        self.ssh_checks += 1
+        try:
+            result = subprocess.run(self.ssh_command(target.ip), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    text=True, timeout=60)
+            ok = result.returncode == 0 and "SSH_OK" in result.stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            self.logger.info(f"[{target.hostname}] SSH check raised exception: {e}. Retrying...")
+            ok = False
+        if not ok:
+            self.logger.info(f"[{target.hostname}] SSH port is open but login failed. Retrying...")
+        self._incoming.put(("checked", target, ok))
+        self._wake()
+
+    def _retry(self, target, now):
+        if now >= target.deadline:
+            self._done(target, False)
+            return
+        target.next_attempt = min(now + target.backoff, target.deadline)
+        target.backoff = min(target.backoff * 2, self.max_backoff)
+
+    def _done(self, target, ok):
+        self._targets.remove(target)
+        if ok:
+            self.logger.info(f"[{target.hostname}] SSH connectivity verified.")
+        else:
+            self.logger.warning(f"[{target.hostname}] SSH connectivity check failed after "
+                                f"{time.monotonic() - target.started:.0f}s.")
+        try:
+            target.callback(ok)
+        except Exception as e:
+            self.logger.error(f"[{target.hostname}] SSH probe callback failed: {e}")
@@ -0,0 +1,158 @@
+import os
+import csv
+import json
+import time
+import queue
+import threading
+
+# Seconds between rewrites of the status files while updates keep coming in.
+STATUS_INTERVAL = 2.0
+
+
+def updated_csv_path(csv_file):
+    base, ext = os.path.splitext(csv_file)
+    return f"{base}_updated{ext}"
+
+
+def status_path(csv_file):
+    base, _ = os.path.splitext(csv_file)
+    return f"{base}_status.json"
+
+
+def read_status(path):
+    """Load a status file written by StatusWriter (None if there is none yet)."""
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_atomic(path, write, newline=None):
+    """Write path through a temporary file and a rename, so readers never see it half written."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", newline=newline) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class StatusWriter:
+    """Keeps <csv>_updated.csv and <csv>_status.json current while the run is going.
+
+    Provisioning threads (and the async engine) only call update(), which
+    puts the event on a queue. A single writer thread applies the queued
+    events to its own copy of the inventory rows, coalescing everything that
+    arrived since the last write, and rewrites both files atomically at most
+    every interval seconds, and once more on stop(). A run that dies partway
+    therefore still leaves the status of every node that got that far.
+
+    The CSV has the inventory columns plus deployment_status (set when a node
+    finishes); the JSON file also has each node's last progress event and
+    system_id, and the count per status, for operators to watch. With
+    previous (the last status file, or RunState.previous) the nodes start
+    from what it says, so the first write does not wipe the statuses an
+    earlier run left: a node keeps its previous status until this run
+    reports progress on it, and machines a run leaves alone keep their
+    event and system_id.
+    """
+
+    def __init__(self, inventory, logger, interval=STATUS_INTERVAL, csv_path=None, json_path=None, previous=None):
+        self.csv_path = csv_path or updated_csv_path(inventory.path)
+        self.json_path = json_path or status_path(inventory.path)
+        self.logger = logger
+        self.interval = interval
+        self.fieldnames = list(inventory.fieldnames)
+        if "deployment_status" not in self.fieldnames:
+            self.fieldnames.append("deployment_status")
+        self.rows = [dict(row) for row in inventory.rows]
+        self.nodes = {row["hostname"]: {"hostname": row["hostname"], "ip": row.get("ip"), "system_id": None,
+                                        "event": None, "status": row.get("deployment_status") or None,
+                                        "updated": None}
+                      for row in self.rows}
+        self._rows = {row["hostname"]: row for row in self.rows}
+        for node in (previous or {}).get("nodes", []):
+            if node.get("hostname") in self.nodes:
+                current = self.nodes[node["hostname"]]
+                current.update({key: node.get(key) for key in ("system_id", "event", "updated")},
+                               status=current["status"] or node.get("status"))
+                if current["status"]:
+                    self._rows[node["hostname"]]["deployment_status"] = current["status"]
+        self.started = time.time()
+        self.writes = 0
+        self._progressing = set()
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="status-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    def update(self, hostname, event, system_id=None, **fields):
+        """Queue a progress event of hostname; a finished event's status becomes its deployment_status."""
+        self._queue.put((hostname, event, system_id, fields.get("status"), time.time()))
+
+    def stop(self):
+        """Write whatever is still queued and wait for the writer thread."""
+        self._closed.set()
+        self._thread.join()
+        self.logger.info(f"Updated CSV with deployment status at {self.csv_path} "
+                         f"({self.writes} status writes, live status in {self.json_path})")
+
+    def _run(self):
+        dirty = True
+        next_write = time.monotonic()
+        while True:
+            closing = self._closed.is_set()
+            try:
+                dirty |= self._apply(self._queue.get(timeout=max(0.05, min(0.5, next_write - time.monotonic()))))
+                while True:
+                    dirty |= self._apply(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if dirty and (closing or time.monotonic() >= next_write):
+                self._write()
+                dirty = False
+                next_write = time.monotonic() + self.interval
+            if closing and self._queue.empty():
+                return
+
+    def _apply(self, update):
+        hostname, event, system_id, status, ts = update
+        node = self.nodes.get(hostname)
+        if node is None:
+            return False
+        node["updated"] = round(ts, 3)
+        node["system_id"] = system_id or node["system_id"]
+        if event == "finished":
+            self._progressing.add(hostname)
+            node["status"] = status
+            self._rows[hostname]["deployment_status"] = status
+        else:
+            node["event"] = event
+            if hostname not in self._progressing:
+                # Whatever an earlier run left no longer holds once this run moves the node.
+                self._progressing.add(hostname)
+                node["status"] = None
+                self._rows[hostname].pop("deployment_status", None)
+        return True
+
+    def _write(self):
+        counts = {}
+        for node in self.nodes.values():
+            status = node["status"] or "In Progress"
+            counts[status] = counts.get(status, 0) + 1
+        status = {"csv": self.csv_path, "started": round(self.started, 3), "updated": round(time.time(), 3),
+                  "total": len(self.nodes), "finished": len(self.nodes) - counts.get("In Progress", 0),
+                  "counts": counts, "nodes": list(self.nodes.values())}
+        try:
+            write_atomic(self.csv_path, self._write_csv, newline='')
+            write_atomic(self.json_path, lambda f: json.dump(status, f, indent=1))
+            self.writes += 1
+        except OSError as e:
+            self.logger.error(f"Error writing deployment status: {e}")
+
+    def _write_csv(self, f):
+        writer = csv.DictWriter(f, fieldnames=self.fieldnames)
+        writer.writeheader()
+        writer.writerows(self.rows)
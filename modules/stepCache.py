@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from modules.statusWriter import write_atomic
+
+# pcdExpress steps whose work only depends on their arguments and the files
+# they read under pcd_ansible-pcd_develop. apply-hosts-onboard (and the
+# on-prem step) act on the hosts themselves and always run.
+CACHEABLE_STEPS = ("setup-environment", "render-userconfig", "create-hostagents-configs")
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tree_digests(root, directories):
+    """{path relative to root: sha256} of every file under each of root/directories."""
+    digests = {}
+    for directory in directories:
+        for dirpath, _, filenames in os.walk(os.path.join(root, directory)):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                digests[os.path.relpath(path, root)] = file_digest(path)
+    return digests
+
+
+class StepCache:
+    """Remembers the inputs and outputs of the pcdExpress steps, to skip those with nothing new to do.
+
+    The steps read and write the files under directories (user_configs/<portal>/<region>/
+    and <portal>-play_data/<region>/) in the directory they run in. A step's
+    inputs are its arguments, the pcdExpress script, the files named in
+    input_files (the host onboarding template) and every file under
+    directories other than the outputs of the cached steps. The host list is
+    left out of -setup-environment's inputs: it only turns the host template
+    into the nodes data file, which the executor writes for each run itself,
+    so a run that adds hosts reuses the environment and only reruns the steps
+    that render the hosts' configs. Its outputs are the files under
+    directories it created or changed. A step is skipped when its inputs hash
+    the same as the last time it succeeded in that directory and every output
+    it left is still there unchanged, so a deleted or edited output makes it
+    run again. Steps in force always run.
+
+    The cache is a JSON file (path), rewritten after every step that succeeds.
+    """
+
+    def __init__(self, path, directories, nodes_data, logger, force=(), input_files=()):
+        self.path = path
+        self.directories = tuple(directories)
+        self.input_files = tuple(input_files)
+        self.nodes_data = nodes_data
+        self.logger = logger
+        self.force = set(force)
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable step cache {path}: {e}")
+            self.entries = {}
+
+    def cacheable(self, name):
+        return name in CACHEABLE_STEPS and not ({name, "all"} & self.force)
+
+    def _outputs(self, cwd):
+        with self._lock:
+            return {path for key, entry in self.entries.items() if key.startswith(f"{cwd}|")
+                    for path in entry["outputs"]}
+
+    def _inputs(self, name, command, cwd, files, outputs):
+        digest = hashlib.sha256(json.dumps(command).encode())
+        script = os.path.join(cwd, command[0])
+        if os.path.isfile(script):
+            digest.update(file_digest(script).encode())
+        # The host inputs (input_files and the nodes data) are not -setup-environment's.
+        for path in self.input_files if name != "setup-environment" else ():
+            full_path = os.path.join(cwd, path)
+            digest.update(f"{path}\0{file_digest(full_path) if os.path.isfile(full_path) else 'missing'}\0".encode())
+        for path in sorted(files):
+            if path in outputs or (name == "setup-environment" and path == os.path.normpath(self.nodes_data)):
+                continue
+            digest.update(f"{path}\0{files[path]}\0".encode())
+        return digest.hexdigest()
+
+    def begin(self, name, command, cwd):
+        """Before running a step: (True, None) if it can be skipped, else (False, state to hand to store())."""
+        files = tree_digests(cwd, self.directories)
+        inputs = self._inputs(name, command, cwd, files, self._outputs(cwd))
+        with self._lock:
+            entry = self.entries.get(f"{cwd}|{name}")
+        if entry and entry["inputs"] == inputs and all(files.get(path) == digest
+                                                        for path, digest in entry["outputs"].items()):
+            self.logger.info(f"Skipping {name}: its inputs and outputs are unchanged since "
+                             f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['stored']))}")
+            return True, None
+        return False, (name, command, cwd, files)
+
+    def store(self, state):
+        """After a step succeeded: record what it read and what it left."""
+        name, command, cwd, before = state
+        after = tree_digests(cwd, self.directories)
+        with self._lock:
+            previous = self.entries.get(f"{cwd}|{name}", {}).get("outputs", {})
+        # A rerun may rewrite its outputs unchanged; they are still its outputs. The
+        # nodes data file is the executor's, never a step's output.
+        outputs = {path: digest for path, digest in after.items()
+                   if (before.get(path) != digest or path in previous) and path != os.path.normpath(self.nodes_data)}
+        # Hashed without this step's outputs as well, as the next run will see them.
+        inputs = self._inputs(name, command, cwd, before, self._outputs(cwd) | set(outputs))
+        with self._lock:
+            # A later step (or a step of another wave) may rewrite a file an
+            # earlier one counted as its output. Nothing but the steps writes
+            # there during a run, so what is on disk now is what every entry left.
+            for key, entry in self.entries.items():
+                if key.startswith(f"{cwd}|"):
+                    entry["outputs"] = {path: after.get(path, digest) for path, digest in entry["outputs"].items()}
+            self.entries[f"{cwd}|{name}"] = {"inputs": inputs, "outputs": outputs, "stored": round(time.time(), 3)}
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                write_atomic(self.path, lambda f: json.dump(self.entries, f, indent=1))
+            except OSError as e:
+                self.logger.warning(f"Cannot write step cache {self.path}: {e}")
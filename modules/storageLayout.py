@@ -1,67 +1,52 @@
-from logging.handlers import RotatingFileHandler
 import re
-import subprocess
 import json
-import time
-from datetime import datetime
-import os
-import logging
-from typing import Dict
-
-
-def setup_storage_logger(machine_name, log_dir="storage_layout_logs"):
-    os.makedirs(log_dir, exist_ok=True)
-    log_file = f"{machine_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-    log_path = os.path.join(log_dir, log_file)
-
-    logger = logging.getLogger(f"storage_logger_{machine_name}")
-    logger.setLevel(logging.INFO)
-    logger.propagate = False
-
-    file_handler = RotatingFileHandler(log_path, maxBytes=1 * 1024 * 1024, backupCount=5)
-    file_handler.setLevel(logging.INFO)
-
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
-
-    logger.addHandler(file_handler)
-
-    return logger
-
-def run_maas_command(command: str, machine: str = "") -> Dict:
-    """Execute MAAS CLI command with silent handling for expected errors."""
-    try:
-        result = subprocess.run(
-            command.split(),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=30
-        )
-        if result.stderr and "not found" in result.stderr.lower():
-            return {}
-        if result.stderr.strip():
-            raise subprocess.CalledProcessError(
-                returncode=result.returncode,
-                cmd=command,
-                stderr=result.stderr
-            )
-        return json.loads(result.stdout) if result.stdout.strip() else {}
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError, json.JSONDecodeError):
-        return {}
+from concurrent.futures import ThreadPoolExecutor
+from modules.maasClient import MaasError
+from modules.retry import RetryPolicy, is_rejected
+from modules.logPipeline import node_context, in_node_context
+
+
+def storage_logger(maas_logger):
+    """The detail logger of the storage steps: its records go to storage_layout_logs/<hostname>.log only."""
+    return maas_logger.getChild("storage")
+
+
+# Sizes MAAS reports back can differ from what was asked for by partition and
+# LV alignment (4 MiB blocks); anything within this is treated as a match.
+SIZE_TOLERANCE = 8 * 1024**2
+
+# Plan phases in the order they are applied, and whether the operations within
+# a phase are independent of each other. MAAS has no bulk storage endpoints, so
+# independent operations are issued concurrently instead.
+PLAN_PHASES = [
+    ("unmount", True),
+    ("delete-lv", True),
+    ("delete-vg", True),
+    ("delete-partition", False),
+    ("create-partition", False),
+    ("create-vg", False),
+    ("create-lv", True),
+    ("format", True),
+    ("mount", True),
+]
+STORAGE_OP_PARALLELISM = 4
 
 
 def parse_size_to_bytes(size_str: str) -> int:
     if not size_str:
         return 0
 
-    size_str = size_str.strip().upper()
+    size_str = str(size_str).strip().upper()
 
-    match = re.match(r"([\d.]+)([KMGT]?)", size_str)
+    # A plain number is bytes; K/M/G/T may be followed by B or IB ("10GB", "512MiB").
+    match = re.match(r"^([\d.]+)\s*([KMGT]?)(?:I?B)?$", size_str)
     
     if not match:
         raise ValueError(f"Invalid size string format: {size_str}")
-    value = float(match.group(1))
+    try:
+        value = float(match.group(1))
+    except ValueError:
+        raise ValueError(f"Invalid size string format: {size_str}")
     unit = match.group(2) # K, M, G, T or empty for bytes
     multipliers = {
         '': 1,       # Bytes (default if no unit specified)
@@ -76,142 +61,385 @@ def parse_size_to_bytes(size_str: str) -> int:
     }
     return int(value * multipliers.get(unit, 1))
 
-def format_and_mount(machine_id,hostname, boot_disk, boot_part1, boot_efi_part2, vg_id,lv_config,vg_group_name, logger):
-    """Handle filesystem formatting and mounting."""
+def size_matches(actual, size_bytes):
+    """Whether a size reported by MAAS matches a template size converted to bytes."""
     try:
-        logger.info(f"{hostname}: Formatting boot partitions")
-        run_maas_command(f"maas admin partition format {machine_id} {boot_disk} {boot_efi_part2} fstype=fat32", machine_id)
-        run_maas_command(f"maas admin partition format {machine_id} {boot_disk} {boot_part1} fstype=ext4", machine_id)
-
-        logger.info(f"{hostname}: Mounting boot partitions")
-        run_maas_command(f"maas admin partition mount {machine_id} {boot_disk} {boot_efi_part2} mount_point=/boot/efi", machine_id)
-        run_maas_command(f"maas admin partition mount {machine_id} {boot_disk} {boot_part1} mount_point=/boot", machine_id)
-
-        # Format and mount logical volumes
-        logical_volumes = run_maas_command(f"maas admin volume-group read {machine_id} {vg_id}", machine_id).get('logical_volumes', [])
-        fs_type_map = {lv["name"]: lv.get("fs_type") for lv in lv_config}
-        lv_mount_point_map = {lv["name"]: lv.get("mount_point") for lv in lv_config}
-        for lv in logical_volumes:
-            lv_id = lv.get('id')
-            lv_name = lv.get('name', '')
-        
-            if not lv_id or not lv_name:
+        actual = int(actual)
+    except (TypeError, ValueError):
+        return False
+    return abs(actual - size_bytes) <= SIZE_TOLERANCE
+
+
+class Volume:
+    """One logical volume of a compiled layout."""
+
+    def __init__(self, name, size, fs_type, mount_point):
+        self.name = name
+        self.size = size
+        self.size_bytes = parse_size_to_bytes(size)
+        # Swap is formatted but never mounted.
+        if 'swap' in name:
+            self.fs_type, self.mount_point = "swap", None
+        else:
+            self.fs_type, self.mount_point = fs_type or "ext4", mount_point or None
+
+
+class Partition:
+    """One boot disk partition of a compiled layout, in on-disk order."""
+
+    def __init__(self, role, size, size_bytes, bootable, fs_type, mount_point):
+        self.role = role
+        self.size = size
+        self.size_bytes = size_bytes
+        self.bootable = bootable
+        self.fs_type = fs_type
+        self.mount_point = mount_point
+
+
+class LayoutSpec:
+    """Storage layout template compiled once per run and shared read-only by all workers.
+
+    The boot disk gets an EFI partition, a /boot partition and one data
+    partition holding a volume group with the template's logical volumes.
+    Sizes are validated and converted to bytes up front, so a bad template
+    fails at startup rather than halfway through a deployment.
+    """
+
+    def __init__(self, vg_group, boot_efi_size, boot_size, volumes):
+        errors = []
+
+        def size_bytes(label, size):
+            try:
+                value = parse_size_to_bytes(size)
+            except ValueError:
+                errors.append(f"{label}: invalid size {size!r}")
+                return 0
+            if value <= 0:
+                errors.append(f"{label}: size must be greater than zero")
+            return value
+
+        if not vg_group or not isinstance(vg_group, str):
+            errors.append("vg_group must be a non-empty string")
+        self.vg_group = vg_group
+        self.volumes = []
+        seen = set()
+        for index, lv in enumerate(volumes):
+            name = lv.get("name") if isinstance(lv, dict) else None
+            if not name:
+                errors.append(f"volumes[{index}]: missing name")
                 continue
-            base_name = lv_name[len(vg_group_name) + 1:] if lv_name.startswith(f"{vg_group_name}-") else lv_name
-            fs_type = fs_type_map.get(base_name, "ext4")
-            lv_mount_point = lv_mount_point_map.get(base_name, "")
-            if 'swap' in base_name:
-                # Format swap, do not mount
-                logger.info(f"{hostname}: Formatting LV '{base_name}' as swap")
-                run_maas_command(f"maas admin block-device format {machine_id} {lv_id} fstype=swap", machine_id)
+            if name in seen:
+                errors.append(f"volume {name}: defined more than once")
+            seen.add(name)
+            if size_bytes(f"volume {name}", lv.get("size")):
+                self.volumes.append(Volume(name, str(lv["size"]).strip(), lv.get("fs_type"), lv.get("mount_point")))
+        efi_bytes = size_bytes("boot_efi_size", boot_efi_size)
+        boot_bytes = size_bytes("boot_size", boot_size)
+        if errors:
+            raise ValueError("Invalid storage layout template: " + "; ".join(errors))
+
+        data_bytes = sum(lv.size_bytes for lv in self.volumes)
+        self.partitions = [
+            Partition("efi", boot_efi_size, efi_bytes, True, "fat32", "/boot/efi"),
+            Partition("boot", boot_size, boot_bytes, False, "ext4", "/boot"),
+            Partition("data", str(data_bytes), data_bytes, False, None, None),
+        ]
+        self.fs_types = {lv.name: lv.fs_type for lv in self.volumes}
+        self.mount_points = {lv.name: lv.mount_point for lv in self.volumes}
+        self.total_bytes = sum(part.size_bytes for part in self.partitions)
+
+    @classmethod
+    def from_template(cls, lv_config_data):
+        return cls(lv_config_data.get("vg_group", "maas_vg"),  # fallback default
+                   lv_config_data.get("boot_efi_size", "0.5G"),
+                   lv_config_data.get("boot_size", "1G"),
+                   lv_config_data.get("volumes", []))
+
+    @classmethod
+    def load(cls, storage_layout_template):
+        """Read and compile a template file; raises ValueError if it is unreadable or invalid."""
+        if isinstance(storage_layout_template, cls):
+            return storage_layout_template
+        try:
+            with open(storage_layout_template, 'r') as f:
+                return cls.from_template(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            raise ValueError(f"Cannot read storage layout template {storage_layout_template}: {e}")
+
+    def check_fits(self, disk_size):
+        """Raise ValueError if the layout does not fit on a boot disk of disk_size bytes."""
+        if disk_size and self.total_bytes > int(disk_size):
+            raise ValueError(f"layout needs {self.total_bytes} bytes but the boot disk has {disk_size}")
+
+
+class CurrentLayout:
+    """A machine's storage as MAAS reports it, read with one call per object kind."""
+
+    def __init__(self, boot_disk, devices, volume_groups, boot_disk_size=None):
+        self.boot_disk = boot_disk
+        self.boot_disk_size = boot_disk_size
+        self.devices = devices
+        self.volume_groups = volume_groups
+
+    @classmethod
+    def read(cls, client, machine_id):
+        boot_disk = client.call("machine", "read", machine_id).get("boot_disk") or {}
+        devices = client.call("block-devices", "read", machine_id)
+        volume_groups = client.call("volume-groups", "read", machine_id)
+        return cls(boot_disk.get("id"), devices, volume_groups, boot_disk.get("size"))
+
+    def device(self, device_id):
+        return next((d for d in self.devices if d.get("id") == device_id), {})
+
+    def boot_partitions(self):
+        return self.device(self.boot_disk).get("partitions", [])
+
+
+class Ref:
+    """Id of an object created earlier in the same plan."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"<{self.name}>"
+
+
+class StorageOp:
+    """One MAAS storage call of a plan (the machine id is implied)."""
+
+    def __init__(self, phase, description, resource, action, ids=(), params=None, produces=None):
+        self.phase = phase
+        self.description = description
+        self.resource = resource
+        self.action = action
+        self.ids = list(ids)
+        self.params = params or {}
+        self.produces = produces
+
+    def __str__(self):
+        return f"[{self.phase}] {self.description}"
+
+    def run(self, client, machine_id, handles):
+        def resolve(value):
+            if not isinstance(value, Ref):
+                return value
+            if handles.get(value.name) is None:
+                raise MaasError(f"{self.description}: {value.name} was not created")
+            return handles[value.name]
+
+        ids = [resolve(i) for i in self.ids]
+        params = {key: resolve(value) for key, value in self.params.items()}
+        result = client.call(self.resource, self.action, machine_id, *ids, **params)
+        if self.produces:
+            handles[self.produces] = result.get("id") if isinstance(result, dict) else None
+        return result
+
+
+def _filesystem_ops(plan, kind, target, label, current_fs, fstype, mount_point, ids):
+    """Append the unmount/format/mount ops needed to take target from current_fs to (fstype, mount_point)."""
+    current_fs = current_fs or {}
+    current_mount = current_fs.get("mount_point") or None
+    reformat = current_fs.get("fstype") != fstype
+    remount = reformat or current_mount != mount_point
+    if current_mount and remount:
+        plan.append(StorageOp("unmount", f"unmount {label} from {current_mount}", kind, "unmount", ids))
+    if reformat:
+        plan.append(StorageOp("format", f"format {label} as {fstype}", kind, "format", ids, {"fstype": fstype}))
+    if mount_point and remount:
+        plan.append(StorageOp("mount", f"mount {label} at {mount_point}", kind, "mount", ids,
+                              {"mount_point": mount_point}))
+
+
+def plan_layout(current, spec):
+    """Minimal list of StorageOps that turns the current layout into the spec's.
+
+    Boot disk partitions are kept for as long as they match the spec in order
+    and size, the volume group is kept when it sits on the kept data partition,
+    and logical volumes are kept when name and size match; only filesystems
+    that differ are reformatted or remounted. Everything else is removed.
+    """
+    plan = []
+    boot_disk = current.boot_disk
+
+    existing = current.boot_partitions()
+    kept = 0
+    for spec_part, part in zip(spec.partitions, existing):
+        if not size_matches(part.get("size"), spec_part.size_bytes):
+            break
+        kept += 1
+    kept_ids = {part.get("id") for part in existing[:kept]}
+    data_part = existing[2].get("id") if kept == 3 else None
+
+    vg_keep = None
+    for vg in current.volume_groups:
+        devices = {d.get("id") for d in vg.get("devices", [])}
+        if vg_keep is None and vg.get("name") == spec.vg_group and data_part and devices == {data_part}:
+            vg_keep = vg
+            continue
+        for lv in vg.get("logical_volumes", []):
+            # MAAS refuses to delete a volume group whose LVs are mounted; dropping
+            # the LVs first works whatever their state.
+            plan.append(StorageOp("delete-lv", f"delete LV {lv.get('name')}", "block-device", "delete",
+                                  [lv.get("id")]))
+        plan.append(StorageOp("delete-vg", f"delete volume group {vg.get('name')}", "volume-group", "delete",
+                              [vg.get("id")]))
+
+    for device in current.devices:
+        for part in device.get("partitions", []):
+            if device.get("id") == boot_disk and part.get("id") in kept_ids:
                 continue
-
-            logger.info(f"{hostname}: Formatting LV '{base_name}' as {fs_type}")
-            run_maas_command(f"maas admin block-device format {machine_id} {lv_id} fstype={fs_type}", machine_id)
-
-            logger.info(f"{hostname}: Mounting LV '{base_name}' at '{lv_mount_point}'")
-            run_maas_command(f"maas admin block-device mount {machine_id} {lv_id} mount_point={lv_mount_point}", machine_id)
-        logger.info(f"{hostname}: Formatting and mounting completed successfully")
-    except Exception as e:
-        logger.error(f"{hostname}: Format/mount failed for {base_name} - {str(e)}")
-        raise
-
-def process_machine(machine_id,hostname,storage_layout_template,logger):
+            plan.append(StorageOp("delete-partition", f"delete partition {part.get('id')} on {device.get('name')}",
+                                  "partition", "delete", [device.get("id"), part.get("id")]))
+
+    handles = {}
+    for index, spec_part in enumerate(spec.partitions):
+        role = spec_part.role
+        if index < kept:
+            part = existing[index]
+            handles[role] = part.get("id")
+            current_fs = part.get("filesystem")
+        else:
+            handles[role] = Ref(f"{role} partition")
+            current_fs = None
+            plan.append(StorageOp("create-partition", f"create {role} partition ({spec_part.size})", "partitions",
+                                  "create", [boot_disk], {"size": spec_part.size_bytes,
+                                                          "bootable": str(spec_part.bootable).lower()},
+                                  produces=handles[role].name))
+        if spec_part.fs_type:
+            _filesystem_ops(plan, "partition", handles[role], f"{role} partition", current_fs, spec_part.fs_type,
+                            spec_part.mount_point, [boot_disk, handles[role]])
+
+    if vg_keep:
+        vg_id = vg_keep.get("id")
+        existing_lvs = vg_keep.get("logical_volumes", [])
+    else:
+        vg_id = Ref("volume group")
+        existing_lvs = []
+        plan.append(StorageOp("create-vg", f"create volume group {spec.vg_group}", "volume-groups", "create",
+                              params={"name": spec.vg_group, "partitions": handles["data"]}, produces=vg_id.name))
+
+    lvs_by_name = {}
+    for lv in existing_lvs:
+        name = lv.get("name", "")
+        lvs_by_name[name[len(spec.vg_group) + 1:] if name.startswith(f"{spec.vg_group}-") else name] = lv
+    wanted = {lv.name for lv in spec.volumes}
+    for name, lv in lvs_by_name.items():
+        if name not in wanted:
+            plan.append(StorageOp("delete-lv", f"delete LV {lv.get('name')}", "block-device", "delete", [lv.get("id")]))
+
+    for lv in spec.volumes:
+        name, size = lv.name, lv.size
+        fstype, mount_point = spec.fs_types[name], spec.mount_points[name]
+        existing_lv = lvs_by_name.get(name)
+        if existing_lv and size_matches(existing_lv.get("size"), lv.size_bytes):
+            lv_id = existing_lv.get("id")
+            current_fs = existing_lv.get("filesystem")
+        else:
+            if existing_lv:
+                plan.append(StorageOp("delete-lv", f"delete LV {existing_lv.get('name')} (size changed)",
+                                      "block-device", "delete", [existing_lv.get("id")]))
+            lv_id = Ref(f"LV {name}")
+            current_fs = None
+            plan.append(StorageOp("create-lv", f"create LV {name} ({size})", "volume-group", "create-logical-volume",
+                                  [vg_id], {"name": name, "size": str(lv.size_bytes)}, produces=lv_id.name))
+        _filesystem_ops(plan, "block-device", lv_id, f"LV {name}", current_fs, fstype, mount_point, [lv_id])
+    order = [phase for phase, _ in PLAN_PHASES]
+    return sorted(plan, key=lambda op: order.index(op.phase))
+
+
+def apply_plan(client, machine_id, hostname, plan, logger, parallelism=STORAGE_OP_PARALLELISM, retry=None):
+    """Run a plan phase by phase; independent operations of a phase run concurrently.
+
+    An operation the region rejected outright (429/503) is sent again in place
+    per retry; any other failure ends the plan.
+    """
+    handles = {}
+    retry = retry or RetryPolicy("storage", attempts=1)
+
+    def run(op):
+        retry.call(lambda: op.run(client, machine_id, handles), hostname, logger, retry_on=is_rejected)
+
+    for phase, independent in PLAN_PHASES:
+        ops = [op for op in plan if op.phase == phase]
+        for op in ops:
+            logger.info(f"{hostname}: {op}")
+        if independent and len(ops) > 1:
+            with ThreadPoolExecutor(max_workers=min(parallelism, len(ops)), thread_name_prefix="storage-op") as pool:
+                list(pool.map(in_node_context(run), ops))
+        else:
+            for op in ops:
+                run(op)
+
+
+def describe_plan(plan):
+    if not plan:
+        return ["layout already matches the template, nothing to do"]
+    return [f"{len(plan)} storage operations planned"] + [f"  {op}" for op in plan]
+
+
+def process_machine(client, machine_id, hostname, storage_layout_template, logger, dry_run=False, retry=None):
+    """Plan the storage changes for one machine and, unless dry_run, apply them. Returns the plan.
+
+    storage_layout_template is a compiled LayoutSpec (or a template path, compiled here).
+    """
     try:
-        with open(storage_layout_template, 'r') as f:
-            lv_config_data = json.load(f)
-            vg_group_name = lv_config_data.get("vg_group", "maas_vg")  # fallback default
-            boot_efi_size = lv_config_data.get("boot_efi_size", "0.5G")
-            boot_size = lv_config_data.get("boot_size", "1G")
-            lv_config = lv_config_data.get("volumes", [])
-            
-        logger.info(f"{hostname}: Starting storage configuration")
+        spec = LayoutSpec.load(storage_layout_template)
 
-        # Get boot disk
-        machine_info = run_maas_command(f"maas admin machine read {machine_id}", machine_id)
-        boot_disk = machine_info.get('boot_disk', {}).get('id')
-        if not boot_disk:
+        logger.info(f"{hostname}: Starting storage configuration")
+        current = CurrentLayout.read(client, machine_id)
+        if not current.boot_disk:
             logger.warning(f"{hostname}: No boot disk found")
-            return
-        
-        logger.info(f"{hostname}: Cleaning existing volume groups")
-        for vg in run_maas_command(f"maas admin volume-groups read {machine_id}", machine_id):
-            if vg_id := vg.get('id'):
-                for lv in run_maas_command(f"maas admin volume-group read {machine_id} {vg_id}", machine_id).get('logical_volumes', []):
-                    if lv_id := lv.get('id'):
-                        run_maas_command(f"maas admin block-device delete {machine_id} {lv_id}", machine_id)
-                run_maas_command(f"maas admin volume-group delete {machine_id} {vg_id}", machine_id)
-
-        logger.info(f"{hostname}: Cleaning partitions on all devices")
-        for device in run_maas_command(f"maas admin block-devices read {machine_id}", machine_id):
-            if device_id := device.get('id'):
-                for part in run_maas_command(f"maas admin partitions read {machine_id} {device_id}", machine_id):
-                    if part_id := part.get('id'):
-                        run_maas_command(f"maas admin partition delete {machine_id} {device_id} {part_id}", machine_id)
-                        
-
-        # Create new layout
-        logger.info(f"{hostname}: Creating new partitions on boot disk {boot_disk}")
-        boot_efi_size_bytes = parse_size_to_bytes(boot_efi_size)
-        boot_efi_part2 = run_maas_command(
-            f"maas admin partitions create {machine_id} {boot_disk} size={boot_efi_size_bytes} bootable=true",
-            machine_id
-        ).get('id')
-        logger.info(f"{hostname}: Created /boot/efi partition (ID: {boot_efi_part2})")
-        boot_size_bytes = parse_size_to_bytes(boot_size)
-        boot_part1 = run_maas_command(
-            f"maas admin partitions create {machine_id} {boot_disk} size={boot_size_bytes} bootable=false",
-            machine_id
-        ).get('id')
-        logger.info(f"{hostname}: Created /boot partition (ID: {boot_part1})")
-
-        disk_size = sum(float(re.match(r"([\d.]+)", v["size"]).group(1)) * {"G": 1, "M": 1/1024, "T": 1024}[v["size"][-1]] for v in lv_config if v["size"])
-        disk_size_bytes = int(disk_size * (1024**3))
-        data_part = run_maas_command(
-            f"maas admin partitions create {machine_id} {boot_disk} size={disk_size_bytes}",
-            machine_id
-        ).get('id')
-
-        if data_part:
-            logger.info(f"{hostname}: Creating volume group {vg_group_name}")
-            vg = run_maas_command(
-                f"maas admin volume-groups create {machine_id} name={vg_group_name} partitions={data_part}",
-                machine_id
-            )
-
-            logger.info(f"{hostname}: Loaded {len(lv_config)} LV configs from template")
-            if vg_id := vg.get('id'):
-                for lv in lv_config:
-                    name = lv["name"]
-                    size = lv["size"]
-                    logger.info(f"{hostname}: Creating LV '{name}' with size {size}")
-                    run_maas_command(
-                        f"maas admin volume-group create-logical-volume {machine_id} {vg_id} name={name} size={size}",
-                        machine_id
-                    )
-
-                logger.info(f"{hostname}: Formatting and mounting LVs")
-                format_and_mount(machine_id,hostname, boot_disk, boot_part1, boot_efi_part2, vg_id,lv_config,vg_group_name, logger)
-
-        logger.info(f"{hostname}: Storage configuration complete")
-
+            return None
+        spec.check_fits(current.boot_disk_size)
+
+        plan = plan_layout(current, spec)
+        for line in describe_plan(plan):
+            logger.info(f"{hostname}: {line}")
+        if not dry_run:
+            apply_plan(client, machine_id, hostname, plan, logger, retry=retry)
+            logger.info(f"{hostname}: Storage configuration complete")
+        return plan
+
+    except MaasError as e:
+        logger.error(f"{hostname}: Configuration failed - {str(e)}")
+        if e.transient:
+            raise
+        return None
     except Exception as e:
         logger.error(f"{hostname}: Configuration failed - {str(e)}")
+        return None
+
 
+def create_storage_layout(client, system_id, hostname, storage_layout_template, maas_logger, dry_run=False,
+                          retry=None, span=None):
+    """Returns True if the layout was applied (or, with dry_run, planned).
 
-def create_storage_layout(system_id,hostname,storage_layout_template,maas_logger):
-    logger = setup_storage_logger(hostname)
+    Per retry, an operation the region rejected is sent again in place, and any
+    other transient MAAS error fails the attempt: the whole layout is then read,
+    planned and applied again, and the new plan only holds what is still missing.
+    """
+    with node_context(hostname=hostname, system_id=system_id, stage="storage"):
+        return _create_storage_layout(client, system_id, hostname, storage_layout_template, maas_logger, dry_run,
+                                      retry, span)
+
+
+def _create_storage_layout(client, system_id, hostname, storage_layout_template, maas_logger, dry_run, retry, span):
+    logger = storage_logger(maas_logger)
     logger.info("Starting MAAS storage configuration")
     maas_logger.info(f"{hostname}: MAAS storage configuration started")
+    retry = retry or RetryPolicy("storage", attempts=1)
     try:
-        process_machine(system_id,hostname,storage_layout_template,logger)
-        time.sleep(1)  # Stagger start slightly
+        plan = retry.call(lambda: process_machine(client, system_id, hostname, storage_layout_template, logger, dry_run,
+                                                  retry),
+                          hostname, maas_logger, span)
+        if dry_run and plan is not None:
+            for line in describe_plan(plan):
+                maas_logger.info(f"{hostname}: (dry run) {line}")
+        return plan is not None
 
     except Exception as e:
         logger.error(f"Fatal error: {str(e)}")
+        return False
     finally:
         logger.info("MAAS storage configuration completed")
-
-
-
-
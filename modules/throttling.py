@@ -0,0 +1,206 @@
+import time
+import asyncio
+import ipaddress
+import threading
+from collections import Counter
+from contextlib import contextmanager, asynccontextmanager
+from modules.maasClient import MaasError
+
+# Operations that can be throttled, and what a limit can be keyed on:
+#   global          one limit shared by every machine
+#   subnet          the BMC (power_address) subnet, /prefix wide
+#   rack            the CSV `rack` column, falling back to the BMC subnet
+#   rack_controller the primary rack controller of the BMC's MAAS subnet,
+#                   falling back to the BMC subnet
+OPERATIONS = ("create", "storage", "deploy", "power-update")
+KEY_KINDS = ("global", "subnet", "rack", "rack_controller")
+
+
+class TokenBucket:
+    """rate tokens per second, at most burst of them saved up.
+
+    reserve() always takes a token, going into debt if none is left, and
+    returns how long the caller has to wait before using it.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Limit:
+    """Concurrency and/or rate limit for one operation, applied separately per key."""
+
+    def __init__(self, operation, key="global", concurrency=None, rate=None, burst=1, prefix=24):
+        if operation not in OPERATIONS:
+            raise ValueError(f"unknown operation {operation!r}, expected one of {', '.join(OPERATIONS)}")
+        if key not in KEY_KINDS:
+            raise ValueError(f"unknown key {key!r}, expected one of {', '.join(KEY_KINDS)}")
+        if not concurrency and not rate:
+            raise ValueError(f"{operation}: set concurrency and/or rate")
+        self.operation = operation
+        self.key = key
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+
+    def __str__(self):
+        parts = [f"{self.operation} per {self.key}"]
+        if self.concurrency:
+            parts.append(f"concurrency={self.concurrency}")
+        if self.rate:
+            parts.append(f"rate={self.rate}/s burst={self.burst}")
+        return " ".join(parts)
+
+
+def parse_limit(spec):
+    """Parse 'deploy,key=subnet,concurrency=4,rate=0.5,burst=2' into a Limit (raises ValueError)."""
+    operation, *options = [part.strip() for part in spec.split(",")]
+    kwargs = {}
+    for option in options:
+        name, _, value = option.partition("=")
+        try:
+            if name == "key":
+                kwargs["key"] = value
+            elif name in ("concurrency", "burst", "prefix"):
+                kwargs[name] = int(value)
+            elif name == "rate":
+                kwargs["rate"] = float(value)
+            else:
+                raise ValueError(f"unknown option {name!r}")
+        except ValueError as e:
+            raise ValueError(f"invalid throttle '{spec}': {e}")
+    return Limit(operation, **kwargs)
+
+
+def rack_controller_map(client):
+    """[(network, primary rack controller id)] for every MAAS subnet, most specific first."""
+    networks = []
+    for subnet in client.call("subnets", "read"):
+        rack = (subnet.get("vlan") or {}).get("primary_rack")
+        try:
+            network = ipaddress.ip_network(subnet.get("cidr"), strict=False)
+        except (TypeError, ValueError):
+            continue
+        if rack:
+            networks.append((network, rack))
+    return sorted(networks, key=lambda entry: -entry[0].prefixlen)
+
+
+class Throttle:
+    """Per-operation, per-key limits shared by all workers of a run.
+
+    slot(operation, row) (or slot_async in the asyncio engine) holds one of the
+    key's concurrency slots for the duration of the block and, when a rate is
+    set, waits for a token before entering it. Operations without a limit pass
+    straight through.
+    """
+
+    def __init__(self, limits=(), rack_controllers=None):
+        self.limits = {limit.operation: limit for limit in limits}
+        self.rack_controllers = rack_controllers or []
+        self.waited = Counter()
+        self._buckets = {}
+        self._semaphores = {}
+        self._async_semaphores = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, limits, client, logger):
+        rack_controllers = []
+        if any(limit.key == "rack_controller" for limit in limits):
+            try:
+                rack_controllers = rack_controller_map(client)
+            except MaasError as e:
+                logger.warning(f"Cannot read MAAS subnets, rack controller limits fall back to BMC subnets: {e}")
+        for limit in limits:
+            logger.info(f"Throttling {limit}")
+        return cls(limits, rack_controllers)
+
+    def key_for(self, limit, row):
+        if limit.key == "global":
+            return "*"
+        if limit.key == "rack" and row.get("rack"):
+            return row["rack"]
+        address = row.get("power_address", "")
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return address
+        if limit.key == "rack_controller":
+            for network, rack in self.rack_controllers:
+                if ip in network:
+                    return rack
+        return str(ipaddress.ip_network(f"{ip}/{limit.prefix}", strict=False))
+
+    def _limiters(self, operation, row, semaphores, new_semaphore):
+        limit = self.limits.get(operation)
+        if not limit:
+            return None, None, None
+        key = (operation, self.key_for(limit, row))
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if limit.rate and not bucket:
+                bucket = self._buckets[key] = TokenBucket(limit.rate, limit.burst)
+            semaphore = semaphores.get(key)
+            if limit.concurrency and not semaphore:
+                semaphore = semaphores[key] = new_semaphore(limit.concurrency)
+        return key, bucket, semaphore
+
+    def _record_wait(self, key, started):
+        waited = time.monotonic() - started
+        if waited >= 0.01:
+            with self._lock:
+                self.waited[key] += waited
+
+    @contextmanager
+    def slot(self, operation, row):
+        key, bucket, semaphore = self._limiters(operation, row, self._semaphores, threading.BoundedSemaphore)
+        if not key:
+            yield
+            return
+        started = time.monotonic()
+        if semaphore:
+            semaphore.acquire()
+        try:
+            if bucket:
+                time.sleep(bucket.reserve())
+            self._record_wait(key, started)
+            yield
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    @asynccontextmanager
+    async def slot_async(self, operation, row):
+        key, bucket, semaphore = self._limiters(operation, row, self._async_semaphores, asyncio.Semaphore)
+        if not key:
+            yield
+            return
+        started = time.monotonic()
+        if semaphore:
+            await semaphore.acquire()
+        try:
+            if bucket:
+                await asyncio.sleep(bucket.reserve())
+            self._record_wait(key, started)
+            yield
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    def summary(self):
+        """One line per throttled (operation, key) that made callers wait, longest first."""
+        return [f"{operation}[{key}] waited {seconds:.1f}s" for (operation, key), seconds in self.waited.most_common()]
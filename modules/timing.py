@@ -0,0 +1,177 @@
+import os
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Spans whose stage starts with this belong to onboarding batches rather than
+# to one node; their hostname is the batch label.
+ONBOARD_PREFIX = "onboard:"
+
+
+class Span:
+    """One timed step of one node (or onboarding batch). The body may set outcome and retries."""
+
+    def __init__(self, hostname, stage):
+        self.hostname = hostname
+        self.stage = stage
+        self.start = time.time()
+        self._started = time.monotonic()
+        self.end = None
+        self.duration = None
+        self.retries = 0
+        self.outcome = "ok"
+
+    def as_dict(self):
+        return {"hostname": self.hostname, "stage": self.stage, "start": round(self.start, 3),
+                "end": round(self.end, 3), "duration": round(self.duration, 3), "retries": self.retries,
+                "outcome": self.outcome}
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class SpanRecorder:
+    """Collects per-node, per-stage spans for the run.
+
+    Every finished span is appended to path (JSON lines) straight away, so the
+    file is usable while the run is still going; summary() and
+    write_metrics() report on everything collected at the end.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.spans = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a")
+
+    def start(self, hostname, stage):
+        return Span(hostname, stage)
+
+    def end(self, span, outcome=None, retries=None):
+        span.duration = time.monotonic() - span._started
+        span.end = span.start + span.duration
+        if outcome is not None:
+            span.outcome = outcome
+        if retries is not None:
+            span.retries = retries
+        with self._lock:
+            self.spans.append(span)
+            if self._file:
+                self._file.write(json.dumps(span.as_dict()) + "\n")
+                self._file.flush()
+        return span
+
+    @contextmanager
+    def span(self, hostname, stage):
+        span = self.start(hostname, stage)
+        try:
+            yield span
+        except BaseException as e:
+            self.end(span, f"error: {e}")
+            raise
+        self.end(span)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def stage_stats(self):
+        """{stage: (count, failures, total, p50, p95, max)} in the order stages first finished."""
+        by_stage = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            by_stage.setdefault(span.stage, []).append(span)
+        stats = {}
+        for stage, stage_spans in by_stage.items():
+            durations = sorted(span.duration for span in stage_spans)
+            failures = sum(1 for span in stage_spans if span.outcome != "ok")
+            stats[stage] = (len(durations), failures, sum(durations), percentile(durations, 0.5),
+                            percentile(durations, 0.95), durations[-1])
+        return stats
+
+    def node_durations(self):
+        """{hostname: seconds from its first span's start to its last span's end} for node spans."""
+        bounds = {}
+        for span in self.spans:
+            if span.stage.startswith(ONBOARD_PREFIX):
+                continue
+            first, last = bounds.get(span.hostname, (span.start, span.end))
+            bounds[span.hostname] = (min(first, span.start), max(last, span.end))
+        return {hostname: last - first for hostname, (first, last) in bounds.items()}
+
+    def critical_path(self):
+        """Chain of spans that ended the run: from the last span to finish, back through the
+        same node's earlier spans; an onboarding batch step hands over to whatever finished
+        last before it started."""
+        spans = sorted(self.spans, key=lambda span: span.end)
+        if not spans:
+            return []
+        path = [spans[-1]]
+        while True:
+            current = path[-1]
+            earlier = [span for span in spans if span.end <= current.start + 1e-3 and span not in path]
+            candidates = [span for span in earlier if span.hostname == current.hostname]
+            if not candidates and current.stage.startswith(ONBOARD_PREFIX):
+                candidates = earlier
+            if not candidates:
+                break
+            path.append(candidates[-1])
+        return list(reversed(path))
+
+    def summary(self, slowest=5):
+        """Report lines: per-stage p50/p95/max, the slowest nodes and the critical path."""
+        stats = self.stage_stats()
+        if not stats:
+            return []
+        lines = [f"{'stage':<36}{'count':>6}{'failed':>7}{'p50 s':>9}{'p95 s':>9}{'max s':>9}"]
+        for stage, (count, failures, _, p50, p95, longest) in stats.items():
+            lines.append(f"{stage:<36}{count:>6}{failures:>7}{p50:>9.1f}{p95:>9.1f}{longest:>9.1f}")
+        nodes = sorted(self.node_durations().items(), key=lambda item: -item[1])[:slowest]
+        if nodes:
+            lines.append("Slowest nodes: " + ", ".join(f"{hostname} {seconds:.1f}s" for hostname, seconds in nodes))
+        path = self.critical_path()
+        if path:
+            steps = []
+            for previous, span in zip([None] + path[:-1], path):
+                if previous and span.start - previous.end >= 0.1:
+                    steps.append(f"(waiting {span.start - previous.end:.1f}s)")
+                steps.append(f"{span.hostname} {span.stage} {span.duration:.1f}s")
+            lines.append(f"Critical path ({path[-1].end - path[0].start:.1f}s): " + " -> ".join(steps))
+        return lines
+
+    def write_metrics(self, path):
+        """Write the stage statistics as a Prometheus textfile (atomically, for the node exporter)."""
+        stats = self.stage_stats()
+        lines = [
+            "# HELP maas_provisioning_stage_seconds Duration of provisioning and onboarding stages.",
+            "# TYPE maas_provisioning_stage_seconds summary",
+        ]
+        for stage, (count, _, total, p50, p95, _) in stats.items():
+            lines.append(f'maas_provisioning_stage_seconds{{stage="{stage}",quantile="0.5"}} {p50:.3f}')
+            lines.append(f'maas_provisioning_stage_seconds{{stage="{stage}",quantile="0.95"}} {p95:.3f}')
+            lines.append(f'maas_provisioning_stage_seconds_sum{{stage="{stage}"}} {total:.3f}')
+            lines.append(f'maas_provisioning_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines += ["# HELP maas_provisioning_stage_max_seconds Longest run of each stage.",
+                  "# TYPE maas_provisioning_stage_max_seconds gauge"]
+        lines += [f'maas_provisioning_stage_max_seconds{{stage="{stage}"}} {stat[5]:.3f}' for stage, stat in stats.items()]
+        lines += ["# HELP maas_provisioning_stage_failures_total Stage runs that did not succeed.",
+                  "# TYPE maas_provisioning_stage_failures_total counter"]
+        lines += [f'maas_provisioning_stage_failures_total{{stage="{stage}"}} {stat[1]}' for stage, stat in stats.items()]
+        lines += ["# HELP maas_provisioning_run_seconds Wall-clock duration of the run.",
+                  "# TYPE maas_provisioning_run_seconds gauge",
+                  f"maas_provisioning_run_seconds {time.time() - self.started:.3f}"]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
@@ -0,0 +1,48 @@
+import socket
+import asyncio
+import logging
+import pytest
+from modules.maasClient import MaasError
+from modules.asyncEngine import AsyncMaasApiClient, AsyncFleetPoller
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_refused_connection_is_a_transient_maas_error():
+    async def call():
+        client = AsyncMaasApiClient(f"http://127.0.0.1:{closed_port()}/MAAS", "a:b:c", timeout=5)
+        await client.call("machines", "read")
+
+    with pytest.raises(MaasError) as excinfo:
+        asyncio.run(call())
+    assert excinfo.value.transient
+
+
+class FlakyClient:
+    """Fails the first bulk read with an unexpected error, then reports every machine Ready."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def call(self, resource, action, **params):
+        self.calls += 1
+        if self.calls == 1:
+            raise AttributeError("'str' object has no attribute 'get'")
+        return [{"system_id": system_id, "status_name": "Ready"} for system_id in params.get("id", [])]
+
+
+def test_poller_keeps_running_after_an_unexpected_poll_error():
+    async def wait():
+        poller = AsyncFleetPoller(FlakyClient(), logging.getLogger("test"), min_interval=0.01, max_interval=0.05)
+        task = asyncio.create_task(poller.run())
+        try:
+            return await asyncio.wait_for(poller.wait_for_async("a", "Ready", "node-a", 10), 5)
+        finally:
+            poller.stop()
+            await task
+
+    assert asyncio.run(wait()) == (True, "Ready")
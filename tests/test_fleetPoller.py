@@ -0,0 +1,100 @@
+import time
+import asyncio
+import logging
+import threading
+from modules import fleetPoller
+from modules.fleetPoller import FleetPoller
+from modules.asyncEngine import AsyncFleetPoller
+
+
+class FakeClient:
+    """Answers `machines read` with the statuses set by the test."""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def call(self, resource, action, **params):
+        return [{"system_id": system_id, "status_name": status} for system_id, status in self.statuses.items()]
+
+
+def test_raising_callback_does_not_stop_the_other_waits():
+    client = FakeClient({"a": "Commissioning", "b": "Commissioning"})
+    poller = FleetPoller(client, logging.getLogger("test"), min_interval=0.01, max_interval=0.05).start()
+    try:
+        def explode(ok, status):
+            raise RuntimeError("callback bug")
+
+        poller.watch("a", "Ready", "node-a", 10, explode)
+        done = threading.Event()
+        results = []
+        poller.watch("b", "Ready", "node-b", 10, lambda ok, status: (results.append((ok, status)), done.set()))
+        # Both changes are picked up by the poller thread, "a" first.
+        client.statuses["a"] = "Ready"
+        while "a" in poller._watched_ids():
+            time.sleep(0.01)
+        client.statuses["b"] = "Ready"
+        assert done.wait(5)
+        assert results == [(True, "Ready")]
+    finally:
+        poller.stop()
+
+
+class MalformedOnceClient(FakeClient):
+    """The first bulk read returns a body the poller cannot parse."""
+
+    def call(self, resource, action, **params):
+        if not hasattr(self, "answered"):
+            self.answered = True
+            return ["not a machine"]
+        return super().call(resource, action, **params)
+
+
+def test_malformed_poll_does_not_stop_the_poller():
+    poller = FleetPoller(MalformedOnceClient({"a": "Ready"}), logging.getLogger("test"),
+                         min_interval=0.01, max_interval=0.05).start()
+    try:
+        done = threading.Event()
+        poller.watch("a", "Ready", "node-a", 10, lambda ok, status: done.set())
+        assert done.wait(5)
+    finally:
+        poller.stop()
+
+
+def test_machine_is_only_given_up_on_once_unknown_for_the_grace_period(monkeypatch):
+    monkeypatch.setattr(fleetPoller, "UNKNOWN_GRACE", 0.2)
+    client = FakeClient({"b": "Commissioning"})
+    poller = FleetPoller(client, logging.getLogger("test"))
+    results = []
+    poller.watch("a", "Ready", "node-a", 10, lambda ok, status: results.append((ok, status)))
+    poller.poll_once()  # missing from the listing: Unknown
+    client.statuses["a"] = "Commissioning"
+    poller.poll_once()
+    client.statuses["a"] = "Unknown"
+    poller.poll_once()
+    time.sleep(0.1)
+    poller.poll_once()
+    assert results == []
+    time.sleep(0.15)
+    poller.poll_once()
+    assert results == [(False, "Unknown")]
+
+
+class AsyncFakeClient(FakeClient):
+    async def call(self, resource, action, **params):
+        return FakeClient.call(self, resource, action, **params)
+
+
+def test_async_poller_gives_up_on_a_machine_unknown_for_the_grace_period(monkeypatch):
+    monkeypatch.setattr(fleetPoller, "UNKNOWN_GRACE", 0.1)
+
+    async def wait():
+        poller = AsyncFleetPoller(AsyncFakeClient({"a": "Unknown"}), logging.getLogger("test"),
+                                  min_interval=0.01, max_interval=0.05)
+        task = asyncio.create_task(poller.run())
+        try:
+            return await asyncio.wait_for(poller.wait_for_async("a", "Ready", "node-a", 10), 5)
+        finally:
+            poller.stop()
+            await task
+
+    assert asyncio.run(wait()) == (False, "Unknown")
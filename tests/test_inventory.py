@@ -0,0 +1,37 @@
+import pytest
+from modules.inventory import REQUIRED_COLUMNS, Inventory, InventoryError
+
+ROW = {"hostname": "node1", "architecture": "amd64/generic", "mac_addresses": "52:54:00:00:00:01",
+       "power_type": "ipmi", "power_address": "10.0.0.1", "ip": "192.168.1.1"}
+
+
+def write_csv(tmp_path, lines):
+    path = tmp_path / "machines.csv"
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def csv_line(row):
+    return ",".join(row.get(column, "") for column in REQUIRED_COLUMNS)
+
+
+def test_valid_csv_loads(tmp_path):
+    inventory = Inventory.load(write_csv(tmp_path, [",".join(REQUIRED_COLUMNS), csv_line(ROW)]))
+    assert [row["hostname"] for row in inventory] == ["node1"]
+
+
+def test_short_row_is_a_validation_error(tmp_path):
+    path = write_csv(tmp_path, [",".join(REQUIRED_COLUMNS), csv_line(ROW), "node2,amd64/generic"])
+    with pytest.raises(InventoryError) as excinfo:
+        Inventory.load(path)
+    errors = excinfo.value.errors
+    assert f"line 3: has 2 field(s), the header has {len(REQUIRED_COLUMNS)}" in errors
+    assert "line 3: ip is empty" in errors
+
+
+def test_long_row_is_a_validation_error(tmp_path):
+    path = write_csv(tmp_path, [",".join(REQUIRED_COLUMNS), csv_line(ROW) + ",extra"])
+    with pytest.raises(InventoryError) as excinfo:
+        Inventory.load(path)
+    assert excinfo.value.errors == [f"line 2: has {len(REQUIRED_COLUMNS) + 1} field(s), "
+                                    f"the header has {len(REQUIRED_COLUMNS)}"]
@@ -0,0 +1,65 @@
+import logging
+import pytest
+from modules.journal import Journal, load_journal
+from modules.maasHelper import ProvisioningFlow, check_layout_fits, resume_point
+from modules.pipeline import STAGES, Node, Pipeline
+from modules.storageLayout import LayoutSpec
+
+READY = {"system_id": "abc123", "status_name": "Ready"}
+
+
+def journal_record(tmp_path, *events):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    for event in events:
+        journal.record("node1", event, system_id="abc123")
+    journal.close()
+    return load_journal(journal.path)["node1"]
+
+
+def test_resume_after_storage_failure_applies_storage_again(tmp_path):
+    record = journal_record(tmp_path, "created", "commissioned", "storage_failed")
+    assert resume_point(record, READY, "yes") == "storage"
+
+
+def test_storage_failure_after_an_earlier_success_applies_storage_again(tmp_path):
+    record = journal_record(tmp_path, "created", "commissioned", "storage", "storage_failed")
+    assert resume_point(record, READY, "yes") == "storage"
+
+
+def test_resume_after_storage_deploys(tmp_path):
+    record = journal_record(tmp_path, "created", "commissioned", "storage_failed", "storage")
+    assert resume_point(record, READY, "yes") == "deploy"
+    assert resume_point(record, READY, "yes", redo=("storage",)) == "storage"
+
+
+def test_failing_wait_callback_finishes_the_node():
+    pipeline = Pipeline({stage: 1 for stage in STAGES}, logging.getLogger("test"))
+    flow = ProvisioningFlow(None, None, pipeline, None, False, None, "no", None, logging.getLogger("test"))
+    node = Node({"hostname": "node1"})
+    pipeline.add(node)
+
+    def commissioned(ok, status):
+        raise KeyError("system_id")
+
+    flow.timed(node, "commissioning", commissioned)(True, "Ready")
+    pipeline.wait()
+    assert node.status == "Error During Commissioning"
+
+
+class ListingClient:
+    def __init__(self, machines):
+        self.machines = machines
+
+    def call(self, resource, action, *ids, **params):
+        return self.machines
+
+
+def test_layout_is_checked_against_the_boot_disks_maas_knows():
+    spec = LayoutSpec("maas_vg", "0.5G", "1G", [{"name": "root", "size": "20G", "mount_point": "/"}])
+    rows = [{"hostname": "small"}, {"hostname": "big"}, {"hostname": "new"}]
+    client = ListingClient([{"system_id": "s1", "hostname": "small", "boot_disk": {"size": 10 * 1024**3}},
+                            {"system_id": "s2", "hostname": "big", "boot_disk": {"size": 100 * 1024**3}}])
+    with pytest.raises(ValueError, match="small: layout needs") as excinfo:
+        check_layout_fits(client, rows, spec)
+    assert "big" not in str(excinfo.value)
+    check_layout_fits(client, rows[1:], spec)
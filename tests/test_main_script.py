@@ -0,0 +1,47 @@
+import pytest
+import main_script
+from modules import onboard
+from modules.journal import journal_path
+
+
+class FakeStream:
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.closed = False
+        FakeStream.instances.append(self)
+
+    def start(self):
+        return self
+
+    def add(self, node):
+        pass
+
+    def close(self):
+        self.closed = True
+        return True
+
+
+def test_run_closes_the_journal_and_the_stream_when_provisioning_fails(tmp_path, monkeypatch):
+    csv_filename = str(tmp_path / "machines.csv")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main_script, "load_inventory", lambda *args, **kwargs: None)
+    monkeypatch.setattr(main_script, "check_onboarding", lambda *args: None)
+    monkeypatch.setattr(main_script, "load_storage_layout", lambda *args: None)
+    reported = []
+    monkeypatch.setattr(main_script, "report_timing", lambda *args: reported.append(True))
+    monkeypatch.setattr(onboard, "OnboardingStream", FakeStream)
+
+    def provision_machines(args, parser, inventory, logger, journal, spans, **kwargs):
+        journal.record("node1", "created", system_id="abc123")
+        raise RuntimeError("MAAS went away")
+
+    monkeypatch.setattr(main_script, "provision_machines", provision_machines)
+    with pytest.raises(RuntimeError):
+        main_script.main(["run", "--csv_filename", csv_filename, "--maas_user", "admin", "--max_workers", "2",
+                          "--ssh_user", "ubuntu", "--portal", "p", "--region", "r", "--environment", "e",
+                          "--url", "https://p-r.example.com", "--incremental_onboarding", "yes"])
+    assert FakeStream.instances[-1].closed
+    assert reported
+    with open(journal_path(csv_filename)) as f:
+        assert '"created"' in f.read()
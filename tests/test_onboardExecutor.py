@@ -0,0 +1,39 @@
+import os
+import logging
+from modules.onboardExecutor import OnboardingExecutor
+
+HOST_TEMPLATE = "templates/host_onboard_data.yaml.j2"
+NODES_DATA = "user_configs/p/r/node-onboarding/p-r-nodesdata.yaml"
+STEP_NAMES = ("setup-environment", "render-userconfig", "create-hostagents-configs", "onprem", "apply-hosts-onboard")
+
+
+def fake_pcd_dir(tmp_path):
+    """A pcd_ansible-pcd_develop whose pcdExpress logs when each step starts and ends."""
+    pcd_dir = tmp_path / "pcd_ansible-pcd_develop"
+    (pcd_dir / "templates").mkdir(parents=True)
+    script = pcd_dir / "pcdExpress"
+    script.write_text('#!/bin/sh\necho "start $1" >> steps.log\nsleep 0.2\necho "end $1" >> steps.log\n')
+    script.chmod(0o755)
+    return pcd_dir
+
+
+def run_steps(tmp_path):
+    pcd_dir = fake_pcd_dir(tmp_path)
+    steps = {name: ["./pcdExpress", name] for name in STEP_NAMES}
+    executor = OnboardingExecutor(steps, str(pcd_dir), NODES_DATA, HOST_TEMPLATE, str(tmp_path / "logs"),
+                                  logging.getLogger("test"))
+
+    def write_vars(hosts, path):
+        with open(path, "w") as f:
+            f.write("hosts: " + ",".join(hosts) + "\n")
+
+    result = executor.run(["10.0.0.1", "10.0.0.2"], write_vars)
+    with open(os.path.join(pcd_dir, "steps.log")) as f:
+        return result, f.read().split("\n")[:-1]
+
+
+def test_each_step_waits_for_the_step_whose_output_it_reads(tmp_path):
+    result, events = run_steps(tmp_path)
+    assert result.succeeded == ["10.0.0.1", "10.0.0.2"]
+    # No step starts before the one before it has ended.
+    assert events == [f"{event} {name}" for name in STEP_NAMES for event in ("start", "end")]
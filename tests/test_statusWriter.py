@@ -0,0 +1,46 @@
+import csv
+import json
+import logging
+from modules.inventory import Inventory
+from modules.journal import Journal
+from modules.runState import RunState
+from modules.statusWriter import StatusWriter, status_path, updated_csv_path
+
+FIELDS = ["hostname", "ip"]
+
+
+def write_inventory(tmp_path):
+    path = tmp_path / "machines.csv"
+    path.write_text("hostname,ip\nnode1,10.0.0.1\nnode2,10.0.0.2\n")
+    return Inventory(str(path), FIELDS, [{"hostname": "node1", "ip": "10.0.0.1"},
+                                         {"hostname": "node2", "ip": "10.0.0.2"}])
+
+
+def updated_statuses(inventory):
+    with open(updated_csv_path(inventory.path), newline='') as f:
+        return {row["hostname"]: row["deployment_status"] for row in csv.DictReader(f)}
+
+
+def test_rerun_keeps_previous_statuses_until_a_node_progresses(tmp_path):
+    inventory = write_inventory(tmp_path)
+    with open(updated_csv_path(inventory.path), "w") as f:
+        f.write("hostname,ip,deployment_status\nnode1,10.0.0.1,Deployed\nnode2,10.0.0.2,Deployment Failed\n")
+
+    writer = StatusWriter(inventory, logging.getLogger("test"), interval=60,
+                          previous=RunState(inventory.path).previous()).start()
+    writer.update("node2", "created", system_id="abc123")
+    writer.stop()
+    assert updated_statuses(inventory) == {"node1": "Deployed", "node2": ""}
+    with open(status_path(inventory.path)) as f:
+        assert json.load(f)["counts"] == {"Deployed": 1, "In Progress": 1}
+
+
+def test_statuses_come_from_the_journal_without_status_files(tmp_path):
+    inventory = write_inventory(tmp_path)
+    journal = Journal(str(tmp_path / "machines_journal.jsonl"))
+    journal.record("node1", "ssh", system_id="abc123")
+    journal.record("node1", "finished", system_id="abc123", status="Deployed")
+    journal.close()
+
+    StatusWriter(inventory, logging.getLogger("test"), previous=RunState(inventory.path).previous()).start().stop()
+    assert updated_statuses(inventory) == {"node1": "Deployed", "node2": ""}
@@ -0,0 +1,99 @@
+import logging
+from modules.stepCache import StepCache
+
+CONFIG_DIR = "user_configs/p/r"
+PLAY_DATA = "p-play_data/r"
+NODES_DATA = "user_configs/p/r/node-onboarding/p-r-nodesdata.yaml"
+HOST_TEMPLATE = "templates/host_onboard_data.yaml.j2"
+
+
+def cache(tmp_path, force=()):
+    return StepCache(str(tmp_path / "step_cache.json"), (CONFIG_DIR, PLAY_DATA), NODES_DATA,
+                     logging.getLogger("test"), force, input_files=(HOST_TEMPLATE,))
+
+
+def run_step(step_cache, cwd, name, write):
+    """Run a fake step through the cache: write(cwd) is its work. Returns whether it ran."""
+    skip, state = step_cache.begin(name, ["./pcdExpress", name], str(cwd))
+    if skip:
+        return False
+    write(cwd)
+    step_cache.store(state)
+    return True
+
+
+def setup_environment(cwd):
+    (cwd / CONFIG_DIR).mkdir(parents=True, exist_ok=True)
+    (cwd / CONFIG_DIR / "p-r-e-environment.yaml").write_text("env: e\n")
+
+
+def create_hostagents_configs(cwd):
+    (cwd / PLAY_DATA / "inventory").mkdir(parents=True, exist_ok=True)
+    (cwd / PLAY_DATA / "inventory" / "hosts").write_text("10.0.0.1\n")
+
+
+def workspace(tmp_path):
+    cwd = tmp_path / "pcd"
+    (cwd / "templates").mkdir(parents=True)
+    (cwd / HOST_TEMPLATE).write_text("hosts: [10.0.0.1]\n")
+    (cwd / "pcdExpress").write_text("#!/bin/sh\n")
+    return cwd
+
+
+def test_unchanged_steps_are_skipped(tmp_path):
+    cwd = workspace(tmp_path)
+    assert run_step(cache(tmp_path), cwd, "setup-environment", setup_environment)
+    assert run_step(cache(tmp_path), cwd, "create-hostagents-configs", create_hostagents_configs)
+    assert not run_step(cache(tmp_path), cwd, "setup-environment", setup_environment)
+    assert not run_step(cache(tmp_path), cwd, "create-hostagents-configs", create_hostagents_configs)
+
+
+def test_deleted_output_is_a_cache_miss(tmp_path):
+    cwd = workspace(tmp_path)
+    run_step(cache(tmp_path), cwd, "setup-environment", setup_environment)
+    run_step(cache(tmp_path), cwd, "create-hostagents-configs", create_hostagents_configs)
+    (cwd / CONFIG_DIR / "p-r-e-environment.yaml").unlink()
+    (cwd / PLAY_DATA / "inventory" / "hosts").unlink()
+    assert run_step(cache(tmp_path), cwd, "setup-environment", setup_environment)
+    assert run_step(cache(tmp_path), cwd, "create-hostagents-configs", create_hostagents_configs)
+
+
+def render_userconfig(cwd):
+    hosts = (cwd / NODES_DATA).read_text()
+    (cwd / CONFIG_DIR / "p-r-hostagentconfigs.yaml").write_text(f"rendered from {hosts}")
+
+
+def add_host(cwd):
+    """What the executor does for a run with one more host: new host template and nodes data."""
+    (cwd / HOST_TEMPLATE).write_text("hosts: [10.0.0.1, 10.0.0.2]\n")
+    (cwd / NODES_DATA).write_text("hosts: [10.0.0.1, 10.0.0.2]\n")
+
+
+def test_rerun_with_added_hosts_only_renders_the_configs_again(tmp_path):
+    cwd = workspace(tmp_path)
+    (cwd / NODES_DATA).parent.mkdir(parents=True)
+    (cwd / NODES_DATA).write_text("hosts: [10.0.0.1]\n")
+    steps = [("setup-environment", setup_environment), ("render-userconfig", render_userconfig),
+             ("create-hostagents-configs", create_hostagents_configs)]
+    assert [run_step(cache(tmp_path), cwd, name, write) for name, write in steps] == [True, True, True]
+    add_host(cwd)
+    # The environment is reused; the configs rendered from the host list are not.
+    assert [run_step(cache(tmp_path), cwd, name, write) for name, write in steps] == [False, True, True]
+    assert [run_step(cache(tmp_path), cwd, name, write) for name, write in steps] == [False, False, False]
+
+
+def test_edited_host_template_is_a_cache_miss_for_the_config_steps(tmp_path):
+    cwd = workspace(tmp_path)
+    run_step(cache(tmp_path), cwd, "setup-environment", setup_environment)
+    run_step(cache(tmp_path), cwd, "create-hostagents-configs", create_hostagents_configs)
+    (cwd / HOST_TEMPLATE).write_text("hosts: [10.0.0.1, 10.0.0.2]\n")
+    assert not run_step(cache(tmp_path), cwd, "setup-environment", setup_environment)
+    assert run_step(cache(tmp_path), cwd, "create-hostagents-configs", create_hostagents_configs)
+
+
+def test_forced_steps_always_run(tmp_path):
+    cwd = workspace(tmp_path)
+    run_step(cache(tmp_path), cwd, "setup-environment", setup_environment)
+    assert not cache(tmp_path, force=("all",)).cacheable("setup-environment")
+    assert not cache(tmp_path, force=("setup-environment",)).cacheable("setup-environment")
+    assert cache(tmp_path, force=("setup-environment",)).cacheable("render-userconfig")
@@ -0,0 +1,33 @@
+from modules.storageLayout import CurrentLayout, LayoutSpec, plan_layout
+
+GIB = 1024**3
+
+
+def spec():
+    return LayoutSpec("maas_vg", "0.5G", "1G", [
+        {"name": "root", "size": "20G", "fs_type": "ext4", "mount_point": "/"},
+        {"name": "swap", "size": "512M"},
+    ])
+
+
+def test_create_lv_sends_the_checked_size_in_bytes():
+    layout = spec()
+    current = CurrentLayout(1, [{"id": 1, "name": "sda", "partitions": []}], [], boot_disk_size=100 * GIB)
+    layout.check_fits(current.boot_disk_size)
+    sizes = {op.params["name"]: op.params["size"] for op in plan_layout(current, layout) if op.phase == "create-lv"}
+    assert sizes == {"root": str(20 * GIB), "swap": str(512 * 1024**2)}
+    assert sum(int(size) for size in sizes.values()) == layout.partitions[2].size_bytes
+
+
+def test_lv_of_the_same_size_in_bytes_is_kept():
+    layout = spec()
+    partitions = [{"id": 10 + index, "size": part.size_bytes} for index, part in enumerate(layout.partitions)]
+    volume_group = {"id": 20, "name": "maas_vg", "devices": [{"id": 12}], "logical_volumes": [
+        {"id": 21, "name": "maas_vg-root", "size": 20 * GIB, "filesystem": {"fstype": "ext4", "mount_point": "/"}},
+        {"id": 22, "name": "maas_vg-swap", "size": 512 * 1000**2, "filesystem": {"fstype": "swap"}},
+    ]}
+    current = CurrentLayout(1, [{"id": 1, "name": "sda", "partitions": partitions}], [volume_group])
+    phases = [(op.phase, op.description) for op in plan_layout(current, layout)
+              if op.phase in ("delete-lv", "create-lv")]
+    # Only the swap LV, created with a decimal reading of 512M, is recreated.
+    assert phases == [("delete-lv", "delete LV maas_vg-swap (size changed)"), ("create-lv", "create LV swap (512M)")]